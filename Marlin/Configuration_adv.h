@@ -294,6 +294,10 @@ const unsigned int dropsegments=5; //everything with less than this number of st
 #define MAX_CMD_SIZE 96
 #define BUFSIZE 8
 
+// Max. payload of a block of packed commands stored to the SD card
+// (command 9, ultiprint store -b).
+#define USB_BLOCK_SIZE 256
+
 
 // Firmware based and LCD controled retract
 // M207 and M208 can be used to define parameters for the retraction.
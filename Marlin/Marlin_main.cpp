@@ -144,6 +144,7 @@
 // M540 - Use S[0|1] to enable or disable the stop SD card print on endstop hit (requires ABORT_ON_ENDSTOP_HIT_FEATURE_ENABLED)
 // M600 - Pause for filament change X[pos] Y[pos] Z[relative lift] E[initial retract] L[later retract distance for removal]
 // M623 - Select SD file (M623 filename.g) for ultimaker2 print, print is started by UM2 gui software.
+// M624 - Check packed usb commands with a CRC-16 instead of the XOR checksum (S1), or not (S0), reset by M110.
 // M907 - Set digital trimpot motor current using axis codes.
 // M908 - Control digital trimpot directly.
 // M350 - Set microstepping mode.
@@ -256,6 +257,11 @@ static int buflen = 0;
 // Usb/serial read buffer of max. MAX_CMD_SIZE size.
 static char usbCmdBuffer[MAX_CMD_SIZE];
 
+// Read buffer of a block of packed commands (command PACKED_BLOCK):
+// header, payload of max. USB_BLOCK_SIZE bytes and CRC.
+#define USB_BLOCK_HEADER 5
+static uint8_t usbBlockBuffer[USB_BLOCK_HEADER + USB_BLOCK_SIZE + 2];
+
 // Structure to store the result of get_command_usb()
 // XXX merge get_command_usb* functions into this
 class UsbCommand {
@@ -270,6 +276,11 @@ class UsbCommand {
         uint8_t packed_count;
         // Timestamp start character of a usbserial command
         unsigned long startTS;
+        // Number of bytes of a block read, 0 if no block is read
+        uint16_t block_count;
+        // Length of the block including header and CRC, known
+        // after the header is read
+        uint16_t block_len;
 
         UsbCommand() {
             serial_count = 0;
@@ -277,11 +288,14 @@ class UsbCommand {
             len = 0;
             packed_count = 0;
             startTS = 0;
+            block_count = 0;
+            block_len = 0;
         }
 
         void reset() {
             serial_count = 0;
             packed_count = 0;
+            block_count = 0;
 
             // MYSERIAL.flush();
 
@@ -311,6 +325,20 @@ static UsbCommand usbCommand;
 uint8_t errorFlags = 0;
 #endif
 
+#if defined(USBStats)
+// Number of commands received over usb and number of commands and bytes
+// written to the sd card, read by the headless simulator.
+uint32_t usbPackedCommands = 0;
+uint32_t usbUnpackedCommands = 0;
+uint32_t usbStoredCommands = 0;
+uint32_t usbStoredBytes = 0;
+uint32_t usbStoredBlocks = 0;
+#endif
+
+// Set by M624: packed commands from usb end with a CRC-16 instead
+// of the XOR checksum and the newline.
+static bool usbCRC16 = false;
+
 static void manage_inactivity();
 
 //static int i = 0;
@@ -347,6 +375,8 @@ char * get_command_usb(UsbCommand *usbCommand, bool cardSaving);
 char * get_command_usb_unpacked(UsbCommand *usbCommand, bool cardSaving);
 /// Get command from usb, packed binary version
 char * get_command_usb_packed(UsbCommand *usbCommand);
+/// Get block of packed commands from usb, returns the payload
+char * get_command_usb_block(UsbCommand *usbCommand, bool cardSaving);
 void get_command_sd();
 /// Get command from sd card, plain text version, return the number of bytes read
 uint8_t get_command_sd_unpacked(int16_t c);
@@ -595,6 +625,17 @@ void loop()
 }
 
 #define ISPACKEDCOMMAND(c) (c < '\n')
+// Command key of the packed M-codes (M104, M106, M107, M109 and M140)
+#define PACKED_MCODE 7
+// Command key of the delta encoded moves, see ultiprint/deltapack.py
+#define PACKED_DELTA 8
+// Command key of a block of packed commands to store on the SD card,
+// see ultiprint/blockstore.py
+#define PACKED_BLOCK 9
+
+// Size of the params of delta encoded moves by their width code:
+// not present, 1 byte delta, 2 byte delta, 4 byte float
+const uint8_t deltaWidths[4] = { 0, 1, 2, 4 };
 
 void get_command_sd() {
 
@@ -693,22 +734,43 @@ readError:
   #endif //SDSUPPORT
 }
 
-uint8_t getPackedLen(uint8_t paramFlags) {
+uint8_t getPackedLen(uint8_t cmd, uint8_t paramFlags) {
 
     uint8_t len = 3; // command + parammask + checksum
     len += 1; // XXX newline, not needed! adjust SLENPTR, ILENPTR, CHKSMPTR
 
+    if (cmd == PACKED_DELTA) {
+      // Width mask, 2 bits per param: XXYYZZEE
+      for (uint8_t shift = 0; shift < 8; shift += 2)
+        len += deltaWidths[(paramFlags >> shift) & 0x3];
+      len += 2; // lower 16 bits of the linenumber
+      return len;
+    }
+
     // Compute length of command from the `parameter mask`
-    if (paramFlags & 0x80)
-      len += 2; // F param
-    if (paramFlags & 0x40)
-      len += 4; // X param
-    if (paramFlags & 0x20)
-      len += 4; // Y param
-    if (paramFlags & 0x10)
-      len += 4; // Z param
-    if (paramFlags & 0x08)
-      len += 4; // E param
+    if (cmd == PACKED_MCODE) {
+      len += 1; // number of the M-code
+      if (paramFlags & 0x80)
+        len += 2; // S param
+      if (paramFlags & 0x40)
+        len += 1; // T param
+    }
+    else {
+      if (paramFlags & 0x80)
+        len += 2; // F param
+      if (paramFlags & 0x40)
+        len += 4; // X param
+      if (paramFlags & 0x20)
+        len += 4; // Y param
+      if (paramFlags & 0x10)
+        len += 4; // Z param
+      if (paramFlags & 0x08)
+        len += 4; // E param
+      if (paramFlags & 0x02)
+        len += 4; // I param, arcs only
+      if (paramFlags & 0x01)
+        len += 4; // J param, arcs only
+    }
     if (paramFlags & 0x04)
       len += 2; // short linenumber
     else
@@ -745,9 +807,9 @@ uint8_t get_command_sd_packed(int16_t n) {
     }
 
     n=card.get();
-    uint8_t nBytes = getPackedLen((char)n);
+    uint8_t nBytes = getPackedLen(cmdbuffer[bufindw][0], (char)n);
 
-    if (n & 0x04) {
+    if ((n & 0x04) || (cmdbuffer[bufindw][0] == PACKED_DELTA)) {
 
         // Short line number
         nBytes -= 3;
@@ -792,6 +854,22 @@ uint8_t get_command_sd_packed(int16_t n) {
 // Send ascii-ACK 0x6 for accepted usbserial command.
 #define USBACK  { MYSERIAL.write(0x6); }
 
+// CRC-16 with polynomial 0x1021 and initial value 0 (XModem), like
+// _crc_xmodem_update() of avr-libc.
+uint16_t crc16_update(uint16_t crc, uint8_t data) {
+
+    crc ^= (uint16_t)data << 8;
+
+    for (uint8_t i = 0; i < 8; i++) {
+        if (crc & 0x8000)
+            crc = (crc << 1) ^ 0x1021;
+        else
+            crc <<= 1;
+    }
+
+    return crc;
+}
+
 char * get_command_usb(UsbCommand *usbCommand, bool cardSaving)
 {
 
@@ -822,6 +900,9 @@ char * get_command_usb(UsbCommand *usbCommand, bool cardSaving)
 
             usbCommand->startTS = millis();
 
+            if (serial_char == PACKED_BLOCK)
+                return get_command_usb_block(usbCommand, cardSaving);
+
             if (ISPACKEDCOMMAND(serial_char))
                 return get_command_usb_packed(usbCommand);
             else
@@ -858,6 +939,9 @@ char * get_command_usb(UsbCommand *usbCommand, bool cardSaving)
             return NULL;
       }
 
+      if (usbCommand->block_count)
+            return get_command_usb_block(usbCommand, cardSaving);
+
       if (usbCommand->packed_count)
             return get_command_usb_packed(usbCommand);
       else
@@ -960,6 +1044,11 @@ char * get_command_usb_unpacked(UsbCommand *usbCommand, bool cardSaving)
       if (gcode_N >= 0)
           gcode_LastN = gcode_N;
 
+      // A transfer starts with M110, check the packed commands with
+      // the XOR checksum until the host asks for the CRC (M624).
+      if (strncmp_P(cmdStart, PSTR("M110"), 4) == 0)
+          usbCRC16 = false;
+
       // Shift left, overwrite line number
       if (cmdStart != buffer) {
 
@@ -987,6 +1076,9 @@ char * get_command_usb_unpacked(UsbCommand *usbCommand, bool cardSaving)
 
       if (buffer[0] == ';') { // entire line is a comment
         if (cardSaving) {
+          #if defined(USBStats)
+            usbUnpackedCommands++;
+          #endif
           USBACK; // Send ACK
           return buffer;  // Valid command, ultigcode
         }
@@ -1015,6 +1107,9 @@ char * get_command_usb_unpacked(UsbCommand *usbCommand, bool cardSaving)
           lastSerialCommandTime = millis();
 #endif
 
+      #if defined(USBStats)
+        usbUnpackedCommands++;
+      #endif
       USBACK; // Send ACK
       return buffer;
     }
@@ -1049,18 +1144,37 @@ syntaxError:
 
 /*
 # 1 byte:            command 0-9
-# 1 byte:            'parameter mask', bits: FXYZES00 (2 unused bytes)
+# 1 byte:            'parameter mask', bits: FXYZESIJ (I and J for arcs only)
 # 2 byte:            F param (short)
 # 4 byte:            X param (float)
 # 4 byte:            Y param (float)
 # 4 byte:            Z param (float)
 # 4 byte:            E param (float)
+# 4 byte:            I param (float)
+# 4 byte:            J param (float)
 # 2/4 byte:          2 or 4byte (short/int) line counter, am schluss, damit einfach abzuschneiden
 # 1 byte:            checksum
+#
+# With M624 S1 the checksum and the newline are replaced by the
+# CRC-16 (XModem) of the command, the length stays the same.
+#
+# Delta encoded moves (command PACKED_DELTA), see ultiprint/deltapack.py:
+#
+# 1 byte:            'width mask', 2 bits per param: XXYYZZEE
+# 1/2/4 byte:        X, Y, Z and E params, delta or absolute
+# 2 byte:            lower 16 bits of the line counter
+#
+# Packed M-codes (command PACKED_MCODE):
+#
+# 1 byte:            'parameter mask', bits: ST000S00 (S param, T param, short line number)
+# 1 byte:            number of the M-code
+# 2 byte:            S param (unsigned short)
+# 1 byte:            T param
 */
 
 #define SLENPTR ((uint16_t*)(buffer+usbCommand->packed_count - 4))
 #define CHKSMPTR ((uint8_t*)(buffer+usbCommand->packed_count - 2))
+#define CRCPTR ((uint16_t*)(buffer+usbCommand->packed_count - 2))
 #define ILENPTR ((uint32_t*)(buffer+usbCommand->packed_count - 6))
 
 char * get_command_usb_packed(UsbCommand *usbCommand) {
@@ -1084,7 +1198,7 @@ char * get_command_usb_packed(UsbCommand *usbCommand) {
             // Store second char
             usbCommand->buffer[usbCommand->serial_count++] = serial_char;
 
-            usbCommand->packed_count = getPackedLen(serial_char);
+            usbCommand->packed_count = getPackedLen(buffer[0], serial_char);
         }
         else {
           usbCommand->packed_count = 1;
@@ -1103,15 +1217,31 @@ char * get_command_usb_packed(UsbCommand *usbCommand) {
     // Packed command read now
     usbCommand->serial_count = 0;
 
-    uint8_t checksum = 0;
     char *ptr = buffer;
+    bool checksumOk;
 
     // Check checksum
     // compute checksum from command
-    while(ptr < (buffer + usbCommand->packed_count - 2))
-        checksum = checksum ^ *(ptr++);
+    if (usbCRC16) {
 
-    if (*CHKSMPTR != checksum) {
+        uint16_t crc = 0;
+
+        while(ptr < (buffer + usbCommand->packed_count - 2))
+            crc = crc16_update(crc, *(ptr++));
+
+        checksumOk = (*CRCPTR == crc);
+    }
+    else {
+
+        uint8_t checksum = 0;
+
+        while(ptr < (buffer + usbCommand->packed_count - 2))
+            checksum = checksum ^ *(ptr++);
+
+        checksumOk = (*CHKSMPTR == checksum);
+    }
+
+    if (! checksumOk) {
 
         SERIAL_ERROR_START;
         SERIAL_ERRORPGM(MSG_ERR_CHECKSUM_MISMATCH);
@@ -1124,7 +1254,18 @@ char * get_command_usb_packed(UsbCommand *usbCommand) {
     }
 
     // Check linenumber
-    if (buffer[1] & 0x04) {
+    if (buffer[0] == PACKED_DELTA) {
+
+        // Lower 16 bits of the line number
+        if(*SLENPTR != (uint16_t)(gcode_LastN+1))
+            goto lineError;
+
+        gcode_LastN++;
+
+        // Cut linenumber and checksum
+        usbCommand->len = usbCommand->packed_count - 4;
+    }
+    else if (buffer[1] & 0x04) {
 
         // Short line number
         if(*SLENPTR != gcode_LastN+1)
@@ -1148,6 +1289,9 @@ char * get_command_usb_packed(UsbCommand *usbCommand) {
     }
 
     usbCommand->packed_count = 0;
+    #if defined(USBStats)
+        usbPackedCommands++;
+    #endif
     USBACK; // Send ACK
     return buffer;
 
@@ -1162,6 +1306,99 @@ lineError:
     return NULL;
 }
 
+/*
+# Block of packed commands (command PACKED_BLOCK), store mode only:
+#
+# 1 byte:            command 9
+# 2 byte:            length of the payload, max. USB_BLOCK_SIZE
+# 2 byte:            lower 16 bits of the line counter, a block counts as one line
+# n byte:            payload, the commands as they are written to the file
+# 2 byte:            CRC-16 (XModem) of the header and the payload
+*/
+
+#define BLENPTR ((uint16_t*)(usbBlockBuffer + 1))
+#define BSEQPTR ((uint16_t*)(usbBlockBuffer + 3))
+#define BCRCPTR ((uint16_t*)(usbBlockBuffer + usbCommand->block_len - 2))
+
+char * get_command_usb_block(UsbCommand *usbCommand, bool cardSaving) {
+
+    if (usbCommand->block_count == 0) {
+
+        // Command key read by get_command_usb()
+        usbBlockBuffer[usbCommand->block_count++] = PACKED_BLOCK;
+        usbCommand->block_len = USB_BLOCK_HEADER;
+    }
+
+    while (usbCommand->block_count < usbCommand->block_len) {
+
+        if (! MYSERIAL.available())
+            return NULL; // try later
+
+        usbBlockBuffer[usbCommand->block_count++] = MYSERIAL.read();
+
+        if (usbCommand->block_count == USB_BLOCK_HEADER) {
+
+            // Header read, get the length of the block
+            if (!cardSaving || (*BLENPTR == 0) || (*BLENPTR > USB_BLOCK_SIZE))
+                goto syntaxError;
+
+            usbCommand->block_len = USB_BLOCK_HEADER + *BLENPTR + 2;
+        }
+    }
+
+    // Block read now
+    usbCommand->serial_count = 0;
+    usbCommand->block_count = 0;
+
+    {
+        uint16_t crc = 0;
+        uint8_t *ptr = usbBlockBuffer;
+
+        while(ptr < (usbBlockBuffer + usbCommand->block_len - 2))
+            crc = crc16_update(crc, *(ptr++));
+
+        if (*BCRCPTR != crc) {
+
+            SERIAL_ERROR_START;
+            SERIAL_ERRORPGM(MSG_ERR_CHECKSUM_MISMATCH);
+            SERIAL_ERRORLN(gcode_LastN);
+            usbCommand->reset();
+            #if defined(ExtendedStats)
+                errorFlags |= EFCheckError;
+            #endif
+            return NULL;
+        }
+    }
+
+    // Lower 16 bits of the line number
+    if (*BSEQPTR != (uint16_t)(gcode_LastN+1)) {
+
+        SERIAL_ERROR_START;
+        SERIAL_ERRORPGM(MSG_ERR_LINE_NO);
+        SERIAL_ERRORLN(gcode_LastN);
+        usbCommand->reset();
+        #if defined(ExtendedStats)
+            errorFlags |= EFLineError;
+        #endif
+        return NULL;
+    }
+
+    gcode_LastN++;
+
+    // Acknowledged by doIdleTasks() when the block is written
+    return (char *)usbBlockBuffer + USB_BLOCK_HEADER;
+
+syntaxError:
+    SERIAL_ERROR_START;
+    SERIAL_ERRORPGM("Syntax error, Last Line:");
+    SERIAL_ERRORLN(gcode_LastN);
+    usbCommand->reset();
+    #if defined(ExtendedStats)
+        errorFlags |= EFSyntaxError;
+    #endif
+    return NULL;
+}
+
 float code_value()
 {
   return (strtod(strchr_pointer + 1, NULL));
@@ -1369,7 +1606,15 @@ void get_coordinates()
 #define XYZNotSeen(parammask) ((parammask & 0x70) == 0)
 #define ESeen(parammask) (parammask & 0x8)
 
-void get_coordinates_packed(char * buffer)
+// Reference values of the delta encoded moves, the last X, Y, Z and E
+// params of the packed moves and arcs.
+static float delta_reference[NUM_AXIS];
+
+// Scale of the fixed point deltas
+const float deltaScales[NUM_AXIS] = { 0.001, 0.001, 0.001, 0.00001 };
+
+// Returns a pointer to the parameter following the E param
+char * get_coordinates_packed(char * buffer)
 {
     int8_t paramMask = buffer[1];
 
@@ -1388,7 +1633,8 @@ void get_coordinates_packed(char * buffer)
     {
         if(paramMask & mask) {
 
-            destination[i] = *((float*)buffer) + (axis_relative_modes[i] || relative_mode)*current_position[i];
+            delta_reference[i] = *((float*)buffer);
+            destination[i] = delta_reference[i] + (axis_relative_modes[i] || relative_mode)*current_position[i];
             buffer += 4; // point to next param
         }
         else
@@ -1403,6 +1649,96 @@ void get_coordinates_packed(char * buffer)
     if (autoretract_enabled && XYZNotSeen(paramMask) && ESeen(paramMask))
         doAutoretract();
     #endif
+
+    return buffer;
+}
+
+void get_coordinates_delta(char * buffer)
+{
+    uint8_t widthMask = buffer[1];
+
+    buffer += 2; // point to first param
+
+    for(int8_t i=0; i < NUM_AXIS; i++)
+    {
+        switch ((widthMask >> (6 - 2*i)) & 0x3) {
+            case 1: // 1 byte delta
+                delta_reference[i] = delta_reference[i] + *((int8_t*)buffer) * deltaScales[i];
+                break;
+            case 2: // 2 byte delta
+                delta_reference[i] = delta_reference[i] + *((int16_t*)buffer) * deltaScales[i];
+                break;
+            case 3: // absolute value
+                delta_reference[i] = *((float*)buffer);
+                break;
+            default: // not present
+                destination[i] = current_position[i];
+                continue;
+        }
+
+        destination[i] = delta_reference[i] + (axis_relative_modes[i] || relative_mode)*current_position[i];
+        buffer += deltaWidths[(widthMask >> (6 - 2*i)) & 0x3]; // point to next param
+    }
+
+    #ifdef FWRETRACT
+    // Only E param present
+    if (autoretract_enabled && ((widthMask & 0xfc) == 0) && (widthMask & 0x3))
+        doAutoretract();
+    #endif
+}
+
+void get_arc_coordinates_packed(char * buffer)
+{
+#ifdef SF_ARC_FIX
+   bool relative_mode_backup = relative_mode;
+   relative_mode = true;
+#endif
+   int8_t paramMask = buffer[1];
+
+   buffer = get_coordinates_packed(buffer);
+#ifdef SF_ARC_FIX
+   relative_mode=relative_mode_backup;
+#endif
+
+   if(paramMask & 0x02) {
+     offset[0] = *((float*)buffer);
+     buffer += 4; // point to next param
+   }
+   else {
+     offset[0] = 0.0;
+   }
+   if(paramMask & 0x01) {
+     offset[1] = *((float*)buffer);
+   }
+   else {
+     offset[1] = 0.0;
+   }
+}
+
+// Expand a packed M-code into a plain text command, it is
+// processed like a command received as text then.
+void unpack_mcode(char * buffer)
+{
+    uint8_t paramMask = buffer[1];
+    uint8_t mcode = buffer[2];
+    uint16_t s = 0;
+    uint8_t t = 0;
+
+    char *ptr = buffer + 3; // point to first param
+
+    if(paramMask & 0x80) {
+        s = *((uint16_t*)ptr);
+        ptr += 2; // point to next param
+    }
+    if(paramMask & 0x40)
+        t = *ptr;
+
+    ptr = buffer + sprintf_P(buffer, PSTR("M%d"), mcode);
+
+    if(paramMask & 0x80)
+        ptr += sprintf_P(ptr, PSTR(" S%u"), s);
+    if(paramMask & 0x40)
+        sprintf_P(ptr, PSTR(" T%d"), t);
 }
 
 #ifdef FWRETRACT
@@ -1459,6 +1795,10 @@ void process_commands()
 
   printing_state = PRINT_STATE_NORMAL;
 
+  // Packed M-codes are processed as plain text commands
+  if (cmdbuffer[bufindr][0] == PACKED_MCODE)
+    unpack_mcode(cmdbuffer[bufindr]);
+
   if (ISPACKEDCOMMAND(cmdbuffer[bufindr][0])) {
 
     switch(cmdbuffer[bufindr][0]) {
@@ -1478,6 +1818,24 @@ void process_commands()
             processG11();
             break;
         #endif //FWRETRACT
+        case 5: // G2  - CW ARC
+            if(Stopped == false) {
+                get_arc_coordinates_packed(cmdbuffer[bufindr]);
+                prepare_arc_move(true);
+            }
+            break;
+        case 6: // G3  - CCW ARC
+            if(Stopped == false) {
+                get_arc_coordinates_packed(cmdbuffer[bufindr]);
+                prepare_arc_move(false);
+            }
+            break;
+        case PACKED_DELTA: // G0/G1, delta encoded
+            if(Stopped == false) {
+                get_coordinates_delta(cmdbuffer[bufindr]); // For X Y Z E
+                prepare_move();
+            }
+            break;
         }
   }
   else if(code_seen('G'))
@@ -2854,6 +3212,14 @@ void process_commands()
       break;
     #endif//ENABLE_ULTILCD2
 
+    case 624: // M624 - Check packed usb commands with a CRC-16 (S1) or the XOR checksum (S0)
+      if (code_seen('S'))
+        usbCRC16 = code_value() != 0;
+      SERIAL_ECHO_START;
+      SERIAL_ECHOPGM("CRC16:");
+      SERIAL_ECHOLN((int)usbCRC16);
+      break;
+
     case 907: // M907 Set digital trimpot motor current using axis codes.
     {
       #if defined(DIGIPOTSS_PIN) && DIGIPOTSS_PIN > -1
@@ -3250,7 +3616,23 @@ void doIdleTasks()
         usbCommand.buffer = usbCmdBuffer;
         usbCmd = get_command_usb(&usbCommand, cardSaving);
 
-        if (usbCmd) {
+        if (usbCmd == (char *)usbBlockBuffer + USB_BLOCK_HEADER) {
+
+            // Block of commands, write the payload at once and
+            // acknowledge the block if it is written.
+            if (card.write_string(usbCmd, *BLENPTR)) {
+                SERIAL_ERROR_START;
+                SERIAL_ERRORLNPGM(MSG_SD_ERR_WRITE_TO_FILE);
+            }
+            else {
+                #if defined(USBStats)
+                    usbStoredBlocks++;
+                    usbStoredBytes += *BLENPTR;
+                #endif
+                USBACK; // Send ACK
+            }
+        }
+        else if (usbCmd) {
 
             // if(strcmp_P(usbCmd, PSTR("M29")) == NULL)
             if((usbCmd[0] != 'M') || (usbCmd[1] != '2') || (usbCmd[2] != '9'))
@@ -3263,6 +3645,12 @@ void doIdleTasks()
                     SERIAL_ERROR_START;
                     SERIAL_ERRORLNPGM(MSG_SD_ERR_WRITE_TO_FILE);
                 }
+                #if defined(USBStats)
+                else {
+                    usbStoredCommands++;
+                    usbStoredBytes += usbCommand.len+1;
+                }
+                #endif
 
                 #if 0
                 // XXX What is "SD Logging" and why do we process the
@@ -3301,7 +3689,12 @@ void doIdleTasks()
 
     manage_heater();
     manage_inactivity();
-    lcd_update();
+
+    // A block is bigger than the serial receive buffer, don't
+    // update the display until it is read.
+    if (usbCommand.block_count == 0)
+        lcd_update();
+
     lifetime_stats_tick();
 }
 
@@ -19,13 +19,32 @@ Options:
   --t0=ttt:rrr      low temperature temperature:resistance point (around 25C)
   --t1=ttt:rrr      middle temperature temperature:resistance point (around 150C)
   --t2=ttt:rrr      high temperature temperature:resistance point (around 250C)
-  --num-temps=...   the number of temperature points to calculate (default: 20)
+  --num-temps=...   the number of temperature points to calculate (default: 36)
+  --max-error=...   create the smallest table with this max. weighted interpolation error (C)
+  --print-range=lll:hhh
+                    temperature range the errors are minimised for (default: 180:260)
+  --outside-weight=...
+                    weight of the errors outside the print range (default: 0.25)
+  --uniform         place the temperature points at uniform steps
+  --error-curve     print the interpolation error per 10C to stderr
+
+The firmware linearly interpolates the temperature between the rows of the
+table (analog2temp() in temperature.cpp). Unless --uniform is given (or numpy
+is missing), the rows are chosen from the whole degrees between min_temp and
+max_temp such that the max. interpolation error over all ADC values is
+minimal for the given number of rows. With --max-error the smallest table
+with at most this error is created instead.
 """
 
 from math import *
 import sys
 import getopt
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 class Thermistor:
     "Class to do the thermistor maths"
     def __init__(self, rp, t1, r1, t2, r2, t3, r3):
@@ -69,6 +88,132 @@ class Thermistor:
         r = exp(pow(x-y,1.0/3) - pow(x+y,1.0/3)) # resistance of thermistor
         return (r / (self.rp + r)) * (1024*16)
 
+    def temp_array(self,adc):
+        "Convert an array of ADC readings into temperatures in Celcius"
+        v = adc * self.vadc / (1024 * 16)
+        r = self.rp * v / (self.vcc - v)
+        lnr = numpy.log(r)
+        Tinv = self.c1 + (self.c2*lnr) + (self.c3*lnr**3)
+        return (1/Tinv) - 273.15
+
+    def adc_array(self,temp):
+        "Convert an array of temperatures into ADC readings"
+        y = (self.c1 - (1/(temp+273.15))) / (2*self.c3)
+        x = numpy.sqrt((self.c2 / (3*self.c3))**3 + y**2)
+        r = numpy.exp((x-y)**(1.0/3) - (x+y)**(1.0/3))
+        return (r / (self.rp + r)) * (1024*16)
+
+class ErrorModel:
+    "Interpolation error of the tables for all ADC readings between min_temp and max_temp"
+    def __init__(self, t, min_temp, max_temp, print_range, outside_weight):
+        self.adcs = numpy.arange(int(t.adc(max_temp)), int(t.adc(min_temp)) + 1)
+        self.temps = t.temp_array(self.adcs)
+        inside = (self.temps >= print_range[0]) & (self.temps <= print_range[1])
+        self.weights = numpy.where(inside, 1.0, outside_weight)
+        self.inside = inside
+
+    def curve(self, table):
+        "Error of the firmware interpolation of the (adc, temp) rows of table, sorted by adc"
+        adcs, temps = numpy.array(table, dtype=float).T
+        return numpy.interp(self.adcs, adcs, temps) - self.temps
+
+    def segment_errors(self, adcs, temps, bound):
+        "Max. weighted error of the segments between the pairs of candidate rows, inf above bound"
+        n = len(adcs)
+        errors = numpy.empty((n, n))
+        errors.fill(numpy.inf)
+        for i in range(n - 1):
+            # Longer segments have larger errors, stop after
+            # a chunk of segments that are all above the bound
+            for j in range(i + 1, n, 16):
+                ends = adcs[j:j+16] - adcs[i]
+                start = adcs[i] - self.adcs[0]
+                offsets = numpy.arange(ends[-1] + 1)
+                slopes = (temps[j:j+16] - temps[i]) / ends.astype(float)
+                err = numpy.abs(temps[i] + numpy.outer(slopes, offsets) - self.temps[start:start+len(offsets)])
+                err *= self.weights[start:start+len(offsets)]
+                # Only the ADC readings up to the end of each segment
+                err[offsets > ends[:, None]] = 0
+                errors[i, j:j+16] = err.max(axis=1)
+                if (errors[i, j:j+16] > bound).all():
+                    break
+        return errors
+
+    def max_error(self, table):
+        "Max. weighted error of table"
+        return (numpy.abs(self.curve(table)) * self.weights).max()
+
+def fewest_rows(errors, max_error):
+    "Indices of the fewest candidate rows with no segment error above max_error, None if impossible"
+    n = len(errors)
+    count = numpy.empty(n, dtype=int)
+    count.fill(n + 1)
+    count[0] = 1
+    prev = numpy.zeros(n, dtype=int)
+    for i in range(n - 1):
+        reach = numpy.flatnonzero(errors[i, i+1:] <= max_error) + i + 1
+        better = reach[count[reach] > count[i] + 1]
+        count[better] = count[i] + 1
+        prev[better] = i
+    if count[-1] > n:
+        return None
+    rows = [n - 1]
+    while rows[-1]:
+        rows.append(prev[rows[-1]])
+    return rows[::-1]
+
+def optimal_rows(errors, num_temps):
+    "Indices of at most num_temps candidate rows with the min. max. segment error"
+    bounds = numpy.unique(errors[numpy.isfinite(errors)])
+    lo = 0
+    hi = len(bounds) - 1
+    while lo < hi:
+        mid = (lo + hi) / 2
+        rows = fewest_rows(errors, bounds[mid])
+        if rows != None and len(rows) <= num_temps:
+            hi = mid
+        else:
+            lo = mid + 1
+    return fewest_rows(errors, bounds[lo])
+
+def uniform_table(t, min_temp, max_temp, num_temps):
+    "The table with num_temps rows at uniform temperature steps"
+    tmp = (min_temp - max_temp) / (num_temps-1)
+    temps = range(max_temp, min_temp + tmp, tmp);
+    return [(int(t.adc(temp)), temp) for temp in temps]
+
+def optimised_table(t, model, min_temp, max_temp, num_temps, max_error):
+    "The table with the breakpoints chosen for the min. error or the fewest rows"
+    temps = numpy.arange(max_temp, min_temp - 1, -1)
+    adcs = numpy.rint(t.adc_array(temps)).astype(int)
+    # Keep one temperature per ADC reading, the table needs increasing readings
+    adcs, first = numpy.unique(adcs, return_index=True)
+    temps = temps[first]
+    if max_error != None:
+        bound = max_error
+    else:
+        # The candidates next to the uniform steps give an upper bound
+        steps = numpy.linspace(0, len(temps) - 1, num_temps).round().astype(int)
+        bound = model.max_error(zip(adcs[steps], temps[steps]))
+    errors = model.segment_errors(adcs, temps, bound)
+    if max_error != None:
+        rows = fewest_rows(errors, max_error)
+        if rows == None:
+            sys.stderr.write("Max. error %s not possible with whole degrees\n" % max_error)
+            sys.exit(1)
+    else:
+        rows = optimal_rows(errors, num_temps)
+    return [(int(adcs[i]), int(temps[i])) for i in rows]
+
+def print_error_curve(model, min_temp, max_temp, tables):
+    "Print the max. error per 10C of the tables to stderr"
+    errors = [numpy.abs(model.curve(table)) for (name, table) in tables]
+    sys.stderr.write("  temp  " + "".join(["%12s" % name for (name, table) in tables]) + "\n")
+    for lo in range(min_temp, max_temp, 10):
+        band = (model.temps >= lo) & (model.temps < lo + 10)
+        if band.any():
+            sys.stderr.write("%3d-%3d " % (lo, lo + 10) + "".join(["%12.3f" % err[band].max() for err in errors]) + "\n")
+
 def main(argv):
 
     rp = 4700;
@@ -79,9 +224,14 @@ def main(argv):
     t3 = 250;
     r3 = 226.15;
     num_temps = int(36);
+    max_error = None
+    print_range = (180, 260)
+    outside_weight = 0.25
+    uniform = numpy == None
+    error_curve = False
 
     try:
-        opts, args = getopt.getopt(argv, "h", ["help", "rp=", "t1=", "t2=", "t3=", "num-temps="])
+        opts, args = getopt.getopt(argv, "h", ["help", "rp=", "t1=", "t2=", "t3=", "num-temps=", "max-error=", "print-range=", "outside-weight=", "uniform", "error-curve"])
     except getopt.GetoptError:
         usage()
         sys.exit(2)
@@ -106,29 +256,59 @@ def main(argv):
             r3 = float( arg[1])
         elif opt == "--num-temps":
             num_temps =  int(arg)
+        elif opt == "--max-error":
+            max_error = float(arg)
+        elif opt == "--print-range":
+            arg =  arg.split(':')
+            print_range = (float(arg[0]), float(arg[1]))
+        elif opt == "--outside-weight":
+            outside_weight = float(arg)
+        elif opt == "--uniform":
+            uniform = True
+        elif opt == "--error-curve":
+            error_curve = True
+
+    if numpy == None and (max_error != None or error_curve):
+        sys.stderr.write("--max-error and --error-curve need numpy\n")
+        sys.exit(2)
 
-    max_adc = (1024 * 16) - 1
     min_temp = 0
     max_temp = 350
-    increment = int(max_adc/(num_temps-1));
 
     t = Thermistor(rp, t1, r1, t2, r2, t3, r3)
-    tmp = (min_temp - max_temp) / (num_temps-1)
-    print tmp
-    temps = range(max_temp, min_temp + tmp, tmp);
+
+    if uniform:
+        table = uniform_table(t, min_temp, max_temp, num_temps)
+    else:
+        model = ErrorModel(t, min_temp, max_temp, print_range, outside_weight)
+        table = optimised_table(t, model, min_temp, max_temp, num_temps, max_error)
 
     print "// Thermistor lookup table for Marlin"
     print "// ./createTemperatureLookup.py --rp=%s --t1=%s:%s --t2=%s:%s --t3=%s:%s --num-temps=%s" % (rp, t1, r1, t2, r2, t3, r3, num_temps)
-    print "#define NUMTEMPS %s" % (len(temps))
+    if not uniform:
+        print "// Breakpoints optimised for %g-%g C, outside weight %s" % (print_range[0], print_range[1], outside_weight)
+
+    if numpy != None:
+        model = ErrorModel(t, min_temp, max_temp, print_range, outside_weight)
+        err = numpy.abs(model.curve(table))
+        print "// Max. interpolation error: %.3f C (%g-%g C), %.3f C (%s-%s C)" % (
+            err[model.inside].max(), print_range[0], print_range[1], err.max(), min_temp, max_temp)
+        if error_curve:
+            tables = [("uniform", uniform_table(t, min_temp, max_temp, len(table)))]
+            if not uniform:
+                tables.append(("optimised", table))
+            print_error_curve(model, min_temp, max_temp, tables)
+
+    print "#define NUMTEMPS %s" % (len(table))
     print "short temptable[NUMTEMPS][2] = {"
 
     counter = 0
-    for temp in temps:
+    for (adc, temp) in table:
         counter = counter +1
-        if counter == len(temps):
-            print "   {%s, %s}" % (int(t.adc(temp)), temp)
+        if counter == len(table):
+            print "   {%s, %s}" % (adc, temp)
         else:
-            print "   {%s, %s}," % (int(t.adc(temp)), temp)
+            print "   {%s, %s}," % (adc, temp)
     print "};"
 
 def usage():
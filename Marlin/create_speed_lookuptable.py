@@ -2,7 +2,12 @@
 
 """ Generate the stepper delay lookup table for Marlin firmware. """
 
-import argparse
+import argparse, sys
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 __author__ = "Ben Gamari <bgamari@gmail.com>"
 __copyright__ = "Copyright 2012, Ben Gamari"
@@ -11,40 +16,166 @@ __license__ = "GPL"
 parser = argparse.ArgumentParser(description=__doc__)
 parser.add_argument('-f', '--cpu-freq', type=int, default=16, help='CPU clockrate in MHz (default=16)')
 parser.add_argument('-d', '--divider', type=int, default=8, help='Timer/counter pre-scale divider (default=8)')
+parser.add_argument('--fast-shift', type=int, default=8, help='Step rate width of the fast table entries as power of 2, max. 8 (default=8)')
+parser.add_argument('--slow-shift', type=int, default=3, help='Step rate width of the slow table entries as power of 2 (default=3)')
+parser.add_argument('--trim', action='store_true', help='Only emit the fast table entries reachable up to --max-rate')
+parser.add_argument('--max-rate', type=int, default=40000, help='MAX_STEP_FREQUENCY of the firmware in steps/s (default=40000)')
+parser.add_argument('--high-rate', type=int, default=5000, help='Step rates from here on are reported separately (default=5000)')
+parser.add_argument('-r', '--report', action='store_true', help='Print the timer period error of this and alternative layouts to stderr (needs numpy)')
 args = parser.parse_args()
 
 cpu_freq = args.cpu_freq * 1000000
 timer_freq = cpu_freq / args.divider
 
+# Step rates below this are clamped (F_CPU/500000), the tables
+# start at this rate
+offset = args.cpu_freq * 2
+
+# The slow table covers the step rates up to 8*256, the fast
+# table the step rates from there on, see calc_timer() in stepper.cpp
+slow_range = 8 * 256
+
+# Timer periods and the differences to the next entry of the table
+# with 'entries' entries 2**shift step rates apart
+def table(timer_freq, offset, shift, entries):
+    a = [ timer_freq / ((i << shift) + offset) for i in range(entries + 1) ]
+    b = [ a[i] - a[i+1] for i in range(entries) ]
+    if entries == 256:
+        # Like the tables in speed_lookuptable.h
+        b[-1] = b[-2]
+    return (a[:entries], b)
+
+# Step rate passed to the table lookup and number of steps per
+# interrupt for the requested step rates, like calc_timer()
+def lookup_rate(rates, max_rate, offset):
+    rates = numpy.minimum(rates, max_rate)
+    loops = numpy.where(rates > 20000, 4, numpy.where(rates > 10000, 2, 1))
+    step_rate = numpy.where(rates > 20000, (rates >> 2) & 0x3fff, numpy.where(rates > 10000, (rates >> 1) & 0x7fff, rates))
+    return (numpy.maximum(step_rate, offset) - offset, loops)
+
+# Number of fast table entries reachable up to 'max_rate'
+def fast_entries(max_rate, offset, shift):
+    (step_rate, loops) = lookup_rate(numpy.arange(max_rate + 1), max_rate, offset)
+    return int(step_rate.max() >> shift) + 1
+
+# The timer periods of calc_timer() for the requested step rates
+def firmware_timer(rates, layout):
+    (timer_freq, offset, fast_shift, fast, slow_shift, slow, max_rate) = layout
+    (step_rate, loops) = lookup_rate(rates, max_rate, offset)
+
+    timer = numpy.empty_like(step_rate)
+
+    # The fast table, the fraction is multiplied with rounding
+    # (MultiU16X8toH16)
+    sel = step_rate >= slow_range
+    idx = numpy.minimum(step_rate[sel] >> fast_shift, len(fast[0]) - 1)
+    frac = step_rate[sel] & ((1 << fast_shift) - 1)
+    gain = numpy.array(fast[1])[idx]
+    timer[sel] = numpy.array(fast[0])[idx] - ((frac * gain + (1 << (fast_shift - 1))) >> fast_shift)
+
+    # The slow table, the fraction is multiplied without rounding
+    sel = ~sel
+    idx = step_rate[sel] >> slow_shift
+    frac = step_rate[sel] & ((1 << slow_shift) - 1)
+    timer[sel] = numpy.array(slow[0])[idx] - ((numpy.array(slow[1])[idx] * frac) >> slow_shift)
+
+    return (numpy.maximum(timer, 100), loops)
+
+# The timer periods without a table, rounded to whole timer ticks
+def exact_timer(rates, layout):
+    (timer_freq, offset, max_rate) = (layout[0], layout[1], layout[-1])
+    (step_rate, loops) = lookup_rate(rates, max_rate, offset)
+    timer = numpy.rint(timer_freq / (step_rate + offset).astype(float)).astype(int)
+    return (numpy.maximum(timer, 100), loops)
+
+# Relative error of the step rates produced with the timer
+# periods 'timer' against the requested step rates 'rates'
+def rate_errors(rates, layout, timer, loops):
+    actual = layout[0] * loops / timer.astype(float)
+    return actual / numpy.minimum(rates, layout[-1]) - 1
+
+def make_layout(cpu_freq, divider, fast_shift, slow_shift, trim, max_rate):
+    timer_freq = cpu_freq * 1000000 / divider
+    offset = cpu_freq * 2
+    entries = 256
+    if trim:
+        entries = fast_entries(max_rate, offset, fast_shift)
+    fast = table(timer_freq, offset, fast_shift, entries)
+    slow = table(timer_freq, offset, slow_shift, slow_range >> slow_shift)
+    return (timer_freq, offset, fast_shift, fast, slow_shift, slow, max_rate)
+
+def print_report(args):
+    sys.stderr.write("Step rate error for step rates up to %d steps/s (high: from %d steps/s):\n" % (args.max_rate, args.high_rate))
+    sys.stderr.write("(whole ticks: the error of the exact periods rounded to whole timer ticks)\n")
+    sys.stderr.write("%-5s %-4s %-5s %-5s %-5s %7s %10s %10s %10s %10s %12s\n" % (
+        "MHz", "div", "fast", "slow", "trim", "bytes", "max", "mean", "high max", "high mean", "whole ticks"))
+
+    layouts = [(args.cpu_freq, args.divider, args.fast_shift, args.slow_shift, args.trim)]
+    for cpu in (16, 20):
+        for divider in (8, 64):
+            for fast_shift in (6, 7, 8):
+                for slow_shift in (2, 3):
+                    for trim in (False, True):
+                        layout = (cpu, divider, fast_shift, slow_shift, trim)
+                        if divider != 8 and (fast_shift, slow_shift, trim) != (8, 3, False):
+                            # Only the default layout for the other
+                            # dividers, the timer resolution dominates
+                            continue
+                        if layout not in layouts and (trim or fast_shift == 8):
+                            layouts.append(layout)
+
+    for (cpu, divider, fast_shift, slow_shift, trim) in layouts:
+        layout = make_layout(cpu, divider, fast_shift, slow_shift, trim, args.max_rate)
+        (fast, slow) = (layout[3], layout[5])
+        if max(fast[0] + slow[0]) > 0xffff:
+            # Periods of the low step rates don't fit the 16 bit timer
+            continue
+        rates = numpy.arange(cpu * 2, args.max_rate + 1)
+        err = numpy.abs(rate_errors(rates, layout, *firmware_timer(rates, layout)))
+        errHigh = err[rates >= args.high_rate]
+        errTicks = numpy.abs(rate_errors(rates, layout, *exact_timer(rates, layout)))
+        sys.stderr.write("%-5d %-4d %-5d %-5d %-5s %7d %9.4f%% %9.4f%% %9.4f%% %9.4f%% %11.4f%%%s\n" % (
+            cpu, divider, 1 << fast_shift, 1 << slow_shift, ("no", "yes")[trim], (len(fast[0]) + len(slow[0])) * 4,
+            err.max() * 100, err.mean() * 100, errHigh.max() * 100, errHigh.mean() * 100, errTicks.max() * 100,
+            ("", " (this table)")[(cpu, divider, fast_shift, slow_shift, trim) == layouts[0]]))
+
+if args.fast_shift > 8 or args.slow_shift < 1:
+    parser.error("--fast-shift must be at most 8, --slow-shift at least 1")
+
+if args.report:
+    if numpy == None:
+        parser.error("--report needs numpy")
+    print_report(args)
+
+fast_count = 256
+if args.trim:
+    if numpy == None:
+        parser.error("--trim needs numpy")
+    fast_count = fast_entries(args.max_rate, offset, args.fast_shift)
+
 print "#ifndef SPEED_LOOKUPTABLE_H"
 print "#define SPEED_LOOKUPTABLE_H"
 print
 print '#include "Marlin.h"'
 print
 
-print "const uint16_t speed_lookuptable_fast[256][2] PROGMEM = {"
-a = [ timer_freq / ((i*256)+(args.cpu_freq*2)) for i in range(256) ]
-b = [ a[i] - a[i+1] for i in range(255) ]
-b.append(b[-1])
-for i in range(32):
-    print "  ",
-    for j in range(8):
-        print "{%d, %d}," % (a[8*i+j], b[8*i+j]),
+if args.fast_shift != 8 or args.slow_shift != 3 or args.trim:
+    print "// Fast table entries %d steps/s apart, slow table entries %d steps/s apart," % (1 << args.fast_shift, 1 << args.slow_shift)
+    print "// calc_timer() in stepper.cpp has to use the same layout."
     print
-print "};"
-print
 
-print "const uint16_t speed_lookuptable_slow[256][2] PROGMEM = {"
-a = [ timer_freq / ((i*8)+(args.cpu_freq*2)) for i in range(256) ]
-b = [ a[i] - a[i+1] for i in range(255) ]
-b.append(b[-1])
-for i in range(32):
-    print "  ",
-    for j in range(8):
-        print "{%d, %d}," % (a[8*i+j], b[8*i+j]),
+def print_table(name, table):
+    (a, b) = table
+    print "const uint16_t %s[%d][2] PROGMEM = {" % (name, len(a))
+    for i in range(0, len(a), 8):
+        print "  ",
+        for j in range(i, min(i + 8, len(a))):
+            print "{%d, %d}," % (a[j], b[j]),
+        print
+    print "};"
     print
-print "};"
-print
 
-print "#endif"
+print_table("speed_lookuptable_fast", table(timer_freq, offset, args.fast_shift, fast_count))
+print_table("speed_lookuptable_slow", table(timer_freq, offset, args.slow_shift, slow_range >> args.slow_shift))
 
+print "#endif"
@@ -18,6 +18,11 @@ typedef void (*sim_ms_callback_t)();
 void sim_check_interrupts();
 void sim_setup(sim_ms_callback_t callback);
 
+// Simulated time in ms
+unsigned int sim_millis();
+// Speed of the simulated time relative to real time, see sim_millis()
+extern int sim_speed;
+
 class AVRRegistor
 {
 private:
@@ -1,8 +1,12 @@
 #include <avr/io.h>
 #include <avr/interrupt.h>
 #include <stdio.h>
-#include <SDL/SDL.h>
 #include <assert.h>
+#ifdef SIM_HEADLESS
+#include <sys/time.h>
+#else
+#include <SDL/SDL.h>
+#endif
 
 #include "../../Marlin/Configuration.h"
 #include "../../Marlin/pins.h"
@@ -26,8 +30,39 @@ extern void TIMER0_OVF_vect();
 extern void TIMER0_COMPB_vect();
 extern void TIMER1_COMPA_vect();
 extern void USART0_RX_vect();
+#ifdef SIM_HEADLESS
+extern int sim_rx_room();
+#endif
+
+int sim_speed = 1;
+
+#ifdef SIM_HEADLESS
+// Number of chars the serial line receives per ms, 250000 baud
+#define SIM_RX_CHARS_PER_MS 25
+#else
+#define SIM_RX_CHARS_PER_MS 1
+#endif
+
+unsigned int sim_millis()
+{
+#ifdef SIM_HEADLESS
+    // No SDL timer, real time scaled by sim_speed
+    static double startTime = -1;
 
-unsigned int prevTicks = SDL_GetTicks();
+    struct timeval tv;
+    gettimeofday(&tv, NULL);
+
+    double now = tv.tv_sec * 1000.0 + tv.tv_usec / 1000.0;
+    if (startTime < 0)
+        startTime = now;
+
+    return (unsigned int)((now - startTime) * sim_speed);
+#else
+    return SDL_GetTicks();
+#endif
+}
+
+unsigned int prevTicks = sim_millis();
 unsigned int twiIntStart = 0;
 
 //After an interrupt we need to set the interrupt flag again, but do this without calling sim_check_interrupts so the interrupt does not fire recursively
@@ -35,7 +70,7 @@ unsigned int twiIntStart = 0;
 
 void sim_check_interrupts()
 {
-    unsigned int ticks = SDL_GetTicks();
+    unsigned int ticks = sim_millis();
     int tickDiff = ticks - prevTicks;
     prevTicks = ticks;
 
@@ -47,8 +82,8 @@ void sim_check_interrupts()
     {
         //Relay the TWI interrupt by 25ms one time till it gets disabled again. This fakes the LCD refresh rate.
         if (twiIntStart == 0)
-            twiIntStart = SDL_GetTicks();
-        if (SDL_GetTicks() - twiIntStart > 25)
+            twiIntStart = sim_millis();
+        if (sim_millis() - twiIntStart > 25)
         {
             cli();
             TWI_vect();
@@ -106,10 +141,30 @@ void sim_check_interrupts()
             TCNT1 = ticks;
         }
 
-        uint8_t ucsr0a = UCSR0A;
+        // Check for serial rx interrupt, one interrupt per received char
+#ifdef SIM_HEADLESS
+        // The serial line runs in real time, not in the simulated time
+        // sped up by sim_speed. Like a line with flow control it never
+        // delivers more chars than the firmware's rx buffer takes: a
+        // loop of the simulated firmware (e.g. writing the SD card) is
+        // slower than on the printer, the bulk store frames are longer
+        // than the rx buffer and would overrun it.
+        static int rxCredit = 0;
+        rxCredit += SIM_RX_CHARS_PER_MS * tickDiff;
+        int rxChars = rxCredit / sim_speed;
+        rxCredit -= rxChars * sim_speed;
+        if (rxChars > sim_rx_room())
+            rxChars = sim_rx_room();
+#else
+        int rxChars = SIM_RX_CHARS_PER_MS * tickDiff;
+#endif
+        for (int n=0; n<rxChars; n++) {
+
+            uint8_t ucsr0a = UCSR0A;
+
+            if (!(ucsr0a & _BV(RXCIE0)) || !(ucsr0a & _BV(RXC0)))
+                break;
 
-        // Check for serial rx interrupt
-        if ((ucsr0a & _BV(RXCIE0)) && (ucsr0a & _BV(RXC0))) {
             // printf("rx int enabled\n");
             USART0_RX_vect();
         }
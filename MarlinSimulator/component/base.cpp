@@ -1,9 +1,8 @@
+#ifndef SIM_HEADLESS
 #include <SDL/SDL.h>
+#endif
 #include "base.h"
 
-#define DRAW_SCALE 3
-
-extern SDL_Surface *screen;
 // std::vector<simBaseComponent*> simComponentList;
 
 std::vector<simBaseComponent*> &simComponentList() {
@@ -12,6 +11,21 @@ std::vector<simBaseComponent*> &simComponentList() {
     return _simComponentList;
 }
 
+#ifdef SIM_HEADLESS
+
+// No display in the headless simulator
+void drawRect(const int x, const int y, const int w, const int h, uint32_t color) {}
+void drawString(const int x, const int y, const char* str, uint32_t color) {}
+void drawChar(const int x, const int y, const char c, uint32_t color) {}
+void drawStringSmall(const int x, const int y, const char* str, uint32_t color) {}
+void drawCharSmall(const int x, const int y, const char c, uint32_t color) {}
+
+#else
+
+#define DRAW_SCALE 3
+
+extern SDL_Surface *screen;
+
 static const uint8_t lcd_font[] = {
     // font data
     0x00, 0x00, 0x00, 0x00, 0x00,// '\x00'
@@ -213,3 +227,5 @@ void drawRect(const int x, const int y, const int w, const int h, uint32_t color
     if (rect.h == 0) rect.h = 1;
     SDL_FillRect(screen, &rect, color);
 }
+
+#endif//SIM_HEADLESS
@@ -13,6 +13,7 @@ sdcardSimulation::sdcardSimulation(const char* basePath, int errorRate)
 
     sd_state = 0;
     sd_buffer_pos = 0;
+    blocksWritten = 0;
 }
 
 sdcardSimulation::~sdcardSimulation()
@@ -66,6 +67,13 @@ FILE* simFile;
 void sdcardSimulation::read_sd_block(int nr)
 {
     memset(sd_buffer, 0, 512);
+
+    if (writtenBlocks.count(nr))
+    {
+        memcpy(sd_buffer, &writtenBlocks[nr][0], 512);
+        nr = -1;
+    }
+
     switch(nr)
     {
     case 0x000:{//MBR
@@ -92,12 +100,16 @@ void sdcardSimulation::read_sd_block(int nr)
             fat32[n] = n + 1;
         fat32[127] = 0X0FFFFFF8;
         }break;
+    case -1://Written block
+        break;
     default:
         if (nr >= 0x401 && nr < 0x500) //root directory: dir_t
         {
             dir_t* dir = (dir_t*)sd_buffer;
             
             DIR* dh = opendir(basePath);
+            if (dh == NULL)
+                return;
             struct dirent *entry;
             int idx = 0;
             int reqIdx = nr - 0x401;
@@ -110,7 +122,10 @@ void sdcardSimulation::read_sd_block(int nr)
                 idx++;
             }
             if (entry == NULL)
+            {
+                closedir(dh);
                 return;
+            }
 
             const char* namePtr = entry->d_name;
             
@@ -140,9 +155,12 @@ void sdcardSimulation::read_sd_block(int nr)
             if (simFile == NULL)
                 // simFile = fopen("c:/models/Box_20x20x10.gcode", "rb");
                 simFile = fopen("/tmp/pcode", "rb");
-            fseek(simFile, 0, SEEK_END);
-            dir->fileSize = ftell(simFile);
-            fseek(simFile, 0, SEEK_SET);
+            if (simFile)
+            {
+                fseek(simFile, 0, SEEK_END);
+                dir->fileSize = ftell(simFile);
+                fseek(simFile, 0, SEEK_SET);
+            }
             
             dir++;
             fatNr++;
@@ -158,18 +176,37 @@ void sdcardSimulation::read_sd_block(int nr)
                 fatNr++;
             }
         }
-        else if (nr >= 4 && nr < 0x400)
+        else if (nr >= 3 && nr < 0x400)
         {
-            //FAT32 tables for file, just link to the next block
+            //FAT32 tables for file, just link to the next block. The
+            //clusters after the file are free, for files written by
+            //the firmware.
+            uint32_t lastCluster = 255;
+            if (simFile)
+            {
+                fseek(simFile, 0, SEEK_END);
+                lastCluster += (ftell(simFile) + 511) / 512;
+            }
             uint32_t* fat32 = (uint32_t*)sd_buffer;
             for(uint8_t n=0;n<128;n++)
-                fat32[n] = (nr-2) * 128 + n + 1;
+            {
+                uint32_t cluster = (nr-2) * 128 + n;
+                if (cluster < lastCluster)
+                    fat32[n] = cluster + 1;
+                else if (cluster == lastCluster)
+                    fat32[n] = 0X0FFFFFF8;
+                else
+                    fat32[n] = 0;
+            }
         }
         else if (nr >= 0x500 && nr < 0x20000)
         {
             //Actual data blocks
-            fseek(simFile, (nr - 0x501) * 512, SEEK_SET);
-            fread(sd_buffer, 512, 1, simFile);
+            if (simFile)
+            {
+                fseek(simFile, (nr - 0x501) * 512, SEEK_SET);
+                fread(sd_buffer, 512, 1, simFile);
+            }
         }else{
             memset(sd_buffer, 0xFF, 512);
             printf("Read SD?: %x\n", nr);
@@ -177,10 +214,6 @@ void sdcardSimulation::read_sd_block(int nr)
         }
         break;
     }
-    
-    uint16_t crc = CRC_CCITT(sd_buffer, 512);
-    sd_buffer[512] = crc >> 8;
-    sd_buffer[513] = crc;
 }
 
 void sdcardSimulation::ISP_SPDR_callback(uint8_t oldValue, uint8_t& newValue)
@@ -223,9 +256,24 @@ void sdcardSimulation::ISP_SPDR_callback(uint8_t oldValue, uint8_t& newValue)
             newValue = 0x00;//R1_READY_STATE
             sd_read_block_nr = (sd_buffer[1] << 24) | (sd_buffer[2] << 16) | (sd_buffer[3] << 8) | (sd_buffer[4] << 0);
             read_sd_block(sd_read_block_nr >> 9);
+            {
+                uint16_t crc = CRC_CCITT(sd_buffer, 512);
+                sd_buffer[512] = crc >> 8;
+                sd_buffer[513] = crc;
+            }
             sd_state = 10;
             sd_buffer_pos = 0;
             break;
+        case 0x0D://CMD13 - SEND_STATUS
+            newValue = 0x00;//R1_READY_STATE, second byte follows
+            sd_state = 30;
+            break;
+        case 0x18://CMD24 - WRITE_BLOCK
+            newValue = 0x00;//R1_READY_STATE
+            sd_write_block_nr = (sd_buffer[1] << 24) | (sd_buffer[2] << 16) | (sd_buffer[3] << 8) | (sd_buffer[4] << 0);
+            sd_state = 20;
+            sd_buffer_pos = 0;
+            break;
         case 0x37://CMD55 - APP_CMD
             sd_state = 2;
             break;
@@ -248,6 +296,28 @@ void sdcardSimulation::ISP_SPDR_callback(uint8_t oldValue, uint8_t& newValue)
             break;
         }
         break;
+    case 20://WRITE BLOCK, wait for the data token
+        if (newValue == 0xFE)//DATA_START_BLOCK
+            sd_state = 21;
+        newValue = 0xFF;
+        break;
+    case 21://WRITE BLOCK, 512 bytes data and 2 bytes crc
+        sd_buffer[sd_buffer_pos++] = newValue;
+        newValue = 0xFF;
+        if (sd_buffer_pos == 512 + 2)
+            sd_state = 22;
+        break;
+    case 22://WRITE BLOCK, data response
+        writtenBlocks[sd_write_block_nr >> 9].assign(sd_buffer, sd_buffer + 512);
+        blocksWritten++;
+        newValue = 0x05;//DATA_RES_ACCEPTED
+        sd_state = 0;
+        sd_buffer_pos = 0;
+        break;
+    case 30://Second byte of the R2 status
+        newValue = 0x00;
+        sd_state = 0;
+        break;
     case 10://READ BLOCK
         if (sd_buffer_pos == 0)
             newValue = 0xFE;//DATA_START_BLOCK
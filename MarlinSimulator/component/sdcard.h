@@ -3,6 +3,9 @@
 
 #include "base.h"
 
+#include <map>
+#include <vector>
+
 class sdcardSimulation : public simBaseComponent
 {
 private:
@@ -18,7 +21,13 @@ public:
     uint8_t sd_buffer[1024];
     int sd_buffer_pos;
     int sd_read_block_nr;
+    int sd_write_block_nr;
     int errorRate;
+
+    // Blocks written by the firmware, they overlay the
+    // simulated FAT file system.
+    std::map<int, std::vector<uint8_t> > writtenBlocks;
+    unsigned long blocksWritten;
 };
 
 #endif//SDCARD_SIM_H
@@ -14,6 +14,8 @@
 */
 #include <unistd.h>
 #include <fcntl.h>
+#include <poll.h>
+#include <termios.h>
 
 
 #include "serial.h"
@@ -33,6 +35,10 @@ serialSim::serialSim()
     recvPos = 0;
     memset(recvBuffer, '\0', sizeof(recvBuffer));
 
+    rxPos = rxLen = 0;
+    rxBytes = 0;
+    ackCount = 0;
+
     ptty = open("/dev/ptmx", O_RDWR | O_NOCTTY | O_NONBLOCK);
     if (ptty == -1) {
         printf("error opening /dev/ptmx\n");
@@ -45,8 +51,73 @@ serialSim::serialSim()
     const char* pts_name = ptsname(ptty);
     assert(pts_name);
 
+#ifdef SIM_HEADLESS
+    printf("ptsname: %s\n", pts_name);
+    fflush(stdout);
+
+    waitForHost(pts_name);
+#else
     printf("ptsname: %s, sleeping 10 seconds ...\n", pts_name);
     sleep(10);
+#endif
+}
+
+// Wait until the host has opened the pseudo tty, the master side reports
+// a hangup as long as the slave side is not open (after it has been
+// opened once).
+void serialSim::waitForHost(const char* pts_name)
+{
+    // Open the slave side once and switch off the echo, else the
+    // output of the firmware is echoed back as input.
+    int fd = open(pts_name, O_RDWR | O_NOCTTY);
+    if (fd >= 0) {
+        struct termios tio;
+        tcgetattr(fd, &tio);
+        cfmakeraw(&tio);
+        tcsetattr(fd, TCSANOW, &tio);
+        close(fd);
+    }
+
+    struct pollfd pfd;
+
+    pfd.fd = ptty;
+    pfd.events = POLLIN;
+
+    while (true) {
+
+        pfd.revents = 0;
+        poll(&pfd, 1, 0);
+
+        if (!(pfd.revents & POLLHUP))
+            break;
+
+        usleep(10000);
+    }
+
+    // Give the host time to setup the line, like the reset of
+    // the printer when the line is opened.
+    usleep(500000);
+
+    printf("host connected\n");
+    fflush(stdout);
+}
+
+// Read the next char from the pseudo tty, returns false if there is none
+bool serialSim::readChar(uint8_t *c)
+{
+    if (rxPos == rxLen) {
+
+        int n = read(ptty, rxBuffer, sizeof(rxBuffer));
+        if (n <= 0)
+            return false;
+
+        rxPos = 0;
+        rxLen = n;
+        rxBytes += n;
+    }
+
+    *c = rxBuffer[rxPos++];
+    return true;
 }
 
 serialSim::~serialSim()
@@ -63,7 +134,7 @@ void serialSim::UART_UCSR0A_callback(uint8_t oldValue, uint8_t& newValue)
 uint8_t  serialSim::UART_UCSR0A_read_callback(uint8_t& value)
 {
 
-   if (((value & _BV(RXC0)) == 0) && (ptty >= 0) && (read(ptty, &rxChar, 1) == 1)) {
+   if (((value & _BV(RXC0)) == 0) && (ptty >= 0) && readChar(&rxChar)) {
 
         // printf("UART_UCSR0A_read_callback read: %c\n", rxChar);
         value |= _BV(RXC0);
@@ -89,6 +160,9 @@ void serialSim::UART_UDR0_callback(uint8_t oldValue, uint8_t& newValue)
         }
     }
 
+    if (newValue == 0x6)
+        ackCount++;
+
     write(ptty, &newValue, 1);
 }
 
@@ -99,7 +173,7 @@ uint8_t  serialSim::UART_UDR0_read_callback(uint8_t& value)
 
     uint8_t c = rxChar;
 
-    if (read(ptty, &rxChar, 1) <= 0) {
+    if (!readChar(&rxChar)) {
         UCSR0A &= ~_BV(RXC0);
     }
 
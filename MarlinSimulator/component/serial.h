@@ -12,6 +12,10 @@ public:
     
     virtual void draw(int x, int y);
 
+    // Statistics: bytes received and ACKs sent
+    unsigned long rxBytes;
+    unsigned long ackCount;
+
 private:
     int recvLine, recvPos;
     char recvBuffer[SERIAL_LINE_COUNT][80];
@@ -20,6 +24,12 @@ private:
     int ptty;
     // Character received from serial pseudo tty 
     uint8_t rxChar;
+    // Chars read from the pseudo tty but not yet received
+    uint8_t rxBuffer[256];
+    int rxPos, rxLen;
+
+    bool readChar(uint8_t *c);
+    void waitForHost(const char* pts_name);
 
     void UART_UCSR0A_callback(uint8_t oldValue, uint8_t& newValue);
     void UART_UDR0_callback(uint8_t oldValue, uint8_t& newValue);
@@ -1,5 +1,7 @@
 
+#ifndef SIM_HEADLESS
 #include <SDL/SDL.h>
+#endif
 #include <Arduino.h>
 
 #include <avr/io.h>
@@ -18,7 +20,9 @@
 #include "../Marlin/temperature.h"
 #include "../Marlin/stepper.h"
 
+#ifndef SIM_HEADLESS
 SDL_Surface *screen;
+#endif
 
 extern int8_t lcd_lib_encoder_pos_interrupt;
 extern int8_t encoderDiff;
@@ -28,6 +32,8 @@ bool cardInserted = true;
 // bool cardInserted = false;
 int stoppedValue;
 
+#ifndef SIM_HEADLESS
+
 void setupGui()
 {
     if ( SDL_Init(SDL_INIT_VIDEO) < 0 ) 
@@ -163,6 +169,83 @@ void guiUpdate()
     SDL_Flip(screen);
 }
 
+#else//SIM_HEADLESS
+
+// Speed of the headless simulator relative to real time,
+// environment variable SIM_SPEED.
+#define HEADLESS_SPEED 10
+
+// Free room in the serial receive buffer of the firmware, the
+// simulated line doesn't deliver more chars than that (see
+// sim_check_interrupts()).
+int sim_rx_room()
+{
+    return RX_BUFFER_SIZE - 1 - MYSERIAL.available();
+}
+
+#if defined(USBStats)
+extern uint32_t usbPackedCommands;
+extern uint32_t usbUnpackedCommands;
+extern uint32_t usbStoredCommands;
+extern uint32_t usbStoredBytes;
+extern uint32_t usbStoredBlocks;
+#endif
+
+// Prints the usb statistics of the firmware once per second (real time)
+// if something was received.
+class statsSim : public simBaseComponent
+{
+private:
+    serialSim* serial;
+    sdcardSimulation* sdcard;
+    unsigned int lastReport;
+    unsigned long lastCommands, lastStored, lastStoredBytes, lastRxBytes;
+public:
+    statsSim(serialSim* serial, sdcardSimulation* sdcard)
+    : serial(serial), sdcard(sdcard), lastReport(0), lastCommands(0), lastStored(0), lastStoredBytes(0), lastRxBytes(0)
+    {
+    }
+    virtual ~statsSim()
+    {
+    }
+
+    virtual void tick()
+    {
+        unsigned int now = sim_millis() / sim_speed;
+        if (now - lastReport < 1000)
+            return;
+
+        float seconds = (now - lastReport) / 1000.0;
+        lastReport = now;
+
+        if (serial->rxBytes == lastRxBytes)
+            return;
+
+#if defined(USBStats)
+        unsigned long commands = usbPackedCommands + usbUnpackedCommands;
+        printf("stats: usb %lu packed, %lu unpacked, %.0f commands/s, stored %lu commands, %lu blocks, %lu bytes, %.0f commands/s, %.0f bytes/s, ",
+            (unsigned long)usbPackedCommands, (unsigned long)usbUnpackedCommands, (commands - lastCommands) / seconds,
+            (unsigned long)usbStoredCommands, (unsigned long)usbStoredBlocks, (unsigned long)usbStoredBytes, (usbStoredCommands - lastStored) / seconds, (usbStoredBytes - lastStoredBytes) / seconds);
+        lastCommands = commands;
+        lastStored = usbStoredCommands;
+        lastStoredBytes = usbStoredBytes;
+#endif
+        printf("rx %lu bytes, %.0f bytes/s, %lu acks, sd %lu blocks written\n",
+            serial->rxBytes, (serial->rxBytes - lastRxBytes) / seconds, serial->ackCount, sdcard->blocksWritten);
+        fflush(stdout);
+
+        lastRxBytes = serial->rxBytes;
+    }
+};
+
+void headlessUpdate()
+{
+    for(unsigned int n=0; n<simComponentList().size(); n++)
+        simComponentList()[n]->tick();
+}
+
+#endif//SIM_HEADLESS
+
 #define PRINTER_DOWN_SCALE 2
 class printerSim : public simBaseComponent
 {
@@ -215,8 +298,16 @@ public:
 
 void sim_setup_main()
 {
+#ifdef SIM_HEADLESS
+    const char* speed = getenv("SIM_SPEED");
+    sim_speed = speed ? atoi(speed) : HEADLESS_SPEED;
+    if (sim_speed < 1)
+        sim_speed = 1;
+    sim_setup(headlessUpdate);
+#else
     setupGui();
     sim_setup(guiUpdate);
+#endif
     adcSim* adc = new adcSim();
     arduinoIOSim* arduinoIO = new arduinoIOSim();
     stepperSim* xStep = new stepperSim(arduinoIO, X_ENABLE_PIN, X_STEP_PIN, X_DIR_PIN, INVERT_X_DIR);
@@ -239,8 +330,14 @@ void sim_setup_main()
     (new heaterSim(HEATER_1_PIN, adc, TEMP_1_PIN))->setDrawPosition(130, 80);
     (new heaterSim(HEATER_BED_PIN, adc, TEMP_BED_PIN, 0.2))->setDrawPosition(130, 90);
     // new sdcardSimulation("c:/models/", 5000);
-    new sdcardSimulation("./models/", 5000);
-    (new serialSim())->setDrawPosition(150, 0);
+#ifdef SIM_HEADLESS
+    // No random sd errors, the headless simulator is used for benchmarks
+    sdcardSimulation* sdcard = new sdcardSimulation("./models/", 0);
+#else
+    sdcardSimulation* sdcard = new sdcardSimulation("./models/", 5000);
+#endif
+    serialSim* serial = new serialSim();
+    serial->setDrawPosition(150, 0);
 #if defined(ULTIBOARD_V2_CONTROLLER) || defined(ENABLE_ULTILCD2)
     i2cSim* i2c = new i2cSim();
     (new displaySDD1309Sim(i2c))->setDrawPosition(0, 0);
@@ -251,4 +348,8 @@ void sim_setup_main()
 #endif
      // Initialize sd card detect signal
      writeInput(SDCARDDETECT, !cardInserted);
+#ifdef SIM_HEADLESS
+     writeInput(SAFETY_TRIGGERED_PIN, stoppedValue);
+     new statsSim(serial, sdcard);
+#endif
 }
@@ -0,0 +1,333 @@
+#!/usr/bin/env python
+
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+
+#
+# Copyright (C) 2014 Erwin Rieger
+#
+
+#
+# Benchmark of the preprocessor and of the usb transfer, without a printer.
+#
+# Preprocessing: each variant of the packer (scalar, bulk, delta, lazy,
+# crc, gcode passes, parallel) is run on a synthetic gcode file and on the
+# given gcode files. Each run is done in a fresh worker process to measure
+# its peak memory.
+#
+# Transfer: the preprocessed gcode is stored with Printer.sendGcode() to a
+# fake printer on a pseudo terminal (see fakeprinter.py) with the given
+# send windows, block sizes (bulk store, see blockstore.py), latencies
+# and error rates.
+#
+# The results are written as json, for example:
+#
+#   benchmark.py -o bench.json file1.gcode file2.gcode
+#
+
+import os, sys, time, json, random, resource, platform, tempfile, argparse, multiprocessing, logging
+
+import ultiprint
+import bulkpack
+import blockstore
+import gcodepass
+from fakeprinter import FakePrinter
+
+# Packer variants: name and Preprocessor options
+variants = (
+    ("scalar", dict(bulk=False)),
+    ("bulk", dict(bulk=True)),
+    ("delta", dict(bulk=True, delta=True)),
+    ("lazy", dict(lazy=True)),
+    ("crc", dict(bulk=True, crc=True)),
+    ("passes", dict(bulk=True, passes=gcodepass.passNames)),
+    )
+
+# Write a synthetic gcode file of about 'lines' lines, layers of
+# extruding moves with some travel moves, retracts, arcs and M-codes,
+# like the output of a slicer.
+def synthGCode(path, lines, seed=1):
+
+    rnd = random.Random(seed)
+
+    f = open(path, "w")
+    f.write(";FLAVOR:UltiGCode\n;Generated by benchmark.py\nM107\nG10\n")
+
+    n = 4
+    layer = 0
+    e = 0.0
+
+    while n < lines:
+
+        layer += 1
+        f.write(";LAYER:%d\nG0 F9000 X%.3f Y%.3f Z%.3f\n" % (layer, rnd.uniform(50, 180), rnd.uniform(50, 180), layer * 0.1))
+        n += 2
+
+        if layer == 2:
+            f.write("M106 S255\n")
+            n += 1
+
+        x = rnd.uniform(50, 180)
+        y = rnd.uniform(50, 180)
+
+        for i in range(rnd.randint(200, 800)):
+
+            if rnd.random() < 0.02:
+                # Travel with retract
+                x = rnd.uniform(50, 180)
+                y = rnd.uniform(50, 180)
+                f.write("G10\nG0 X%.3f Y%.3f\nG11\n" % (x, y))
+                n += 3
+                continue
+
+            x = min(max(x + rnd.uniform(-2, 2), 20), 210)
+            y = min(max(y + rnd.uniform(-2, 2), 20), 210)
+            e += rnd.uniform(0.01, 0.1)
+
+            if rnd.random() < 0.01:
+                f.write("G2 X%.3f Y%.3f I%.3f J%.3f E%.5f\n" % (x, y, rnd.uniform(-5, 5), rnd.uniform(-5, 5), e))
+            elif rnd.random() < 0.05:
+                f.write("G1 F%d X%.3f Y%.3f E%.5f\n" % (rnd.choice((1200, 1800, 2400)), x, y, e))
+            else:
+                f.write("G1 X%.3f Y%.3f E%.5f\n" % (x, y, e))
+
+            n += 1
+
+    f.write("M107\nM104 S0\nM140 S0\n")
+    f.close()
+
+# Peak memory of this process in KB
+def maxRss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+# Run one preprocessing benchmark in a worker process
+def runPreprocess(task):
+
+    (corpus, path, name, options) = task
+
+    # Redirect the progress messages of the preprocessor
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+
+    baseRss = maxRss()
+    start = time.time()
+
+    prep = ultiprint.Preprocessor("store", path, **options)
+    if isinstance(prep.prep, ultiprint.LazyGCode):
+        prep.prep.drain()
+
+    duration = time.time() - start
+
+    sys.stdout.close()
+    sys.stdout = stdout
+
+    f = open(path)
+    lines = sum([1 for line in f])
+    f.close()
+
+    return {
+        "corpus": corpus,
+        "variant": name,
+        "lines": lines,
+        "bytes": prep.origbytes,
+        "packedBytes": prep.packbytes,
+        "seconds": duration,
+        "linesPerSec": lines / duration,
+        "bytesPerSec": prep.origbytes / duration,
+        "baseRssKB": baseRss,
+        "maxRssKB": maxRss(),
+        }
+
+def preprocessWorker(task, queue):
+    queue.put(runPreprocess(task))
+
+def benchPreprocess(corpora, jobs):
+
+    tasks = []
+
+    for (corpus, path) in corpora:
+
+        for (name, options) in variants:
+
+            if name != "scalar" and not bulkpack.available() and options.get("bulk"):
+                # Same as scalar without numpy
+                continue
+
+            tasks.append((corpus, path, name, options))
+
+        if jobs > 1:
+            tasks.append((corpus, path, "jobs%d" % jobs, dict(jobs=jobs)))
+
+    results = []
+
+    for task in tasks:
+
+        # A fresh process for each run, for the peak memory. Not a pool
+        # (daemonic) process, the parallel variant starts worker processes.
+        queue = multiprocessing.Queue()
+        proc = multiprocessing.Process(target=preprocessWorker, args=(task, queue))
+        proc.start()
+        result = queue.get()
+        proc.join()
+
+        print "Preprocess %-12s %-8s %8d lines %8.1f s %10.0f lines/sec %8d KB" % (
+            result["corpus"], result["variant"], result["lines"], result["seconds"], result["linesPerSec"], result["maxRssKB"])
+        sys.stdout.flush()
+
+        results.append(result)
+
+    return results
+
+# Store the preprocessed gcode 'prep' on a fake printer
+def runTransfer(corpus, prep, window, blockSize, latency, errorRate):
+
+    fake = FakePrinter(latency, errorRate)
+    fake.start()
+
+    printer = ultiprint.Printer()
+    printer.initMode("store")
+    printer.window = window
+    printer.blockSize = blockSize
+
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+
+    printer.initSerial(fake.name)
+
+    # Like sendGcode(), but without the monitoring time
+    # after the store has finished.
+    printer.startGcode(prep.prep)
+    ev = ultiprint.DummyEvent()
+    while printer.printing:
+        printer.processCommand(ev)
+
+    printer.close()
+
+    sys.stdout.close()
+    sys.stdout = stdout
+
+    duration = printer.storeDuration
+    report = printer.metrics.report()
+
+    # Without M110, M28 (M624) and M29
+    stored = [cmd for (cmd, response) in prep.prep][2 + prep.crc:-1]
+    if blockSize:
+        # The fake printer has the payloads of the blocks
+        ok = "".join(fake.stored) == "".join(map(blockstore.storedCommand, stored))
+    else:
+        ok = fake.stored == stored
+
+    return {
+        "corpus": corpus,
+        "window": window,
+        "blockSize": blockSize,
+        "latency": latency,
+        "errorRate": errorRate,
+        "commands": len(prep.prep),
+        "bytes": fake.bytes,
+        "sentBytes": printer.sentBytes,
+        "errors": fake.errors,
+        "resends": report["resends"],
+        "latencyMs": report["latencyMs"],
+        "seconds": duration,
+        "gcodesPerSec": len(prep.prep) / duration,
+        "bytesPerSec": fake.bytes / duration,
+        "ok": ok,
+        }
+
+def benchTransfer(corpora, windows, blockSizes, latencies, errorRates, delta, crc):
+
+    results = []
+
+    for (corpus, path) in corpora:
+
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, "w")
+        prep = ultiprint.Preprocessor("store", path, delta=delta, crc=crc)
+        sys.stdout.close()
+        sys.stdout = stdout
+
+        for window in windows:
+            for blockSize in blockSizes:
+                for latency in latencies:
+                    for errorRate in errorRates:
+
+                        result = runTransfer(corpus, prep, window, blockSize, latency, errorRate)
+
+                        print "Transfer   %-12s window %2d blocks %3d latency %.4f errors %.3f: %8.1f s %8.0f gcodes/sec %8.0f bytes/sec, p95 ACK %.2f ms, %d errors%s" % (
+                            corpus, window, blockSize, latency, errorRate, result["seconds"], result["gcodesPerSec"], result["bytesPerSec"], result["latencyMs"]["p95"], result["errors"],
+                            ("", ", FAILED: stored file differs")[not result["ok"]])
+                        sys.stdout.flush()
+
+                        results.append(result)
+
+    return results
+
+#
+# Main
+#
+if __name__ == "__main__":
+
+    def floatList(s):
+        return map(float, s.split(","))
+
+    def intList(s):
+        return map(int, s.split(","))
+
+    parser = argparse.ArgumentParser(description='Benchmark of the UltiPrint preprocessor and usb transfer.')
+    parser.add_argument("gfiles", nargs="*", help="GCode files to benchmark, in addition to the synthetic gcode.")
+    parser.add_argument("-o", dest="output", action="store", type=str, help="Write the results as json to this file, default: stdout.", default=None)
+    parser.add_argument("-n", dest="synthLines", action="store", type=int, help="Number of lines of the synthetic gcode, 0 to disable, default: 200000.", default=200000)
+    parser.add_argument("-j", dest="jobs", action="store", type=int, help="Also benchmark parallel preprocessing with this number of worker processes.", default=1)
+    parser.add_argument("-P", dest="noPreprocess", action="store_true", help="Skip the preprocessing benchmark.")
+    parser.add_argument("-T", dest="noTransfer", action="store_true", help="Skip the transfer benchmark.")
+    parser.add_argument("-w", dest="windows", action="store", type=intList, help="Comma separated list of send windows, default: 1,8.", default=[1, 8])
+    parser.add_argument("-b", dest="blockSizes", action="store", type=intList, help="Comma separated list of block sizes of the bulk store, 0 to send the commands one by one, default: 0.", default=[0])
+    parser.add_argument("-L", dest="latencies", action="store", type=floatList, help="Comma separated list of ACK latencies of the fake printer in seconds, default: 0.", default=[0.0])
+    parser.add_argument("-E", dest="errorRates", action="store", type=floatList, help="Comma separated list of error rates of the fake printer, e.g. 0,0.001, default: 0.", default=[0.0])
+    parser.add_argument("-D", dest="delta", action="store_true", help="Transfer delta encoded moves.")
+    parser.add_argument("-r", dest="crc", action="store_true", help="Transfer packed commands with a CRC-16.")
+
+    args = parser.parse_args()
+
+    # No progress lines and no resend warnings of the
+    # transfers with errors
+    logging.basicConfig(format="%(message)s", level=logging.ERROR)
+
+    corpora = []
+    tmpFile = None
+
+    if args.synthLines:
+        (fd, tmpFile) = tempfile.mkstemp(suffix=".gcode")
+        os.close(fd)
+        synthGCode(tmpFile, args.synthLines)
+        corpora.append(("synthetic", tmpFile))
+
+    for gfile in args.gfiles:
+        corpora.append((os.path.basename(gfile), gfile))
+
+    results = {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "host": platform.node(),
+        "python": platform.python_version(),
+        "numpy": bulkpack.available(),
+        "packerVersion": ultiprint.Preprocessor.packerVersion,
+        "preprocess": [],
+        "transfer": [],
+        }
+
+    try:
+        if not args.noPreprocess:
+            results["preprocess"] = benchPreprocess(corpora, args.jobs)
+
+        if not args.noTransfer:
+            results["transfer"] = benchTransfer(corpora, args.windows, args.blockSizes, args.latencies, args.errorRates, args.delta, args.crc)
+    finally:
+        if tmpFile:
+            os.remove(tmpFile)
+
+    if args.output:
+        f = open(args.output, "w")
+        json.dump(results, f, indent=2, sort_keys=True)
+        f.close()
+    else:
+        print json.dumps(results, indent=2, sort_keys=True)
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+
+#
+# Copyright (C) 2014 Erwin Rieger
+#
+
+#
+# Bulk store: send the commands to store on the SD card in framed blocks.
+#
+# In store mode the firmware writes each command to usb.g without the line
+# number and checksum. Instead of sending the commands one by one, the
+# commands following M28 are converted to this stored form and collected
+# into blocks of up to 'blockSize' bytes. The firmware writes the payload
+# of a block at once and acknowledges the block after it is written:
+#
+# 1 byte:            command key 9
+# 2 bytes:           length of the payload (unsigned short)
+# 2 bytes:           lower 16 bits of the line counter
+# n bytes:           payload, the commands as they are stored in usb.g
+# 2 bytes:           CRC-16 (XModem) of the header and the payload
+#
+# A block counts as one line, so a block with a bad CRC or line number is
+# resent like a single command (Error: ... Last Line: <n>). The commands
+# with a response (M29) are sent unframed with a new line number.
+#
+# The payload is limited by the receive buffer of the firmware, see
+# USB_BLOCK_SIZE in Configuration_adv.h.
+#
+
+import struct, binascii
+
+import gcodefile
+
+# Command key of a block
+blockKey = 9
+
+# Max. size of the payload, USB_BLOCK_SIZE of the firmware
+maxBlockSize = 256
+
+# Min. size of the payload, a block holds at least one command
+minBlockSize = gcodefile.maxLineLength
+
+def checksum(command):
+    return reduce(lambda x, y: x ^ y, map(ord, command))
+
+# The text of an ascii command "N<line> <text>*<checksum>"
+def asciiText(cmd):
+
+    body = cmd.split(None, 1)[1]
+    return body[:body.index("*")]
+
+# The line number of the command 'cmd'
+def lineNumber(cmd):
+
+    if cmd[0] < "\n":
+
+        # Packed command, the line number is followed by the checksum
+        # and the newline or the CRC-16
+        if cmd[0] == "\x08" or ord(cmd[1]) & 0x04:
+            return struct.unpack("<H", cmd[-4:-2])[0]
+
+        return struct.unpack("<I", cmd[-6:-2])[0]
+
+    return int(cmd.split(None, 1)[0][1:])
+
+# A command in the form the firmware writes it to the SD card, empty
+# if the command is not stored.
+def storedCommand(cmd):
+
+    if cmd[0] < "\n":
+
+        # Packed command, cut line number, checksum and newline
+        if cmd[0] == "\x08" or ord(cmd[1]) & 0x04:
+            return cmd[:-4] + "\n"
+
+        return cmd[:-6] + "\n"
+
+    text = asciiText(cmd)
+
+    # Strip comment, but not a comment line
+    i = text.find(";", 1)
+    if i >= 0:
+        text = text[:i]
+
+    if not text:
+        return ""
+
+    return text + "\n"
+
+# Ascii command 'cmd' with the line number 'lineNr'
+def renumber(cmd, lineNr):
+
+    prefix = "N%d %s" % (lineNr, asciiText(cmd))
+    return prefix + "*%d\n" % checksum(prefix)
+
+# The block of the stored commands 'payload' with the line number 'lineNr'
+def frame(payload, lineNr):
+
+    data = struct.pack("<BHH", blockKey, len(payload), lineNr & 0xffff) + payload
+    return data + struct.pack("<H", binascii.crc_hqx(data, 0))
+
+# Generator, yields the (command, response) tuples to send for the
+# (command, response) tuples in 'gcode': the commands up to M28 as they
+# are, the following commands in blocks.
+def frameCommands(gcode, blockSize):
+
+    lineNr = 0
+    storing = False
+
+    # Stored commands of the current block
+    payload = []
+    size = 0
+
+    for (cmd, response) in gcode:
+
+        if not storing:
+
+            yield (cmd, response)
+            lineNr += 1
+
+            storing = cmd[0] >= "\n" and asciiText(cmd).startswith("M28 ")
+            continue
+
+        if response:
+
+            # Send the block, then the command
+            if payload:
+                yield (frame("".join(payload), lineNr), None)
+                lineNr += 1
+                payload = []
+                size = 0
+
+            yield (renumber(cmd, lineNr), response)
+            lineNr += 1
+            continue
+
+        stored = storedCommand(cmd)
+        if not stored:
+            continue
+
+        if size + len(stored) > blockSize:
+            yield (frame("".join(payload), lineNr), None)
+            lineNr += 1
+            payload = []
+            size = 0
+
+        payload.append(stored)
+        size += len(stored)
+
+    if payload:
+        yield (frame("".join(payload), lineNr), None)
@@ -0,0 +1,457 @@
+#!/usr/bin/env python
+
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+
+#
+# Copyright (C) 2014 Erwin Rieger
+#
+
+#
+# Bulk packer, packs a whole chunk of gcode lines at once.
+#
+# The G0/G1/G10/G11 commands of a chunk are grouped by their layout (command
+# and the sequence of parameter letters). The parameters of a group are parsed in
+# one pass by numpy, each group is packed into one numpy structured array
+# and the XOR checksums of all commands are computed in vectorised passes.
+#
+# The output is byte identical to Preprocessor.packGCode() and the plain
+# text commands of Preprocessor.packSingleLines(). Lines the bulk packer can
+# not handle (for example malformed moves) are passed to packGCode(), so
+# errors are reported the same way.
+#
+# If delta encoding is enabled, the packed G0/G1 moves of a chunk are delta
+# encoded in a vectorised pass, see deltaChunk().
+#
+# Numpy is optional, if it is not installed the Preprocessor falls back to
+# the line by line packer.
+#
+
+import string
+
+import deltapack
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Parameter letters of a move, in the order they are packed, with
+# their bit in the parameter mask and their numpy type.
+moveParams = (
+    ("F", 1 << 7, "<u2"),
+    ("X", 1 << 6, "<f4"),
+    ("Y", 1 << 5, "<f4"),
+    ("Z", 1 << 4, "<f4"),
+    ("E", 1 << 3, "<f4"),
+    )
+
+paramBits = dict([(letter, bit) for (letter, bit, t) in moveParams])
+
+# Parameter mask flag for a short line number
+shortLineFlag = 1 << 2
+
+# Move command keys
+moveKeys = { "G0": 1, "G1": 2 }
+
+# Retract command keys
+retractKeys = { "G10": 3, "G11": 4 }
+
+# Translation table to blank out the letters of a move, leaving the numbers
+moveLetters = string.maketrans("GFXYZE", "      ")
+
+# Cache of the analysed line layouts, see lineLayout()
+layouts = {}
+
+# Cache of the numpy record types of the move layouts
+moveDtypes = {}
+
+# Cache of the numpy record types of the delta encoded moves
+deltaDtypes = {}
+
+# Numpy types of the params of delta encoded moves by their width code
+deltaTypes = (None, "i1", "<i2", "<f4")
+
+def available():
+    return numpy != None
+
+# Analyse the layout of a line. Lines with the same command and the same
+# sequence of parameter letters (the 'signature') share the layout.
+#
+# Returns:
+#   (cmdHex, letters): A G0/G1 move the bulk packer can handle, letters
+#                      in the order of the line. G10/G11 are packed like
+#                      moves without parameters.
+#   None:              Line is packed by packGCode().
+def lineLayout(scmd):
+
+    splitted = scmd.split()
+    cmd = splitted[0]
+
+    if cmd in retractKeys and len(splitted) == 1:
+        return (retractKeys[cmd], ())
+
+    if cmd not in moveKeys or len(splitted) > 6:
+        return None
+
+    letters = []
+
+    for param in splitted[1:]:
+
+        letter = param[0]
+        # Parameter value without the digits, only a sign and
+        # a decimal point are allowed.
+        rest = param[1:].translate(None, string.digits)
+
+        if letter not in paramBits or letter in letters:
+            # unknown or repeated parameter
+            return None
+
+        if letter == "F":
+            # F is an integer, range is checked in packMoves()
+            if rest:
+                return None
+        elif rest not in ("", "-", ".", "-."):
+            return None
+
+        letters.append(letter)
+
+    return (moveKeys[cmd], tuple(letters))
+
+# Numpy record type of a packed move with parameter mask 'mask', the
+# checksum and the newline are part of the record.
+def moveDtype(mask):
+
+    dtype = moveDtypes.get(mask)
+
+    if dtype == None:
+
+        fields = [("cmd", "u1"), ("mask", "u1")]
+
+        for (letter, bit, t) in moveParams:
+            if mask & bit:
+                fields.append((letter, t))
+
+        if mask & shortLineFlag:
+            fields.append(("ln", "<u2"))
+        else:
+            fields.append(("ln", "<u4"))
+
+        fields += [("chk", "u1"), ("nl", "u1")]
+
+        dtype = moveDtypes[mask] = numpy.dtype(fields)
+
+    return dtype
+
+# Numpy record type of a delta encoded move with the width mask 'widthMask'.
+def deltaDtype(widthMask):
+
+    dtype = deltaDtypes.get(widthMask)
+
+    if dtype == None:
+
+        fields = [("cmd", "u1"), ("mask", "u1")]
+
+        for (i, letter) in enumerate("XYZE"):
+            code = (widthMask >> (6 - 2*i)) & 0x3
+            if code:
+                fields.append((letter, deltaTypes[code]))
+
+        fields += [("ln", "<u2"), ("chk", "u1"), ("nl", "u1")]
+
+        dtype = deltaDtypes[widthMask] = numpy.dtype(fields)
+
+    return dtype
+
+# Compute the XOR checksums of the plain text commands "N<lineNr> <cmd>"
+# of a chunk. Returns the checksums and the length of the plain text
+# commands including checksum and newline.
+def asciiChecksums(lines, lns):
+
+    n = len(lines)
+
+    lens = numpy.fromiter(map(len, lines), dtype=numpy.int64, count=n)
+    starts = numpy.zeros(n, dtype=numpy.int64)
+    numpy.cumsum(lens[:-1], out=starts[1:])
+
+    # XOR of the commands
+    data = numpy.frombuffer("".join(lines), dtype=numpy.uint8)
+    chk = numpy.bitwise_xor.reduceat(data, starts)
+
+    # XOR of the "N<lineNr> " prefix, digit by digit
+    chk ^= ord("N") ^ ord(" ")
+    ndigits = numpy.ones(n, dtype=numpy.int64)
+
+    p = 1
+    for k in range(10):
+
+        if k == 0:
+            present = numpy.ones(n, dtype=bool)
+        else:
+            present = lns >= p
+            if not present.any():
+                break
+            ndigits += present
+
+        chk ^= numpy.where(present, (lns // p) % 10 + ord("0"), 0).astype(numpy.uint8)
+        p *= 10
+
+    # "N" + linenumber + " " + cmd + "*" + checksum + newline
+    chkdigits = 1 + (chk >= 10) + (chk >= 100)
+    origlens = 1 + ndigits + 1 + lens + 1 + chkdigits + 1
+
+    return (chk, origlens)
+
+# Pack a group of moves with the same layout. Returns the packed
+# commands as numpy array of strings, their total size and the parsed
+# parameters or None if the parameters could not be parsed.
+def packMoves(cmdHex, letters, lines, lns):
+
+    n = len(lines)
+
+    # Parse all parameters of the group at once, one row per line: the
+    # number of the G command followed by the parameters.
+    text = " ".join(lines).translate(moveLetters)
+    values = numpy.fromstring(text, sep=" ")
+
+    # Each parameter must be parsed into exactly one number
+    if values.size != n * (len(letters) + 1) or len(text.split()) != values.size:
+        return None
+
+    values = values.reshape(n, len(letters) + 1)
+
+    if "F" in letters:
+        sp = values[:, letters.index("F") + 1]
+        if (sp <= 0).any() or (sp >= 0x10000).any():
+            return None
+
+    mask = 0
+    for letter in letters:
+        mask |= paramBits[letter]
+
+    packed = numpy.empty(n, dtype=object)
+    nbytes = 0
+    short = lns < 0x10000
+
+    for (flags, rows) in ((shortLineFlag, numpy.nonzero(short)[0]), (0, numpy.nonzero(~short)[0])):
+
+        if not rows.size:
+            continue
+
+        dtype = moveDtype(mask | flags)
+
+        records = numpy.zeros(rows.size, dtype=dtype)
+        records["cmd"] = cmdHex
+        records["mask"] = mask | flags
+
+        for (i, letter) in enumerate(letters):
+            # Round the doubles to float like struct.pack("<f")
+            records[letter] = values[rows, i+1]
+
+        records["ln"] = lns[rows]
+
+        raw = records.view(numpy.uint8).reshape(rows.size, dtype.itemsize)
+        raw[:, -2] = numpy.bitwise_xor.reduce(raw[:, :-2], axis=1)
+        raw[:, -1] = ord("\n")
+
+        # One string per record, the newline at the end protects
+        # trailing zero bytes.
+        packed[rows] = records.view("S%d" % dtype.itemsize).astype(object)
+        nbytes += rows.size * dtype.itemsize
+
+    return (packed, nbytes, values)
+
+# Delta encode the packed G0/G1 moves of a chunk, this is the vectorised
+# version of deltapack.DeltaEncoder.encode() with the same output.
+#
+# cmdKeys, fSeen:          command key and F param of the packed moves and arcs
+# axisSeen, axisValues:    X, Y, Z and E params of the packed moves and arcs
+def deltaChunk(prep, result, lns, cmdKeys, fSeen, axisSeen, axisValues):
+
+    n = len(result)
+    idx = numpy.arange(n)
+    reference = prep.deltaEncoder.reference
+
+    candidates = ((cmdKeys == 1) | (cmdKeys == 2)) & ~fSeen
+
+    codes = numpy.zeros((4, n), dtype=numpy.uint8)
+    deltas = numpy.zeros((4, n), dtype=numpy.int64)
+
+    for i in range(4):
+
+        seen = axisSeen[i]
+        values = axisValues[i]
+
+        # Reference of each line: the value of the previous line
+        # with this param or the reference of the encoder.
+        last = numpy.maximum.accumulate(numpy.where(seen, idx, -1))
+        prev = numpy.empty(n, dtype=numpy.int64)
+        prev[0] = -1
+        prev[1:] = last[:-1]
+
+        ref = values[numpy.maximum(prev, 0)]
+        valid = prev >= 0
+
+        if reference[i] != None:
+            ref = numpy.where(valid, ref, numpy.float32(reference[i])).astype(numpy.float32)
+            valid[:] = True
+
+        with numpy.errstate(invalid="ignore"):
+
+            x = numpy.floor((values.astype(numpy.float64) - ref.astype(numpy.float64)) / deltapack.scales[i] + 0.5)
+            ok = valid & (x >= -0x8000) & (x <= 0x7fff)
+
+            d = numpy.where(ok, x, 0).astype(numpy.int64)
+
+            # Float arithmetic of the firmware
+            ok &= (ref + d.astype(numpy.float32) * numpy.float32(deltapack.scales32[i])) == values
+
+        code = numpy.where(ok, numpy.where((d >= -0x80) & (d <= 0x7f), deltapack.DELTA8, deltapack.DELTA16), deltapack.ABSOLUTE)
+
+        codes[i] = numpy.where(seen & candidates, code, 0)
+        deltas[i] = d
+
+        if last[-1] >= 0:
+            reference[i] = float(values[last[-1]])
+
+    widthMasks = (codes[0] << 6) | (codes[1] << 4) | (codes[2] << 2) | codes[3]
+
+    # Size of the delta encoded moves: command, width mask, params,
+    # line number, checksum and newline
+    deltaLens = 2 + numpy.array(deltapack.widths)[codes].sum(axis=0) + 4
+    lens = numpy.fromiter(map(len, result), dtype=numpy.int64, count=n)
+
+    encode = candidates & (deltaLens < lens)
+
+    for widthMask in numpy.unique(widthMasks[encode]).tolist():
+
+        rows = numpy.nonzero(encode & (widthMasks == widthMask))[0]
+        dtype = deltaDtype(widthMask)
+
+        records = numpy.zeros(rows.size, dtype=dtype)
+        records["cmd"] = deltapack.deltaKey
+        records["mask"] = widthMask
+
+        for (i, letter) in enumerate("XYZE"):
+
+            code = (widthMask >> (6 - 2*i)) & 0x3
+
+            if code == deltapack.ABSOLUTE:
+                records[letter] = axisValues[i, rows]
+            elif code:
+                records[letter] = deltas[i, rows]
+
+        records["ln"] = lns[rows] & 0xffff
+
+        raw = records.view(numpy.uint8).reshape(rows.size, dtype.itemsize)
+        raw[:, -2] = numpy.bitwise_xor.reduce(raw[:, :-2], axis=1)
+        raw[:, -1] = ord("\n")
+
+        result[rows] = records.view("S%d" % dtype.itemsize).astype(object)
+
+    # Statistics, the moves are counted with their absolute size in packChunk()
+    saved = numpy.where(encode, lens - deltaLens, 0)
+
+    for (cmdHex, cmd) in ((1, "G0"), (2, "G1")):
+
+        cmdSaved = int(saved[cmdKeys == cmdHex].sum())
+
+        if cmdSaved:
+            prep.packbytes -= cmdSaved
+            prep.packedCmds[cmd][2] -= cmdSaved
+
+# Pack a chunk of commands with their line numbers and responses, the
+# commands are stripped and not empty. Updates the statistics of the
+# preprocessor 'prep' and returns the (command, response) tuples to send.
+def packChunk(prep, lines, lineNrs, responses):
+
+    n = len(lines)
+    lns = numpy.array(lineNrs, dtype=numpy.int64)
+
+    (chk, origlens) = asciiChecksums(lines, lns)
+
+    prep.origbytes += int(origlens.sum())
+
+    # Signature of the lines: command and parameter letters
+    keys = [scmd[:3] + scmd.translate(None, string.digits) for scmd in lines]
+
+    # Analyse the new signatures, with one line as example
+    for (key, scmd) in dict(zip(keys, lines)).iteritems():
+        if key not in layouts:
+            layouts[key] = lineLayout(scmd)
+
+    distinct = list(set(keys))
+    keyIds = numpy.array(map(dict(zip(distinct, range(len(distinct)))).__getitem__, keys))
+
+    result = numpy.empty(n, dtype=object)
+    # Positions of the lines to pack line by line
+    single = []
+
+    if prep.delta:
+        # Params of the packed moves and arcs for the delta encoding
+        cmdKeys = numpy.zeros(n, dtype=numpy.uint8)
+        fSeen = numpy.zeros(n, dtype=bool)
+        axisSeen = numpy.zeros((4, n), dtype=bool)
+        axisValues = numpy.zeros((4, n), dtype=numpy.float32)
+
+    for (keyId, key) in enumerate(distinct):
+
+        positions = numpy.nonzero(keyIds == keyId)[0]
+        layout = layouts[key]
+
+        if layout:
+            (cmdHex, letters) = layout
+            packed = packMoves(cmdHex, letters, [lines[pos] for pos in positions.tolist()], lns[positions])
+
+            if packed:
+                result[positions] = packed[0]
+                prep.packbytes += packed[1]
+                prep.countPacked(lines[positions[0]].split(None, 1)[0], positions.size, int(origlens[positions].sum()), packed[1])
+
+                if prep.delta and cmdHex in (1, 2):
+                    cmdKeys[positions] = cmdHex
+                    fSeen[positions] = "F" in letters
+                    for (i, letter) in enumerate("XYZE"):
+                        if letter in letters:
+                            axisSeen[i, positions] = True
+                            axisValues[i, positions] = packed[2][:, letters.index(letter) + 1]
+
+                continue
+
+        single += positions.tolist()
+
+    for pos in single:
+
+        scmd = lines[pos]
+        packed = prep.packGCode(scmd, lineNrs[pos])
+
+        if packed:
+
+            prep.packbytes += len(packed)
+            prep.countPacked(scmd.split(None, 1)[0], 1, int(origlens[pos]), len(packed))
+            result[pos] = packed
+
+            axes = prep.delta and deltapack.unpackAxes(packed)
+
+            if axes:
+                (cmdKeys[pos], fSeen[pos], values) = axes
+                for i in range(4):
+                    if values[i] != None:
+                        axisSeen[i, pos] = True
+                        axisValues[i, pos] = values[i]
+
+        else:
+
+            prep.packbytes += int(origlens[pos])
+
+            if scmd[0] == ";":
+                prep.uncompressedCmds["<comment>"] += 1
+            else:
+                prep.uncompressedCmds[scmd.split()[0]] += 1
+
+            result[pos] = "N%d %s*%d\n" % (lineNrs[pos], scmd, chk[pos])
+
+    if prep.delta:
+        deltaChunk(prep, result, lns, cmdKeys, fSeen, axisSeen, axisValues)
+
+    return zip(result.tolist(), responses)
+
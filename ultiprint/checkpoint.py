@@ -0,0 +1,392 @@
+#!/usr/bin/env python
+
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+
+#
+# Copyright (C) 2014 Erwin Rieger
+#
+
+#
+# Crash-safe checkpoint of a transfer, for the resume after a crash of
+# the host ("ultiprint.py resume <checkpoint>").
+#
+# While printing a preprocessed file (see prepcache.py), the resume
+# position is saved together with the modal state of the printer after
+# the commands before it: position, feedrate, temperatures, fan, retract
+# state and the reference values of the delta encoded moves (see
+# deltapack.py). The modal state is tracked by decoding the commands.
+#
+# An acknowledged command is written to usb.g, the printer prints it
+# later: the last commands are still in the firmware's command and
+# planner buffers (BUFSIZE 8 and BLOCK_BUFFER_SIZE 16 in
+# Configuration_adv.h) or not yet read from the SD card. The resume
+# position is Checkpoint.backoff commands before the first command not
+# acknowledged, a few commands are printed twice rather than left out.
+# The host doesn't know how far the print lags behind, raise the
+# back-off (-B) if the printer reads usb.g further behind.
+#
+# The checkpoint file has two slots of slotSize bytes, the records are
+# written alternately to the slots, in place, with one fdatasync() per
+# record. A record is written at most once per Checkpoint.interval
+# seconds and only if there was progress. If the host dies while writing
+# a record, the other slot still has the previous one, the newest record
+# with a valid CRC-32 is used.
+#
+# Record, all numbers little endian:
+#
+#   4 bytes:           magic "UPCK"
+#   4 bytes:           sequence number of the record
+#   8 bytes:           time of the record (double)
+#   4 bytes:           resume position
+#   4 bytes:           line number of the last acknowledged command, as
+#                      sent (-1 if none)
+#   8 bytes:           offset of the resume position in the body of the
+#                      preprocessed file
+#   20 bytes:          X, Y, Z, E (float) and F param, NaN if not known
+#   16 bytes:          reference values of X, Y, Z and E (float)
+#   6 bytes:           hotend and bed temperature, fan speed (short, -1
+#                      if not known)
+#   1 byte:            retracted (G10)
+#   20 bytes:          job hash, SHA-1 of the preprocessed file
+#   256 bytes:         path of the preprocessed file
+#   4 bytes:           CRC-32 of the record
+#
+# The printer is reset when the serial line is opened again and stops
+# printing. So the resume prints a new usb.g: the header comments of the
+# file (";FLAVOR:UltiGCode", ";MATERIAL:"...), the commands to restore
+# the modal state (see ModalState.preamble()) and the commands from the
+# resume position on. The modal state assumes absolute positioning (G90,
+# M82) like the slicers use. An UltiGCode file has no temperatures, the
+# UM2 heats up and primes the nozzle before it prints the file.
+#
+# A store can't be resumed, M28 truncates usb.g and the firmware has no
+# append mode: the resumed usb.g would hold only the rest of the file.
+#
+
+import os, time, math, struct, hashlib, binascii
+
+import blockstore, deltapack, prepcache
+
+magic = "UPCK"
+
+record = struct.Struct("<4sIdIiQ9f3h?20s256s")
+
+slotSize = 512
+
+# Sync the data of the file, without the meta data if possible
+fdatasync = getattr(os, "fdatasync", os.fsync)
+
+# SHA-1 of the preprocessed file 'prep', identifies the job
+def jobHash(prep):
+    return hashlib.sha1(prep.mm).digest()
+
+def floatOrNaN(value):
+
+    if value == None:
+        return float("nan")
+
+    return value
+
+def floatOrNone(value):
+
+    if math.isnan(value):
+        return None
+
+    return value
+
+def intOrNone(value):
+
+    if value < 0:
+        return None
+
+    return value
+
+class ModalState:
+
+    def __init__(self):
+
+        # Position and feedrate
+        self.x = self.y = self.z = self.e = None
+        self.f = None
+
+        # Reference values of the delta encoded moves, as known to the
+        # firmware: the last values of the packed moves and arcs.
+        self.reference = [None, None, None, None]
+
+        self.hotend = None
+        self.bed = None
+        self.fan = None
+        self.retracted = False
+
+    # The state as fields of a record
+    def pack(self):
+
+        fields = [floatOrNaN(value) for value in [self.x, self.y, self.z, self.e, self.f] + self.reference]
+        fields += [(value, -1)[value == None] for value in (self.hotend, self.bed, self.fan)]
+        return fields + [self.retracted]
+
+    # Set the state from the fields of a record
+    def unpack(self, fields):
+
+        (self.x, self.y, self.z, self.e, self.f) = map(floatOrNone, fields[:5])
+        self.reference = map(floatOrNone, fields[5:9])
+        (self.hotend, self.bed, self.fan) = map(intOrNone, fields[9:12])
+        self.retracted = fields[12]
+
+    def move(self, values):
+
+        for (i, axis) in enumerate("xyze"):
+            if values[i] != None:
+                setattr(self, axis, values[i])
+
+    def mcode(self, mcode, s):
+
+        if mcode in (104, 109):
+            if s != None:
+                self.hotend = int(s)
+        elif mcode in (140, 190):
+            if s != None:
+                self.bed = int(s)
+        elif mcode == 106:
+            if s == None:
+                s = 255
+            self.fan = int(s)
+        elif mcode == 107:
+            self.fan = 0
+
+    # Update the state with the preprocessed command 'cmd'
+    def update(self, cmd):
+
+        if cmd[0] < "\n":
+
+            key = ord(cmd[0])
+
+            if key == deltapack.deltaKey:
+                (values, codes) = deltapack.unpackDelta(cmd, self.reference)
+                self.move(values)
+
+            elif key in (1, 2, 5, 6):
+                (key, fSeen, values) = deltapack.unpackAxes(cmd)
+                if fSeen:
+                    self.f = struct.unpack_from("<H", cmd, 2)[0]
+                for i in range(4):
+                    if values[i] != None:
+                        self.reference[i] = values[i]
+                self.move(values)
+
+            elif key in (3, 4):
+                self.retracted = key == 3
+
+            elif key == 7:
+                s = None
+                if ord(cmd[1]) & 0x80:
+                    s = struct.unpack_from("<H", cmd, 3)[0]
+                self.mcode(ord(cmd[2]), s)
+
+            return
+
+        words = blockstore.asciiText(cmd).split(";", 1)[0].split()
+
+        if not words:
+            return
+
+        code = words[0]
+        params = {}
+
+        for word in words[1:]:
+            try:
+                params[word[0]] = float(word[1:])
+            except ValueError:
+                pass
+
+        if code in ("G0", "G1", "G2", "G3", "G92"):
+
+            # G92 sets only the given axes, a bare G92 sets
+            # nothing (see Marlin_main.cpp), and not F.
+            if code != "G92" and "F" in params:
+                self.f = params["F"]
+
+            self.move([params.get(axis) for axis in "XYZE"])
+
+        elif code in ("G10", "G11"):
+            self.retracted = code == "G10"
+
+        elif code[0] == "M" and code[1:].isdigit():
+            self.mcode(int(code[1:]), params.get("S"))
+
+    # The commands to restore the state after a reset of the printer:
+    # heat up, home Z (bed down) then X and Y, set E, move to the
+    # position from above and set retract state, feedrate and fan.
+    def preamble(self):
+
+        cmds = []
+
+        if self.bed:
+            cmds.append("M140 S%d" % self.bed)
+        if self.hotend:
+            cmds.append("M104 S%d" % self.hotend)
+        if self.bed:
+            cmds.append("M190 S%d" % self.bed)
+        if self.hotend:
+            cmds.append("M109 S%d" % self.hotend)
+
+        cmds += ["G28 Z0", "G28 X0 Y0"]
+
+        if self.e != None:
+            cmds.append("G92 E%.5f" % self.e)
+
+        xy = ["%s%.3f" % (axis, value) for (axis, value) in (("X", self.x), ("Y", self.y)) if value != None]
+        if xy:
+            cmds.append("G0 F9000 " + " ".join(xy))
+
+        if self.z != None:
+            cmds.append("G0 Z%.3f" % self.z)
+
+        if self.retracted:
+            cmds.append("G10")
+
+        if self.f:
+            cmds.append("G1 F%d" % self.f)
+
+        if self.fan:
+            cmds.append("M106 S%d" % self.fan)
+        elif self.fan != None:
+            cmds.append("M107")
+
+        return cmds
+
+class Checkpoint:
+
+    # Min. time between two records in seconds
+    interval = 1.0
+
+    # Default number of acknowledged commands that may not be printed
+    # yet: BUFSIZE + BLOCK_BUFFER_SIZE of the firmware
+    backoff = 24
+
+    # Checkpoint file 'path' of the transfer of the preprocessed file
+    # 'prep'. A resumed transfer continues at 'position' with the modal
+    # 'state' and the sequence number 'seq' of the loaded record, a new
+    # transfer truncates the file. The resume position is 'backoff'
+    # commands before the first command not acknowledged.
+    def __init__(self, path, prep, position=0, state=None, seq=0, backoff=None):
+
+        self.path = path
+        self.prep = prep
+        self.jobHash = jobHash(prep)
+
+        if len(prep.path) > 256:
+            raise IOError("%s: path too long for a checkpoint" % prep.path)
+
+        if backoff != None:
+            self.backoff = backoff
+
+        # Commands before this position are decoded into state, the
+        # commands before 'acked' are acknowledged
+        self.position = position
+        self.acked = position
+        self.state = state or ModalState()
+
+        # Acknowledged position of the last record, a resumed
+        # transfer keeps the loaded record until there is progress
+        self.seq = seq
+        self.saved = None
+        if seq:
+            self.saved = position
+        self.lastWrite = 0
+
+        flags = os.O_RDWR | os.O_CREAT
+        if not seq:
+            flags |= os.O_TRUNC
+        self.fd = os.open(path, flags, 0644)
+
+    # The commands before position 'pos' are acknowledged, write a
+    # record if the last one is older than interval or if 'force' is set.
+    def update(self, pos, force=False):
+
+        if self.fd == None:
+            return
+
+        now = time.time()
+
+        if not force and now - self.lastWrite < self.interval:
+            return
+
+        self.acked = max(self.acked, pos)
+
+        while self.position < self.acked - self.backoff:
+            self.state.update(self.prep[self.position][0])
+            self.position += 1
+
+        if self.acked == self.saved:
+            return
+
+        self.write(now)
+
+    def write(self, now):
+
+        self.seq += 1
+
+        lineNr = -1
+        if self.acked:
+            lineNr = blockstore.lineNumber(self.prep[self.acked - 1][0])
+
+        data = record.pack(magic, self.seq, now, self.position, lineNr, self.prep.offsets[self.position] - prepcache.header.size,
+            *(self.state.pack() + [self.jobHash, self.prep.path]))
+        data += struct.pack("<I", binascii.crc32(data) & 0xffffffff)
+
+        os.lseek(self.fd, (self.seq % 2) * slotSize, os.SEEK_SET)
+        os.write(self.fd, data)
+        fdatasync(self.fd)
+
+        self.saved = self.acked
+        self.lastWrite = now
+
+    # The transfer is complete, remove the checkpoint
+    def finish(self):
+
+        self.close()
+        os.remove(self.path)
+
+    def close(self):
+
+        if self.fd != None:
+            os.close(self.fd)
+            self.fd = None
+
+# Read the checkpoint file 'path'. Returns the newest valid record as
+# (seq, position, lineNr, offset, jobHash, prepPath, state) or None.
+def load(path):
+
+    f = open(path, "rb")
+    data = f.read(2 * slotSize)
+    f.close()
+
+    newest = None
+
+    for slot in range(2):
+
+        rec = data[slot * slotSize:slot * slotSize + record.size + 4]
+
+        if len(rec) < record.size + 4 or rec[:4] != magic:
+            continue
+
+        if struct.unpack("<I", rec[-4:])[0] != binascii.crc32(rec[:-4]) & 0xffffffff:
+            continue
+
+        fields = record.unpack(rec[:-4])
+
+        if newest and newest[1] > fields[1]:
+            continue
+
+        newest = fields
+
+    if not newest:
+        return None
+
+    (m, seq, t, position, lineNr, offset) = newest[:6]
+
+    state = ModalState()
+    state.unpack(newest[6:19])
+
+    return (seq, position, lineNr, offset, newest[19], newest[20].rstrip("\0"), state)
@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+
+#
+# Copyright (C) 2014 Erwin Rieger
+#
+
+#
+# Delta encoding of packed moves (command key 8).
+#
+# The X, Y, Z and E params of a G0/G1 move without F param are encoded as
+# fixed point deltas to the reference value of the axis, the reference is
+# the value of the last packed move or arc (command keys 1, 2, 5, 6 and 8)
+# with this param. Plain text moves don't change the reference.
+#
+# 1 byte:            command key 8
+# 1 byte:            width mask, 2 bits per param: XXYYZZEE
+#                      0: param not present
+#                      1: 1 byte delta (signed char)
+#                      2: 2 byte delta (signed short)
+#                      3: 4 byte absolute value (float)
+# 1/2/4 bytes:       X param
+# 1/2/4 bytes:       Y param
+# 1/2/4 bytes:       Z param
+# 1/2/4 bytes:       E param
+# 2 bytes:           lower 16 bits of the line number
+# 1 byte:            checksum
+#
+# The firmware computes the value of a delta param in float arithmetic:
+#
+#   reference = reference + delta * scale
+#
+# A delta is only used if this gives exactly the float of the absolute
+# param, else the absolute value is sent. So the delta encoding is lossless.
+#
+# The reference values are reset every Preprocessor.sliceSize input
+# lines, so slices of a file can be packed independently.
+#
+
+import struct, math
+
+# Command key of the delta encoded moves
+deltaKey = 8
+
+# Scale of the fixed point deltas of the X, Y, Z and E params,
+# the slicers use 3 digits for X, Y, Z and 5 digits for E.
+scales = (0.001, 0.001, 0.001, 0.00001)
+
+# Size of the params by their width code
+widths = (0, 1, 2, 4)
+
+# Width codes
+DELTA8 = 1
+DELTA16 = 2
+ABSOLUTE = 3
+
+def float32(value):
+    return struct.unpack("<f", struct.pack("<f", value))[0]
+
+# Scales rounded to float like in the firmware
+scales32 = tuple([float32(scale) for scale in scales])
+
+# Decode the X, Y, Z and E params of a packed move or arc. Returns
+# (command key, F param seen, list of the 4 params) or None for other
+# commands, missing params are None.
+def unpackAxes(packed):
+
+    cmdHex = ord(packed[0])
+
+    if cmdHex not in (1, 2, 5, 6):
+        return None
+
+    mask = ord(packed[1])
+
+    pos = 2
+    if mask & 0x80:
+        pos += 2 # F param
+
+    values = [None, None, None, None]
+
+    for i in range(4):
+        if mask & (0x40 >> i):
+            values[i] = struct.unpack_from("<f", packed, pos)[0]
+            pos += 4
+
+    return (cmdHex, mask & 0x80, values)
+
+# Decode the X, Y, Z and E params of a delta encoded move like the
+# firmware does. The list 'reference' of the reference values is
+# updated, returns the list of the 4 params and the list of their width
+# codes, missing params are None.
+def unpackDelta(packed, reference):
+
+    widthMask = ord(packed[1])
+
+    pos = 2
+    values = [None, None, None, None]
+    codes = [None, None, None, None]
+
+    for i in range(4):
+
+        code = (widthMask >> (6 - 2*i)) & 0x3
+        if not code:
+            continue
+
+        if code == ABSOLUTE:
+            value = struct.unpack_from("<f", packed, pos)[0]
+        else:
+            delta = struct.unpack_from(("<b", "<h")[code-1], packed, pos)[0]
+            value = float32(reference[i] + float32(delta * scales32[i]))
+
+        pos += widths[code]
+        values[i] = reference[i] = value
+        codes[i] = code
+
+    return (values, codes)
+
+# The move with the X, Y, Z and E params 'values' as absolute packed
+# move (command key 2) with the line number 'lineNr', missing params
+# are None.
+def absoluteMove(values, lineNr):
+
+    mask = 0
+    params = ""
+
+    for i in range(4):
+        if values[i] != None:
+            mask |= 0x40 >> i
+            params += struct.pack("<f", values[i])
+
+    if lineNr < 0x10000:
+        mask |= 0x04
+        params += struct.pack("<H", lineNr)
+    else:
+        params += struct.pack("<I", lineNr)
+
+    packed = struct.pack("<BB", 2, mask) + params
+    return packed + chr(reduce(lambda x, y: x ^ y, map(ord, packed))) + "\n"
+
+# Compute the fixed point delta of a param, returns the width code and
+# the delta. The computation is done the same way in bulkpack.deltaChunk().
+def encodeValue(i, value, reference):
+
+    if reference == None:
+        return (ABSOLUTE, value)
+
+    x = math.floor((value - reference) / scales[i] + 0.5)
+
+    if not (-0x8000 <= x <= 0x7fff):
+        return (ABSOLUTE, value)
+
+    delta = int(x)
+
+    # Float arithmetic of the firmware, products and sums of two floats
+    # are exact in double precision in the range of the coordinates.
+    if float32(reference + float32(delta * scales32[i])) != value:
+        return (ABSOLUTE, value)
+
+    if -0x80 <= delta <= 0x7f:
+        return (DELTA8, delta)
+
+    return (DELTA16, delta)
+
+class DeltaEncoder:
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+
+        # Reference values of X, Y, Z and E
+        self.reference = [None, None, None, None]
+
+    # Delta encode a packed command, returns the delta encoded move if it
+    # is shorter than 'packed', else 'packed'.
+    def encode(self, packed, lineNr):
+
+        axes = unpackAxes(packed)
+
+        if not axes:
+            return packed
+
+        (cmdHex, fSeen, values) = axes
+        delta = None
+
+        if cmdHex in (1, 2) and not fSeen:
+
+            widthMask = 0
+            params = ""
+
+            for i in range(4):
+
+                if values[i] == None:
+                    continue
+
+                (code, value) = encodeValue(i, values[i], self.reference[i])
+                widthMask |= code << (6 - 2*i)
+                params += struct.pack(("<b", "<h", "<f")[code-1], value)
+
+            delta = struct.pack("<BB", deltaKey, widthMask) + params + struct.pack("<H", lineNr & 0xffff)
+            delta += chr(reduce(lambda x, y: x ^ y, map(ord, delta))) + "\n"
+
+        for i in range(4):
+            if values[i] != None:
+                self.reference[i] = values[i]
+
+        if delta and len(delta) < len(packed):
+            return delta
+
+        return packed
+
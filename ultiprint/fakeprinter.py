@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+
+#
+# Copyright (C) 2014 Erwin Rieger
+#
+
+#
+# Stand-in for a UM2 on a pseudo terminal, for testing and benchmarking
+# without a printer.
+#
+# The fake printer speaks the usb protocol of the firmware: each command
+# with a valid checksum and line number is acknowledged with an ACK (0x6),
+# M110, M28 and M623 are answered with "ok", M29 with "Done saving file.",
+# M624 S1 switches the packed commands to the CRC-16 (until M110), the
+# line number of M110 is the new line number.
+# Blocks of commands (command key 9, see blockstore.py) are acknowledged
+# once per block. Invalid commands are answered with "Error:... Last
+# Line: <n>" and the receive buffer is flushed, like the firmware does.
+#
+# Options: a latency per command (delay before the ACK) and an error
+# rate (probability that a valid command is rejected with a checksum
+# error).
+#
+# Standalone use: fakeprinter.py [-l latency] [-e errorRate], prints the
+# name of the pseudo terminal to use with ultiprint.py -d.
+#
+
+import os, sys, time, struct, random, binascii, threading, argparse
+
+# Acknowledge of a usb transmission
+ACK = chr(0x6)
+
+# Size of the params of packed moves and arcs by param mask bit, FXYZESIJ
+paramSizes = ((0x80, 2), (0x40, 4), (0x20, 4), (0x10, 4), (0x08, 4), (0x02, 4), (0x01, 4))
+
+# Size of the params of delta encoded moves by width code
+deltaSizes = (0, 1, 2, 4)
+
+# Length of a packed command with command key 'cmd' and param mask
+# 'mask', like getPackedLen() of the firmware.
+def packedLen(cmd, mask):
+
+    # Command key, mask, checksum and newline
+    n = 4
+
+    if cmd == 8:
+        for shift in (6, 4, 2, 0):
+            n += deltaSizes[(mask >> shift) & 3]
+        return n + 2
+
+    if cmd == 7:
+        if mask & 0x80:
+            n += 2
+        if mask & 0x40:
+            n += 1
+        # M-code number
+        n += 1
+    else:
+        for (bit, size) in paramSizes:
+            if mask & bit:
+                n += size
+
+    if mask & 0x04:
+        # Short line number
+        return n + 2
+
+    return n + 4
+
+class FakePrinter(threading.Thread):
+
+    def __init__(self, latency=0, errorRate=0):
+
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+        self.master, self.slave = os.openpty()
+        self.name = os.ttyname(self.slave)
+
+        self.latency = latency
+        self.errorRate = errorRate
+
+        self.rxBuffer = ""
+        self.lastLine = -1
+
+        # Packed commands end with a CRC-16 (M624 S1)
+        self.crc = False
+
+        # Statistics
+        self.commands = 0
+        self.errors = 0
+        self.bytes = 0
+
+        # Commands and payloads of the blocks of the file written
+        # by M28, without the setup commands.
+        self.stored = []
+        self.storing = False
+
+    def reply(self, s):
+        os.write(self.master, s)
+
+    # Reject the current command
+    def error(self, msg):
+
+        self.errors += 1
+        self.reply("Error:%s, Last Line: %d\n" % (msg, self.lastLine))
+
+        # Flush the receive buffer
+        self.rxBuffer = ""
+
+    # Returns the next complete command from the receive buffer as a tuple
+    # (command, line number, short (16 bit) line number, checksum ok, gcode
+    # text of ascii commands) or None.
+    def nextCommand(self):
+
+        cmd = ord(self.rxBuffer[0])
+
+        if cmd == 9:
+
+            # Block: key, length, line number, payload and CRC
+            if len(self.rxBuffer) < 5:
+                return None
+
+            n = 5 + struct.unpack("<H", self.rxBuffer[1:3])[0] + 2
+            if len(self.rxBuffer) < n:
+                return None
+
+            data = self.rxBuffer[:n]
+            self.rxBuffer = self.rxBuffer[n:]
+
+            lineNr = struct.unpack("<H", data[3:5])[0]
+            crc = struct.unpack("<H", data[-2:])[0]
+            return (data, lineNr, True, binascii.crc_hqx(data[:-2], 0) == crc, None)
+
+        if cmd < 10:
+
+            if len(self.rxBuffer) < 2:
+                return None
+
+            n = packedLen(cmd, ord(self.rxBuffer[1]))
+            if len(self.rxBuffer) < n:
+                return None
+
+            data = self.rxBuffer[:n]
+            self.rxBuffer = self.rxBuffer[n:]
+
+            shortLine = cmd == 8 or ord(data[1]) & 0x04
+            if shortLine:
+                lineNr = struct.unpack("<H", data[-4:-2])[0]
+            else:
+                lineNr = struct.unpack("<I", data[-6:-2])[0]
+
+            if self.crc:
+                return (data, lineNr, shortLine, binascii.crc_hqx(data[:-2], 0) == struct.unpack("<H", data[-2:])[0], None)
+
+            chk = reduce(lambda x, y: x ^ y, map(ord, data[:-2]))
+            return (data, lineNr, shortLine, chk == ord(data[-2]), None)
+
+        i = self.rxBuffer.find("\n")
+        if i < 0:
+            return None
+
+        data = self.rxBuffer[:i+1]
+        self.rxBuffer = self.rxBuffer[i+1:]
+
+        try:
+            (body, chk) = data.rstrip().rsplit("*", 1)
+            (n, text) = body.split(None, 1)
+            return (data, int(n[1:]), False, reduce(lambda x, y: x ^ y, map(ord, body)) == int(chk), text)
+        except ValueError:
+            return (data, None, False, False, None)
+
+    # Check and execute a command
+    def processCommand(self, data, lineNr, shortLine, chkOk, text):
+
+        if not chkOk or (self.errorRate and random.random() < self.errorRate):
+            self.error("checksum mismatch")
+            return
+
+        expected = self.lastLine + 1
+        if shortLine:
+            expected &= 0xffff
+
+        if text == "M110":
+            # M110 sets the line number
+            self.lastLine = lineNr - 1
+            self.crc = False
+        elif lineNr != expected:
+            self.error("Line Number is not Last Line Number+1")
+            return
+
+        self.lastLine += 1
+        self.commands += 1
+        self.bytes += len(data)
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        self.reply(ACK)
+
+        if text == "M29":
+            self.storing = False
+            self.reply("Done saving file.\n")
+        elif self.storing and data[0] == "\x09":
+            # Payload of a block
+            self.stored.append(data[5:-2])
+        elif self.storing:
+            self.stored.append(data)
+        elif text in ("M110", "M623 usb.g"):
+            self.reply("ok\n")
+        elif text in ("M624 S0", "M624 S1"):
+            self.crc = text == "M624 S1"
+            self.reply("echo:CRC16:%d\nok\n" % self.crc)
+        elif text == "M28 usb.g":
+            self.storing = True
+            self.stored = []
+            self.reply("ok\n")
+
+    def run(self):
+
+        while True:
+
+            self.rxBuffer += os.read(self.master, 4096)
+
+            while self.rxBuffer:
+
+                command = self.nextCommand()
+                if not command:
+                    break
+
+                self.processCommand(*command)
+
+#
+# Main
+#
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Fake UM2 on a pseudo terminal.')
+    parser.add_argument("-l", dest="latency", action="store", type=float, help="Delay before each ACK in seconds, default: 0.", default=0)
+    parser.add_argument("-e", dest="errorRate", action="store", type=float, help="Probability of a checksum error per command, default: 0.", default=0)
+
+    args = parser.parse_args()
+
+    printer = FakePrinter(args.latency, args.errorRate)
+    printer.start()
+
+    print "Fake printer on:", printer.name
+    sys.stdout.flush()
+
+    try:
+        while True:
+            time.sleep(10)
+            print "Commands: %d, errors: %d, bytes: %d" % (printer.commands, printer.errors, printer.bytes)
+            sys.stdout.flush()
+    except KeyboardInterrupt:
+        pass
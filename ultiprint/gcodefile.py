@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+
+#
+# Copyright (C) 2014 Erwin Rieger
+#
+
+#
+# Memory-mapped input gcode file.
+#
+# The file is mapped into memory and only the start and length of each
+# line is kept (5 bytes per line), instead of a string and a tuple per
+# line. The packer reads the lines in blocks of about blockSize bytes,
+# only the lines of the current block are copied out of the mapping.
+# Lines longer than maxLineLength (like the ";CURA_PROFILE_STRING" line
+# at the end of the file) are dropped, they would overflow the command
+# buffer of the firmware (MAX_CMD_SIZE 96 in Marlin).
+#
+# Comments and empty lines are kept, the comments are sent and stored
+# in usb.g and all lines count for the slicing of the parallel packer.
+#
+# With numpy the line boundaries are found in a vectorised pass over
+# each block of the mapping, else line by line with mmap.find().
+#
+
+import os, mmap, array, cStringIO
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Max. length of a line including the newline
+maxLineLength = 80
+
+# Lines are scanned and read in blocks of about this size
+blockSize = 1024 * 1024
+
+class GCodeFile:
+
+    # Sequence of the (line, response) tuples of the file 'filename',
+    # preceded by the commands 'head' and followed by the commands 'tail'.
+    def __init__(self, filename, head=[], tail=[]):
+
+        self.head = list(head)
+        self.tail = list(tail)
+
+        f = open(filename, "rb")
+        self.size = os.fstat(f.fileno()).st_size
+
+        if self.size:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            # Empty files can't be mapped
+            self.data = ""
+
+        f.close()
+
+        # Start and length of the lines
+        if self.size < 2**32:
+            self.starts = array.array("I")
+        else:
+            self.starts = array.array("L")
+        self.lengths = array.array("B")
+
+        if numpy != None:
+            self.scanNumpy()
+        else:
+            self.scan()
+
+        self.nHead = len(self.head)
+        self.nLines = len(self.starts)
+
+    # Find the lines with mmap.find()
+    def scan(self):
+
+        pos = 0
+
+        while pos < self.size:
+
+            end = self.data.find("\n", pos)
+            if end < 0:
+                end = self.size
+            else:
+                end += 1
+
+            if end - pos <= maxLineLength:
+                self.starts.append(pos)
+                self.lengths.append(end - pos)
+
+            pos = end
+
+    # Find the lines block by block
+    def scanNumpy(self):
+
+        startType = numpy.dtype(self.starts.typecode)
+
+        # Start of the current line
+        lineStart = 0
+
+        for blockStart in xrange(0, self.size, blockSize):
+
+            n = min(blockSize, self.size - blockStart)
+            block = numpy.frombuffer(self.data, dtype=numpy.uint8, count=n, offset=blockStart)
+
+            ends = numpy.flatnonzero(block == 10) + (blockStart + 1)
+            if not len(ends):
+                continue
+
+            starts = numpy.empty_like(ends)
+            starts[0] = lineStart
+            starts[1:] = ends[:-1]
+            lineStart = ends[-1]
+
+            lengths = ends - starts
+            keep = lengths <= maxLineLength
+
+            self.starts.fromstring(starts[keep].astype(startType).tostring())
+            self.lengths.fromstring(lengths[keep].astype(numpy.uint8).tostring())
+
+        if lineStart < self.size and self.size - lineStart <= maxLineLength:
+            # Last line without newline
+            self.starts.append(lineStart)
+            self.lengths.append(self.size - lineStart)
+
+    def __len__(self):
+        return self.nHead + self.nLines + len(self.tail)
+
+    def __getitem__(self, pos):
+
+        if isinstance(pos, slice):
+            return self.slice(*pos.indices(len(self)))
+
+        if pos < 0:
+            pos += len(self)
+
+        if pos < self.nHead:
+            return self.head[pos]
+
+        pos -= self.nHead
+
+        if pos < self.nLines:
+            start = self.starts[pos]
+            return (self.data[start:start+self.lengths[pos]], None)
+
+        return self.tail[pos - self.nLines]
+
+    # Generator, the (line, response) tuples of the lines
+    # 'first' to 'last' - 1 of the file.
+    def lines(self, first, last):
+
+        if first >= last:
+            return
+
+        data = self.data
+
+        pos = self.starts[first]
+        end = self.starts[last-1] + self.lengths[last-1]
+
+        while pos < end:
+
+            # Read up to the last line end in the block. The
+            # lines to drop (if any) are dropped again here.
+            stop = end
+            if pos + blockSize < end:
+                stop = data.rfind("\n", pos, pos + blockSize) + 1
+                if stop <= pos:
+                    # Line longer than the block
+                    stop = data.find("\n", pos) + 1
+
+            for line in cStringIO.StringIO(data[pos:stop]):
+                if len(line) <= maxLineLength:
+                    yield (line, None)
+
+            pos = stop
+
+    # List of the items start to stop, used by the parallel packer
+    def slice(self, start, stop, step):
+
+        if step != 1:
+            return [self[i] for i in xrange(start, stop, step)]
+
+        result = self.head[start:stop]
+
+        first = max(start - self.nHead, 0)
+        last = max(min(stop - self.nHead, self.nLines), 0)
+        result += self.lines(first, last)
+
+        result += self.tail[max(start - self.nHead - self.nLines, 0):max(stop - self.nHead - self.nLines, 0)]
+
+        return result
+
+    def __iter__(self):
+
+        for cmd in self.head:
+            yield cmd
+
+        for cmd in self.lines(0, self.nLines):
+            yield cmd
+
+        for cmd in self.tail:
+            yield cmd
+
+    def close(self):
+
+        if self.size:
+            self.data.close()
@@ -0,0 +1,282 @@
+#!/usr/bin/env python
+
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+
+#
+# Copyright (C) 2014 Erwin Rieger
+#
+
+#
+# G-code passes, run on the lines of a gcode file before they are packed
+# (ultiprint.py -O). Fewer and shorter commands are sent:
+#
+#   comments:   strip comment lines and trailing comments, except the
+#               header comments the UM2 reads from the start of the file
+#               (";FLAVOR:UltiGCode", ";TIME:", ";MATERIAL:" ...)
+#   numbers:    normalise the numbers of the params, e.g. X10.500 -> X10.5,
+#               F1800.0 -> F1800 (then F can be packed)
+#   modal:      drop the params of G0/G1 moves that repeat the modal value
+#               (F, unchanged X, Y, Z and E) and moves that are left
+#               without params
+#
+# A pass is a class with the name of the pass and the method apply(),
+# which returns the changed line or None to drop the line. The passes
+# keep state from line to line, so a file is run through the passes of
+# one Pipeline in order. Commands with a response (M110, M28, M29...)
+# are not touched.
+#
+
+import re
+
+# Ascii params of these M-codes are text, not numbers
+textMCodes = ("M23", "M28", "M30", "M32", "M117", "M623", "M928")
+
+number = re.compile(r"^[-+]?(\d+\.?\d*|\.\d+)$")
+
+class StripComments:
+
+    name = "comments"
+
+    # Header comments used by the UM2, see UltiLCD2_menu_print.cpp
+    headerKeys = (";FLAVOR:", ";TIME:", ";MATERIAL:", ";MATERIAL2:", ";NOZZLE_DIAMETER:")
+
+    def __init__(self):
+
+        # Set until the first command of the file
+        self.header = True
+
+    def apply(self, line):
+
+        if line[0] == ";":
+
+            if self.header and line.startswith(StripComments.headerKeys):
+                return line
+
+            return None
+
+        self.header = False
+
+        i = line.find(";")
+        if i >= 0:
+            line = line[:i].rstrip()
+
+        return line
+
+# The number 's' without superfluous zeros, signs and decimal point
+def normNumber(s):
+
+    if not number.match(s):
+        return s
+
+    negative = s[0] == "-"
+    s = s.lstrip("+-")
+
+    if "." in s:
+        s = s.rstrip("0").rstrip(".")
+
+    s = s.lstrip("0")
+
+    if not s:
+        return "0"
+
+    if negative:
+        return "-" + s
+
+    return s
+
+class NormNumbers:
+
+    name = "numbers"
+
+    def apply(self, line):
+
+        if line[0] == ";":
+            return line
+
+        (cmd, sep, comment) = line.partition(";")
+        words = cmd.split()
+
+        if words[0] in textMCodes:
+            return line
+
+        cmd = " ".join([words[0]] + [word[0] + normNumber(word[1:]) for word in words[1:]])
+
+        if sep:
+            return cmd + " " + sep + comment
+
+        return cmd
+
+class ModalParams:
+
+    name = "modal"
+
+    # G-codes that don't change the position
+    keepPosition = ("G4", "G10", "G11")
+
+    def __init__(self):
+
+        # Known modal values of X, Y, Z, E and F
+        self.values = {}
+
+        # Relative positioning (G91) and relative E (M83)
+        self.relative = False
+        self.relativeE = False
+
+    def forget(self, axes):
+
+        for axis in axes:
+            self.values.pop(axis, None)
+
+    # Params of 'words' as dictionary, None if one is not a number
+    def params(self, words):
+
+        values = {}
+
+        for word in words:
+            try:
+                values[word[0]] = float(word[1:])
+            except ValueError:
+                return None
+
+        return values
+
+    def apply(self, line):
+
+        if line[0] == ";":
+            return line
+
+        (cmd, sep, comment) = line.partition(";")
+        words = cmd.split()
+        code = words[0]
+
+        if code in ("G0", "G1"):
+            return self.move(line, words, sep + comment)
+
+        if code[0] == "T":
+            # Tool offsets
+            self.forget("XYZE")
+
+        elif code in ("G2", "G3", "G92"):
+
+            params = self.params(words[1:])
+
+            if params == None:
+                self.forget("XYZEF")
+                return line
+
+            # G92 sets only the given axes, a bare G92 sets
+            # nothing (see Marlin_main.cpp), and not F.
+            axes = "XYZEF"
+            if code == "G92":
+                axes = "XYZE"
+
+            for axis in axes:
+                if axis in params and not self.isRelative(axis):
+                    self.values[axis] = params[axis]
+                elif axis in params:
+                    self.forget(axis)
+
+        elif code == "G28":
+
+            homed = [axis for axis in "XYZ" if axis in cmd[3:]]
+            self.forget(homed or "XYZ")
+
+        elif code in ("G90", "G91"):
+            self.relative = code == "G91"
+            self.forget("XYZE")
+
+        elif code in ("M82", "M83"):
+            self.relativeE = code == "M83"
+            self.forget("E")
+
+        elif code[0] == "G" and code not in ModalParams.keepPosition:
+            self.forget("XYZEF")
+
+        return line
+
+    def isRelative(self, axis):
+        return axis != "F" and (self.relative or (axis == "E" and self.relativeE))
+
+    def move(self, line, words, comment):
+
+        params = self.params(words[1:])
+
+        if params == None or len(params) != len(words) - 1:
+            # Unknown or repeated params
+            self.forget("XYZEF")
+            return line
+
+        keep = [words[0]]
+
+        for word in words[1:]:
+
+            axis = word[0]
+            value = params[axis]
+
+            if self.isRelative(axis):
+                keep.append(word)
+                continue
+
+            if self.values.get(axis) == value:
+                continue
+
+            self.values[axis] = value
+            keep.append(word)
+
+        if len(keep) == 1:
+            # Nothing left to do
+            return None
+
+        if comment:
+            keep.append(comment)
+
+        return " ".join(keep)
+
+# The passes in the order they are run
+passes = (StripComments, NormNumbers, ModalParams)
+
+passNames = [p.name for p in passes]
+
+class Pipeline:
+
+    # Run the passes with the names 'names' in the order of
+    # the passes list.
+    def __init__(self, names):
+
+        self.passes = [p() for p in passes if p.name in names]
+
+        # Commands and bytes removed by each pass:
+        # [name, commands, bytes]
+        self.stats = [[p.name, 0, 0] for p in self.passes]
+
+    def names(self):
+        return [p.name for p in self.passes]
+
+    # Generator, run the (line, response) tuples of 'gcode' through
+    # the passes.
+    def run(self, gcode):
+
+        passes = zip(self.passes, self.stats)
+
+        for (line, response) in gcode:
+
+            scmd = line.strip()
+
+            if response or not scmd:
+                yield (line, response)
+                continue
+
+            for (p, stat) in passes:
+
+                new = p.apply(scmd)
+
+                if new == None:
+                    stat[1] += 1
+                    stat[2] += len(scmd) + 1
+                    break
+
+                stat[2] += len(scmd) - len(new)
+                scmd = new
+
+            else:
+                yield (scmd, None)
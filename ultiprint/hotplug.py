@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+
+#
+# Copyright (C) 2014 Erwin Rieger
+#
+
+#
+# Hotplug events of the serial devices.
+#
+# TtyWatcher watches a device directory (/dev) for ttys that are added
+# or removed. On Linux inotify is used (through ctypes, no extra module
+# needed), fileno() can be passed to select() then, it is readable
+# when a device node was created or deleted. A change of the attributes
+# of a node is reported as added too: udev sets the permissions after
+# the node is created, a device that could not be opened may be
+# accessible then. Without inotify the directory is listed on each call
+# of wait() and fileno() is None.
+#
+# The directory can be a temporary directory, e.g. to fake the events
+# for testing by creating and removing files there.
+#
+
+import os, time, struct, select, errno, ctypes, ctypes.util
+
+# Event masks, see inotify(7)
+IN_ATTRIB = 0x4
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+
+# Flags of inotify_init1()
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+
+# struct inotify_event without the name
+eventHeader = struct.Struct("iIII")
+
+# Prefixes of the serial devices to watch
+ttyPrefixes = ("ttyACM", "ttyUSB")
+
+def loadLibc():
+
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+
+    return libc
+
+libc = loadLibc()
+
+class TtyWatcher:
+
+    def __init__(self, path="/dev", prefixes=ttyPrefixes):
+
+        self.path = path
+        self.prefixes = prefixes
+
+        # Inotify file descriptor
+        self.fd = None
+
+        # The ttys found by the last listing, without inotify
+        self.names = None
+
+        if libc:
+
+            fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+
+            if fd >= 0:
+                if libc.inotify_add_watch(fd, path, IN_ATTRIB | IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO) >= 0:
+                    self.fd = fd
+                else:
+                    os.close(fd)
+
+        if self.fd == None:
+            self.names = self.listTtys()
+
+    def fileno(self):
+        return self.fd
+
+    def listTtys(self):
+        return set([name for name in os.listdir(self.path) if name.startswith(self.prefixes)])
+
+    # Returns the list of ("add", device) and ("remove", device) events
+    # since the last call, waits up to 'timeout' seconds for an event.
+    def wait(self, timeout=0):
+
+        if self.fd == None:
+            return self.pollEvents(timeout)
+
+        if timeout:
+            select.select([self.fd], [], [], timeout)
+
+        return self.readEvents()
+
+    def readEvents(self):
+
+        events = []
+
+        while True:
+
+            try:
+                data = os.read(self.fd, 4096)
+            except OSError as ex:
+                if ex.errno == errno.EAGAIN:
+                    return events
+                raise
+
+            pos = 0
+            while pos < len(data):
+
+                (wd, mask, cookie, length) = eventHeader.unpack_from(data, pos)
+                pos += eventHeader.size
+
+                name = data[pos:pos+length].rstrip("\0")
+                pos += length
+
+                if not name.startswith(self.prefixes):
+                    continue
+
+                if mask & (IN_ATTRIB | IN_CREATE | IN_MOVED_TO):
+                    events.append(("add", os.path.join(self.path, name)))
+                elif mask & (IN_DELETE | IN_MOVED_FROM):
+                    events.append(("remove", os.path.join(self.path, name)))
+
+    def pollEvents(self, timeout):
+
+        names = self.listTtys()
+
+        if names == self.names and timeout:
+            time.sleep(timeout)
+            names = self.listTtys()
+
+        events = [("add", os.path.join(self.path, name)) for name in sorted(names - self.names)]
+        events += [("remove", os.path.join(self.path, name)) for name in sorted(self.names - names)]
+
+        self.names = names
+
+        return events
+
+    def close(self):
+
+        if self.fd != None:
+            os.close(self.fd)
+            self.fd = None
+
@@ -39,6 +39,29 @@ elif os.name == 'posix':
 else:
     raise ImportError("Sorry: no implementation for your platform ('%s') available" % (os.name,))
 
+if 'usb_id' not in globals():
+    # No direct lookup on this platform, search the list of ports
+
+    def usb_id(device):
+        """\
+        Return the hardware ID of the USB serial port device, None if it is
+        not a USB device.
+        """
+        for port, desc, hwid in comports():
+            if port == device and hwid.startswith('USB'):
+                return hwid
+        return None
+
+    def find_usb_id(hwid):
+        """\
+        Return the port with the hardware ID hwid (as returned by usb_id()),
+        None if it is not connected.
+        """
+        for port, desc, h in comports():
+            if h == hwid:
+                return port
+        return None
+
 
 def grep(regexp):
     """\
@@ -10,22 +10,6 @@ import sys
 import os
 import re
 
-try:
-    import subprocess
-except ImportError:
-    def popen(argv):
-        try:
-            si, so =  os.popen4(' '.join(argv))
-            return so.read().strip()
-        except:
-            raise IOError('lsusb failed')
-else:
-    def popen(argv):
-        try:
-            return subprocess.check_output(argv, stderr=subprocess.STDOUT).strip()
-        except:
-            raise IOError('lsusb failed')
-
 
 # The comports function is expected to return an iterable that yields tuples of
 # 3 strings: port name, human readable description and a hardware ID.
@@ -56,9 +40,20 @@ if   plat[:5] == 'linux':    # Linux (confirmed)
     # try to extract descriptions from sysfs. this was done by experimenting,
     # no guarantee that it works for all devices or in the future...
 
+    # Everything is read from sysfs, no lsusb subprocesses. The USB
+    # identity of a tty is cached by its sysfs device path, the cache
+    # entry is checked against the device number of the USB device, which
+    # changes when a device is plugged in again.
+    sysfs_tty = '/sys/class/tty'
+
+    # Only these ttys are listed
+    tty_prefixes = ('ttyS', 'ttyUSB', 'ttyACM')
+
+    # sysfs device path -> (devnum, description, hardware ID)
+    usb_cache = {}
+
     def usb_sysfs_hw_string(sysfs_path):
         """given a path to a usb device in sysfs, return a string describing it"""
-        bus, dev = os.path.basename(os.path.realpath(sysfs_path)).split('-')
         snr = read_line(sysfs_path+'/serial')
         if snr:
             snr_txt = ' SNR=%s' % (snr,)
@@ -70,36 +65,54 @@ if   plat[:5] == 'linux':    # Linux (confirmed)
                 snr_txt
                 )
 
-    def usb_lsusb_string(sysfs_path):
-        bus, dev = os.path.basename(os.path.realpath(sysfs_path)).split('-')
-        try:
-            desc = popen(['lsusb', '-v', '-s', '%s:%s' % (bus, dev)])
-            # descriptions from device
-            iManufacturer = re_group('iManufacturer\s+\w+ (.+)', desc)
-            iProduct = re_group('iProduct\s+\w+ (.+)', desc)
-            iSerial = re_group('iSerial\s+\w+ (.+)', desc) or ''
-            # descriptions from kernel
-            idVendor = re_group('idVendor\s+0x\w+ (.+)', desc)
-            idProduct = re_group('idProduct\s+0x\w+ (.+)', desc)
-            # create descriptions. prefer text from device, fall back to the others
-            return '%s %s %s' % (iManufacturer or idVendor, iProduct or idProduct, iSerial)
-        except IOError:
-            return base
+    def usb_sysfs_string(sysfs_path):
+        """the description lsusb would show, from the strings of the device"""
+        return '%s %s %s' % (
+                read_line(sysfs_path+'/manufacturer') or read_line(sysfs_path+'/idVendor'),
+                read_line(sysfs_path+'/product') or read_line(sysfs_path+'/idProduct'),
+                read_line(sysfs_path+'/serial') or ''
+                )
+
+    def usb_device(sys_dev_path):
+        """the usb device in sysfs of a tty device (interface or usb-serial port), None if not usb"""
+        path = sys_dev_path
+        for i in range(3):
+            if os.path.exists(path+'/idVendor'):
+                return path
+            path = os.path.dirname(path)
+        return None
+
+    def usb_info(base):
+        """(description, hardware ID) of a USB tty, None for other ttys"""
+        sys_dev_path = os.path.realpath('%s/%s/device' % (sysfs_tty, base))
+        if not os.path.exists(sys_dev_path):
+            return None
+        entry = usb_cache.get(sys_dev_path)
+        if entry:
+            if read_line(entry[0]) == entry[1]:
+                return entry[2:]
+        sys_usb = usb_device(sys_dev_path)
+        if not sys_usb:
+            return None
+        info = (usb_sysfs_string(sys_usb), usb_sysfs_hw_string(sys_usb))
+        usb_cache[sys_dev_path] = (sys_usb+'/devnum', read_line(sys_usb+'/devnum')) + info
+        return info
 
     def describe(device):
         """\
         Get a human readable description.
-        For USB-Serial devices try to run lsusb to get a human readable description.
+        For USB-Serial devices the strings of the device are read from sysfs.
         For USB-CDC devices read the description from sysfs.
         """
         base = os.path.basename(device)
         # USB-Serial devices
-        sys_dev_path = '/sys/class/tty/%s/device/driver/%s' % (base, base)
+        sys_dev_path = '%s/%s/device/driver/%s' % (sysfs_tty, base, base)
         if os.path.exists(sys_dev_path):
-            sys_usb = os.path.dirname(os.path.dirname(os.path.realpath(sys_dev_path)))
-            return usb_lsusb_string(sys_usb)
+            info = usb_info(base)
+            if info:
+                return info[0]
         # USB-CDC devices
-        sys_dev_path = '/sys/class/tty/%s/device/interface' % (base,)
+        sys_dev_path = '%s/%s/device/interface' % (sysfs_tty, base)
         if os.path.exists(sys_dev_path):
             return read_line(sys_dev_path)
         return base
@@ -107,27 +120,48 @@ if   plat[:5] == 'linux':    # Linux (confirmed)
     def hwinfo(device):
         """Try to get a HW identification using sysfs"""
         base = os.path.basename(device)
-        if os.path.exists('/sys/class/tty/%s/device' % (base,)):
+        if os.path.exists('%s/%s/device' % (sysfs_tty, base)):
             # PCI based devices
-            sys_id_path = '/sys/class/tty/%s/device/id' % (base,)
+            sys_id_path = '%s/%s/device/id' % (sysfs_tty, base)
             if os.path.exists(sys_id_path):
                 return read_line(sys_id_path)
-            # USB-Serial devices
-            sys_dev_path = '/sys/class/tty/%s/device/driver/%s' % (base, base)
-            if os.path.exists(sys_dev_path):
-                sys_usb = os.path.dirname(os.path.dirname(os.path.realpath(sys_dev_path)))
-                return usb_sysfs_hw_string(sys_usb)
-            # USB-CDC devices
-            if base.startswith('ttyACM'):
-                sys_dev_path = '/sys/class/tty/%s/device' % (base,)
-                if os.path.exists(sys_dev_path):
-                    return usb_sysfs_hw_string(sys_dev_path + '/..')
+            # USB-Serial and USB-CDC devices
+            if base.startswith('ttyUSB') or base.startswith('ttyACM'):
+                info = usb_info(base)
+                if info:
+                    return info[1]
         return 'n/a'    # XXX directly remove these from the list?
 
+    def tty_names(prefixes):
+        """names of the ttys in sysfs starting with one of prefixes"""
+        try:
+            names = os.listdir(sysfs_tty)
+        except OSError:
+            return []
+        return [name for name in names if name.startswith(prefixes) and os.path.exists('/dev/'+name)]
+
     def comports():
-        devices = glob.glob('/dev/ttyS*') + glob.glob('/dev/ttyUSB*') + glob.glob('/dev/ttyACM*')
+        devices = ['/dev/'+name for name in tty_names(tty_prefixes)]
         return [(d, describe(d), hwinfo(d)) for d in devices]
 
+    def usb_id(device):
+        """the hardware ID of the USB tty device, None if it is not a USB device"""
+        base = os.path.basename(os.path.realpath(device))
+        if not base.startswith(('ttyUSB', 'ttyACM')):
+            return None
+        info = usb_info(base)
+        if info:
+            return info[1]
+        return None
+
+    def find_usb_id(hwid):
+        """the device of the USB tty with the hardware ID hwid, None if not found"""
+        for name in tty_names(('ttyUSB', 'ttyACM')):
+            info = usb_info(name)
+            if info and info[1] == hwid:
+                return '/dev/'+name
+        return None
+
 elif plat == 'cygwin':       # cygwin/win32
     def comports():
         devices = glob.glob('/dev/com*')
@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+
+#
+# Copyright (C) 2014 Erwin Rieger
+#
+
+#
+# Per command instrumentation of the usb transfer.
+#
+# For each command the send time, the time of its ACK, the number of
+# bytes and whether it is packed is recorded, commands discarded by the
+# firmware after an error count as resends. The ACK latencies are
+# aggregated into histograms with logarithmic buckets, so the memory
+# used does not grow with the length of the print.
+#
+# The metrics are exported as json lines: an "interval" record every
+# 'interval' seconds while sending and a "report" record with the totals
+# when the transfer has finished, e.g.:
+#
+#   {"type": "interval", "port": "/dev/ttyACM0", "seconds": 10.0,
+#    "commands": 51234, "commandsPerSec": 5123.4, "bytesPerSec": 60123.0,
+#    "resends": 0, "resendRate": 0.0,
+#    "latencyMs": {"p50": 1.1, "p95": 1.9, "p99": 4.2, "max": 12.0}, ...}
+#
+
+import math, time, json, collections, logging
+
+log = logging.getLogger("ultiprint.metrics")
+
+class LatencyHistogram:
+
+    # Width of the buckets, each bucket is 5% wider than the previous
+    # one. Bucket n holds the latencies from base**n to base**(n+1)
+    # microseconds.
+    base = 1.05
+
+    def __init__(self):
+
+        self.buckets = collections.defaultdict(int)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+
+        us = max(seconds * 1000000, 1)
+        self.buckets[int(math.log(us, self.base))] += 1
+
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def merge(self, other):
+
+        for (n, count) in other.buckets.iteritems():
+            self.buckets[n] += count
+
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    # Latency in seconds below which 'p' percent of the commands
+    # were acknowledged, the upper bound of the bucket.
+    def percentile(self, p):
+
+        if not self.count:
+            return 0.0
+
+        limit = self.count * p / 100.0
+        n = 0
+
+        for bucket in sorted(self.buckets):
+            n += self.buckets[bucket]
+            if n >= limit:
+                return min(self.base ** (bucket+1) / 1000000, self.max)
+
+        return self.max
+
+    # Latencies in milliseconds
+    def summary(self):
+
+        mean = 0.0
+        if self.count:
+            mean = self.total / self.count
+
+        return {
+            "p50": self.percentile(50) * 1000,
+            "p95": self.percentile(95) * 1000,
+            "p99": self.percentile(99) * 1000,
+            "mean": mean * 1000,
+            "max": self.max * 1000,
+            }
+
+class CommandCounter:
+
+    def __init__(self):
+
+        self.commands = 0
+        self.bytes = 0
+        self.packed = 0
+        self.packedBytes = 0
+        self.acked = 0
+        self.resends = 0
+        self.latency = LatencyHistogram()
+
+    def record(self, now, start):
+
+        seconds = now - start
+        rate = lambda n: seconds and n / seconds
+
+        resendRate = 0.0
+        if self.commands:
+            resendRate = float(self.resends) / self.commands
+
+        return {
+            "seconds": seconds,
+            "commands": self.commands,
+            "bytes": self.bytes,
+            "packedCommands": self.packed,
+            "packedBytes": self.packedBytes,
+            "unpackedCommands": self.commands - self.packed,
+            "unpackedBytes": self.bytes - self.packedBytes,
+            "acked": self.acked,
+            "resends": self.resends,
+            "resendRate": resendRate,
+            "commandsPerSec": rate(self.commands),
+            "bytesPerSec": rate(self.bytes),
+            "latencyMs": self.latency.summary(),
+            }
+
+class CommandMetrics:
+
+    def __init__(self, interval=10):
+
+        # Seconds between two interval records
+        self.interval = interval
+
+        self.start()
+
+    # Reset the metrics for the next transfer
+    def start(self, now=None):
+
+        now = now or time.time()
+
+        self.startTime = now
+        self.intervalStart = now
+
+        # Send time and packed flag of the commands in flight
+        self.pending = collections.deque()
+
+        # Totals and the counts of the current interval, the latencies
+        # of packed and unpacked commands are kept apart.
+        self.total = CommandCounter()
+        self.current = CommandCounter()
+        self.unpackedLatency = LatencyHistogram()
+        self.packedLatency = LatencyHistogram()
+
+    def sent(self, nbytes, packed, now=None):
+
+        self.pending.append((now or time.time(), packed))
+
+        for counter in (self.total, self.current):
+            counter.commands += 1
+            counter.bytes += nbytes
+            if packed:
+                counter.packed += 1
+                counter.packedBytes += nbytes
+
+    def acked(self, now=None):
+
+        if not self.pending:
+            return
+
+        (sendTime, packed) = self.pending.popleft()
+        latency = (now or time.time()) - sendTime
+
+        for counter in (self.total, self.current):
+            counter.acked += 1
+            counter.latency.add(latency)
+
+        if packed:
+            self.packedLatency.add(latency)
+        else:
+            self.unpackedLatency.add(latency)
+
+    # The firmware has rejected a command, the commands in flight
+    # are discarded and sent again.
+    def resend(self):
+
+        for counter in (self.total, self.current):
+            counter.resends += len(self.pending)
+
+        self.pending.clear()
+
+    # Returns the record of the current interval if it is over (or
+    # 'force' is set) and something was sent, else None.
+    def poll(self, now=None, force=False):
+
+        now = now or time.time()
+
+        if now - self.intervalStart < self.interval and not force:
+            return None
+
+        if not (self.current.commands or self.current.acked):
+            # Nothing sent, e.g. while printing from sd
+            self.intervalStart = now
+            return None
+
+        record = self.current.record(now, self.intervalStart)
+        record["type"] = "interval"
+        record["time"] = now
+
+        self.current = CommandCounter()
+        self.intervalStart = now
+
+        return record
+
+    # The totals of the transfer
+    def report(self, now=None):
+
+        now = now or time.time()
+
+        record = self.total.record(now, self.startTime)
+        record["type"] = "report"
+        record["time"] = now
+        record["packedLatencyMs"] = self.packedLatency.summary()
+        record["unpackedLatencyMs"] = self.unpackedLatency.summary()
+
+        return record
+
+    def printReport(self, now=None):
+
+        record = self.report(now)
+
+        log.info("Command metrics:")
+        log.info("  %d commands (%d packed, %d unpacked), %d bytes in %.1f seconds, %.1f bytes/sec",
+            record["commands"], record["packedCommands"], record["unpackedCommands"], record["bytes"], record["seconds"], record["bytesPerSec"])
+        log.info("  %d resends, resend rate: %.4f", record["resends"], record["resendRate"])
+
+        for (name, key) in (("all", "latencyMs"), ("packed", "packedLatencyMs"), ("unpacked", "unpackedLatencyMs")):
+            lat = record[key]
+            log.info("  ACK latency %-8s p50: %7.2f ms, p95: %7.2f ms, p99: %7.2f ms, max: %7.2f ms", name, lat["p50"], lat["p95"], lat["p99"], lat["max"])
+
+# Write 'record' as a json line to the file 'out'
+def writeRecord(out, record, **fields):
+
+    record = dict(record)
+    record.update(fields)
+
+    out.write(json.dumps(record, sort_keys=True) + "\n")
+    out.flush()
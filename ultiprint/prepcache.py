@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+
+#
+# Copyright (C) 2014 Erwin Rieger
+#
+
+#
+# Persistent cache of preprocessed (packed) gcode.
+#
+# File format, all numbers little endian:
+#
+# Header:
+#   8 bytes:           magic "ULTIPREP"
+#   2 bytes:           file format version
+#   2 bytes:           packer version, see Preprocessor.packerVersion
+#   4 bytes:           number of commands
+#   8 bytes:           offset of the command offset table
+#   8 bytes:           offset of the meta data
+#   4 bytes:           size of the meta data
+#
+# Body:                the packed commands, back to back
+# Offset table:        number of commands + 1 unsigned ints, start of
+#                      each command in the file
+# Meta data:           json, the statistics of the preprocessor and of
+#                      the gcode passes, the expected responses of the
+#                      commands, the mode (store or print) and the packer
+#                      options
+#
+# The body is written first, so a file can be written while the commands
+# are generated. Cached files are memory-mapped when read.
+#
+# The same format is used for the files written by "ultiprint.py pre -o",
+# they can be sent with the print and store modes as they are.
+#
+
+import os, time, struct, mmap, array, json, hashlib, logging
+
+magic = "ULTIPREP"
+formatVersion = 1
+
+header = struct.Struct("<8sHHIQQI")
+
+log = logging.getLogger("ultiprint.prepcache")
+
+class PrepWriter:
+
+    # Write a preprocessed gcode file, the file is written to a temporary
+    # file first and renamed to 'path' in close().
+    def __init__(self, path, packerVersion):
+
+        self.path = path
+        self.tmpPath = "%s.%d.tmp" % (path, os.getpid())
+        self.packerVersion = packerVersion
+
+        self.f = open(self.tmpPath, "wb")
+        # Placeholder, the real header is written in close()
+        self.f.write("\0" * header.size)
+
+        self.pos = header.size
+        self.offsets = array.array("I", [self.pos])
+        self.replies = {}
+
+    def add(self, cmd, response):
+
+        if response:
+            self.replies[str(len(self.offsets) - 1)] = response
+
+        self.f.write(cmd)
+        self.pos += len(cmd)
+        self.offsets.append(self.pos)
+
+    # Finish the file, prep is the preprocessor that has
+    # created the commands.
+    def close(self, prep):
+
+        meta = json.dumps({
+            "origbytes": prep.origbytes,
+            "packbytes": prep.packbytes,
+            "uncompressedCmds": prep.uncompressedCmds,
+            "packedCmds": prep.packedCmds,
+            "passStats": prep.passStats,
+            "replies": self.replies,
+            "mode": prep.mode,
+            "options": prep.options,
+            })
+
+        offsetsPos = self.pos
+        self.offsets.tofile(self.f)
+        metaPos = offsetsPos + len(self.offsets) * self.offsets.itemsize
+        self.f.write(meta)
+
+        self.f.seek(0)
+        self.f.write(header.pack(magic, formatVersion, self.packerVersion, len(self.offsets) - 1, offsetsPos, metaPos, len(meta)))
+        self.f.close()
+
+        os.rename(self.tmpPath, self.path)
+
+    # Remove the temporary file of an unfinished write
+    def abort(self):
+
+        self.f.close()
+        os.remove(self.tmpPath)
+
+class PrepFile:
+
+    # Memory-mapped, read only view of a preprocessed gcode file. Indexing
+    # returns (command, response) tuples like the Preprocessor.prep list.
+    def __init__(self, path):
+
+        self.path = os.path.abspath(path)
+
+        self.f = open(path, "rb")
+        self.mm = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        (m, version, self.packerVersion, count, offsetsPos, metaPos, metaLen) = header.unpack_from(self.mm)
+
+        if m != magic or version != formatVersion:
+            raise IOError("%s: not a preprocessed gcode file or unsupported version" % path)
+
+        self.offsets = array.array("I")
+        self.offsets.fromstring(self.mm[offsetsPos:offsetsPos + (count + 1) * self.offsets.itemsize])
+
+        meta = json.loads(self.mm[metaPos:metaPos + metaLen])
+
+        self.origbytes = meta["origbytes"]
+        self.packbytes = meta["packbytes"]
+        self.uncompressedCmds = dict([(str(cmd), n) for (cmd, n) in meta["uncompressedCmds"].items()])
+        self.packedCmds = dict([(str(cmd), stat) for (cmd, stat) in meta["packedCmds"].items()])
+        self.replies = dict([(int(pos), str(reply)) for (pos, reply) in meta["replies"].items()])
+        self.passStats = [[str(name), commands, nbytes] for (name, commands, nbytes) in meta.get("passStats", [])]
+        self.mode = str(meta.get("mode", ""))
+        self.options = str(meta.get("options", ""))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, pos):
+
+        if pos < 0 or pos >= len(self.offsets) - 1:
+            raise IndexError("gcode position %d out of range" % pos)
+
+        return (self.mm[self.offsets[pos]:self.offsets[pos+1]], self.replies.get(pos))
+
+    def close(self):
+
+        self.mm.close()
+        self.f.close()
+
+# Returns True if 'path' is a preprocessed gcode file
+def isPrepFile(path):
+
+    f = open(path, "rb")
+    m = f.read(len(magic))
+    f.close()
+
+    return m == magic
+
+# Write the commands of the preprocessor 'prep' to the file 'path'
+def writePrepFile(path, prep, packerVersion):
+
+    writer = PrepWriter(path, packerVersion)
+
+    try:
+        for (cmd, response) in prep.prep:
+            writer.add(cmd, response)
+    except:
+        writer.abort()
+        raise
+
+    writer.close(prep)
+
+class PrepCache:
+
+    # Suffix of the cache files
+    suffix = ".prep"
+
+    # Cache directory 'cacheDir' with a max. size of 'maxSize' bytes,
+    # least recently used files are evicted first.
+    def __init__(self, cacheDir, maxSize):
+
+        self.cacheDir = os.path.expanduser(cacheDir)
+        self.maxSize = maxSize
+
+        if not os.path.isdir(self.cacheDir):
+            os.makedirs(self.cacheDir)
+
+    # Cache key of a gcode file: hash of the file contents, the mode (the
+    # commands sent before the file depend on the mode), the packer
+    # version and the packer options.
+    def key(self, filename, mode, packerVersion, options=""):
+
+        h = hashlib.sha1()
+
+        f = open(filename, "rb")
+        while True:
+            data = f.read(1024*1024)
+            if not data:
+                break
+            h.update(data)
+        f.close()
+
+        key = "%s-%s-%d" % (h.hexdigest(), mode, packerVersion)
+        if options:
+            key += "-" + options
+
+        return key
+
+    def path(self, key):
+        return os.path.join(self.cacheDir, key + PrepCache.suffix)
+
+    # Returns the memory-mapped cache file for key or None.
+    def get(self, key):
+
+        path = self.path(key)
+
+        if not os.path.exists(path):
+            return None
+
+        # Mark as recently used
+        os.utime(path, None)
+
+        return PrepFile(path)
+
+    # Returns a writer for a new cache file
+    def writer(self, key, packerVersion):
+        return PrepWriter(self.path(key), packerVersion)
+
+    # Evict the least recently used files until the cache size is below
+    # maxSize, the most recently used file is always kept. Left over
+    # temporary files older than an hour are removed, too.
+    def evict(self):
+
+        files = []
+        size = 0
+
+        for name in os.listdir(self.cacheDir):
+
+            path = os.path.join(self.cacheDir, name)
+            st = os.stat(path)
+
+            if name.endswith(".tmp"):
+                if st.st_mtime < time.time() - 3600:
+                    os.remove(path)
+                continue
+
+            if name.endswith(PrepCache.suffix):
+                files.append((st.st_mtime, st.st_size, path))
+                size += st.st_size
+
+        files.sort()
+
+        while len(files) > 1 and size > self.maxSize:
+            (mtime, fsize, path) = files.pop(0)
+            log.info("Evicting cache file: %s", path)
+            os.remove(path)
+            size -= fsize
+
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+
+#
+# Copyright (C) 2014 Erwin Rieger
+#
+
+#
+# Event loop to drive several printers from one process.
+#
+# The printers use non-blocking reads, the loop waits with select() until
+# one of the serial lines is readable (or a timer of a printer, like the
+# pause after an error, may have expired) and then lets each printer
+# process its input and fill its send window with Printer.processCommand().
+#
+# While a printer is disconnected, the loop waits for its device to come
+# back instead (see Printer.reconnect()).
+#
+# Writes are blocking, the data in flight is limited by the send window
+# of the printer, so a write does not block for long.
+#
+
+import select
+
+class PrinterLoop:
+
+    # Max. time to wait for input, the timers of the printers
+    # are checked at least this often.
+    pollInterval = 0.1
+
+    def __init__(self):
+
+        self.printers = []
+
+        # Set if a printer has sent or received something, the
+        # next poll does not wait then.
+        self.more = False
+
+    # Add a printer to the loop and start sending the list of
+    # (command, response) tuples 'gcode'.
+    def add(self, printer, gcode, wantReply=None):
+
+        # Non-blocking reads
+        printer.readTimeout = 0
+        printer.timeout = 0
+
+        printer.startGcode(gcode, wantReply)
+
+        self.printers.append(printer)
+
+    # Called by Printer.processCommand(), like wx.IdleEvent.RequestMore()
+    def RequestMore(self, more):
+        self.more = self.more or more
+
+    # Wait for input and let each printer process it, returns the
+    # printers that are done, they are removed from the loop.
+    def step(self):
+
+        timeout = self.pollInterval
+        if self.more:
+            timeout = 0
+
+        self.more = False
+
+        # A printer that waits for its device to come back
+        # may have nothing to wait for (see Printer.fileno())
+        select.select([printer for printer in self.printers if printer.fileno() != None], [], [], timeout)
+
+        finished = []
+
+        for printer in self.printers[:]:
+
+            if not printer.processCommand(self):
+                self.printers.remove(printer)
+                finished.append(printer)
+
+        return finished
+
+    # Run until all printers are done
+    def run(self):
+
+        while self.printers:
+            self.step()
+
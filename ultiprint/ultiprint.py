@@ -16,15 +16,29 @@
 # N5860 G1 F3000 X153.16 Y123.17 Z38.80 E459.21186*62 -> 51 bytes
 # 
 # 1 byte:            command key, 1-9
-# 1 byte:           'parameter mask', bits: FXYZES00 (2 unused bits)
+# 1 byte:           'parameter mask', bits: FXYZESIJ (I and J for arcs only)
 # 2 bytes:           F param
 # 4 bytes:           X param
 # 4 bytes:           Y param
 # 4 bytes:           Z param
 # 4 bytes:           E param
+# 4 bytes:           I param
+# 4 bytes:           J param
 # 2/4 bytes:         2 or 4byte line counter, am schluss, damit einfach abzuschneiden
 # 1 byte:            checksum
+#
+# With -r (M624 S1) the checksum and the newline of the packed commands
+# are replaced by a CRC-16 (XModem, binascii.crc_hqx()), see crcCommand().
 # 
+# Packed M-codes:
+#
+# 1 byte:            command key 7
+# 1 byte:           'parameter mask', bits: ST000S00 (S param, T param, short line number)
+# 1 byte:            number of the M-code
+# 2 bytes:           S param (unsigned short)
+# 1 byte:            T param
+# 2/4 bytes:         2 or 4byte line counter
+# 1 byte:            checksum
 # 
 # Kompressed command keys:
 # 
@@ -32,9 +46,61 @@
 #   G1:  2
 #   G10: 3
 #   G11: 4
+#   G2:  5
+#   G3:  6
+#   M104, M106, M107, M109, M140: 7
+#   Delta encoded G0/G1: 8, see deltapack.py
+#   Block of commands to store on the SD card: 9, see blockstore.py
 # 
+# With -O the lines are run through gcode passes before they are packed
+# (comment stripping, normalised numbers, no repeated modal params), see
+# gcodepass.py.
+#
+#
+# Send window:
+#
+# By default the next command is sent after the ACK of the previous one
+# (stop and wait). With a send window of N commands, up to N commands are
+# in flight. The number of bytes in flight is limited to the size of the
+# firmware's serial receive buffer (RX_BUFFER_SIZE in MarlinSerial.h), so
+# the firmware never drops characters. On a "Error: ... Last Line:" reply
+# the window is rewound to the command following the last accepted line.
+# The resend is paused while the firmware drains its receive buffer, the
+# pause grows for bursts of errors, see Printer.errorPause().
+#
+#
+# Reconnect:
+#
+# When the serial line is dead, the printer watches /dev for the tty to
+# come back (see hotplug.py) and reattaches to the device with the same
+# usb id, the commands in flight are sent again. A printer that is not
+# back within Printer.reconnectTimeout seconds (-R) has most likely been
+# power-cycled and lost the state of the print, it is not reattached.
+#
+#
+# Checkpoint and resume:
+#
+# With -K the resume position of a print and the modal state of the
+# printer are saved to a checkpoint file, about once a second (see
+# checkpoint.py). The resume position is -B commands before the first
+# command not acknowledged, the acknowledged commands in the firmware's
+# buffers are not printed yet. After a crash of the host, "resume
+# <checkpoint>" sends the preprocessed file from this position on,
+# without preprocessing it again: M110 sets the line number, the commands
+# to setup the transfer and to restore the modal state follow, numbered
+# so that the commands of the file keep their line numbers. A store can't
+# be resumed, the firmware truncates usb.g.
+#
+#
+# Console output:
+#
+# All messages go through the logger "ultiprint". The per command output
+# (sent commands and ACKs) is logged at debug level only (-v), -q reports
+# only progress (logger "ultiprint.progress") and errors. Progress lines
+# are rate-limited to one per Printer.progressInterval seconds.
+#
 
-import sys, time, struct, argparse, collections
+import sys, time, struct, binascii, argparse, collections, itertools, gc, array, multiprocessing, logging
 
 from serial import Serial, SerialException 
 
@@ -51,6 +117,17 @@ from serial import Serial, SerialException
 #
 import list_ports
 
+import bulkpack
+import deltapack
+import prepcache
+import printerloop
+import gcodefile
+import metrics
+import blockstore
+import hotplug
+import checkpoint
+import gcodepass
+
 # >>> list_ports.comports()
 # [('/dev/ttyS3', 'ttyS3', 'n/a'),
 #('/dev/ttyS2', 'ttyS2', 'n/a'),
@@ -60,69 +137,322 @@ import list_ports
 #('/dev/ttyUSB0', 'Linux Foundation 2.0 root hub ', 'USB VID:PID=0403:f06f SNR=ELU2CSFC'),
 #('/dev/ttyACM0', 'ttyACM0', 'USB VID:PID=2341:0042 SNR=75237333536351815111')]
 
+log = logging.getLogger("ultiprint")
+progress = logging.getLogger("ultiprint.progress")
+
+# Setup the console output, see above
+def setupLogging(verbose=False, quiet=False):
+
+    level = logging.INFO
+    if verbose:
+        level = logging.DEBUG
+    elif quiet:
+        level = logging.WARNING
+
+    logging.basicConfig(format="%(message)s", stream=sys.stdout)
+
+    log.setLevel(level)
+    progress.setLevel(min(level, logging.INFO))
+
 class DummyEvent:
 
     def RequestMore(self, b):
         pass
 
-class Preprocessor:
+class LazyGCode:
 
-    def __init__(self, mode, filename=None, gcode=[], stream=None):
+    # Sequence like view of a lazily preprocessed gcode stream.
+    # Commands are pulled from the packing generator on demand, only the
+    # last 'lookback' commands are kept for command resends triggered
+    # by checkError() (gcodePos = lastLine + 1).
+    def __init__(self, gen, lookback=1000):
 
-        self.lineNr = 0
-        self.origbytes = 0
-        self.packbytes = 0
-        self.uncompressedCmds = collections.defaultdict(int)
+        self.gen = gen
+        self.window = collections.deque(maxlen=lookback)
 
-        # Always reset line counter first
-        gcode = [("M110", "ok")] + gcode
+        # Number of commands pulled from the generator so far
+        self.pulled = 0
+        # Highest position accessed so far
+        self.maxPos = -1
+        self.exhausted = False
+
+    # Pull commands from the generator until the command at
+    # position pos is available (or the generator is exhausted).
+    def fill(self, pos):
 
-        if filename or stream:
+        while self.pulled <= pos and not self.exhausted:
+            try:
+                self.window.append(self.gen.next())
+                self.pulled += 1
+            except StopIteration:
+                self.exhausted = True
 
-            # If in printing mode, then send custom M623 command,
-            # select file for UM2 print
-            if mode == "print":
-                gcode += [("M623 usb.g", "ok")]
+    # Pull all remaining commands, for example to get the
+    # preprocessor statistics.
+    def drain(self):
 
-            # Store or print mode, open the file on the
-            # SD card with the M28 command, then send the
-            # contents of the file given on the commandline.
-            # Close file on SD card with M29 if done.
-            gcode += [("M28 usb.g", "ok")]
+        while not self.exhausted:
+            self.fill(self.pulled)
 
-            if filename:
-                inFile = open(filename)
+    # Number of commands known so far. The stream is always read one
+    # command ahead of the highest accessed position, so
+    # 'pos < len(gcode)' tells if there is a command to send at pos.
+    def __len__(self):
 
-                print "Preprocessing:", filename
-                sys.stdout.flush()
+        self.fill(self.maxPos + 1)
+        return self.pulled
 
-                for line in inFile.readlines():
-    
-                    # Strip very long lines like ";CURA_PROFILE_STRING" line at the end of the file:
-                    # Marlin: #define MAX_CMD_SIZE 96
-                    if len(line) > 80:
-                        continue
+    def __getitem__(self, pos):
 
-                    gcode.append((line, None))
+        self.fill(pos)
 
-            if filename:
-                inFile.close()
-            else:
-                
-                print "Preprocessing:", stream
+        if pos >= self.pulled:
+            raise IndexError("gcode position %d out of range" % pos)
+
+        index = pos - (self.pulled - len(self.window))
+        if index < 0:
+            raise IndexError("gcode position %d not in lookback window" % pos)
+
+        self.maxPos = max(self.maxPos, pos)
+        return self.window[index]
+
+class PackedGCode:
+
+    # Compact sequence of the packed (command, response) tuples: the
+    # commands are stored back to back in one bytearray with an index
+    # of their offsets, the few responses are kept by position. This
+    # needs about 4 bytes per command on top of the command itself,
+    # instead of a string and a tuple per command.
+    def __init__(self, commands=()):
+
+        self.data = bytearray()
+        self.offsets = array.array("I", [0])
+        self.replies = {}
+
+        self.extend(commands)
+
+    def append(self, cmd, response=None):
+
+        if response:
+            self.replies[len(self.offsets) - 1] = response
+
+        self.data += cmd
+        self.offsets.append(len(self.data))
+
+    def extend(self, commands):
+
+        for (cmd, response) in commands:
+            self.append(cmd, response)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, pos):
+
+        if pos < 0:
+            pos += len(self.offsets) - 1
+
+        if pos < 0 or pos >= len(self.offsets) - 1:
+            raise IndexError("gcode position %d out of range" % pos)
+
+        return (bytes(self.data[self.offsets[pos]:self.offsets[pos+1]]), self.replies.get(pos))
+
+    def __iter__(self):
+
+        for pos in xrange(len(self.offsets) - 1):
+            yield self[pos]
+
+    # The commands 'start' to 'end' - 1 as one block, a view of
+    # the buffer without a copy.
+    def view(self, start, end):
+        return memoryview(self.data)[self.offsets[start]:self.offsets[end]]
+
+class ResumedGCode:
+
+    # Sequence of the commands of the preprocessed file 'prep' from the
+    # position 'resumePos' on, for the resume of a transfer. The
+    # (command, response) tuples of 'head' are sent first, as ascii
+    # commands numbered so that the positions stay the line numbers, the
+    # first position to send is 'start'.
+    #
+    # The firmware doesn't have the reference values of the delta
+    # encoded moves after a reset, 'reference' is the list of the values
+    # the moves are encoded against. Delta encoded moves are sent as
+    # absolute moves until each axis has got an absolute value.
+    def __init__(self, prep, resumePos, head, reference, crc):
+
+        self.prep = prep
+        self.resumePos = resumePos
+        self.start = resumePos - len(head)
+        self.head = [(asciiCommand(cmd, self.start + i), response) for (i, (cmd, response)) in enumerate(head)]
+        self.crc = crc
+
+        self.reference = list(reference)
+        self.referenced = [False, False, False, False]
+        # Next position to check for a delta encoded move, and
+        # the moves sent as absolute moves by position
+        self.scanPos = resumePos
+        self.absolute = {}
+
+    def __len__(self):
+        return len(self.prep)
+
+    def __getitem__(self, pos):
+
+        if pos < self.start or pos >= len(self.prep):
+            raise IndexError("gcode position %d out of range" % pos)
+
+        if pos < self.resumePos:
+            return self.head[pos - self.start]
 
-                for line in stream:
+        while self.scanPos <= pos and not all(self.referenced):
+            self.scan(self.scanPos)
+            self.scanPos += 1
 
-                    # Strip very long lines like ";CURA_PROFILE_STRING" line at the end of the file:
-                    # Marlin: #define MAX_CMD_SIZE 96
-                    if len(line) > 80:
-                        continue
+        (cmd, response) = self.prep[pos]
+        return (self.absolute.get(pos, cmd), response)
 
-                    gcode.append((line, None))
+    def scan(self, pos):
 
-            gcode.append(("M29", Printer.endStoreToken))
+        cmd = self.prep[pos][0]
 
-        self.prep = self.preprocessGCode(gcode)
+        if not isPackedCommand(cmd):
+            return
+
+        key = ord(cmd[0])
+
+        if key in (1, 2, 5, 6):
+            values = deltapack.unpackAxes(cmd)[2]
+            for i in range(4):
+                if values[i] != None:
+                    self.reference[i] = values[i]
+
+        elif key == deltapack.deltaKey:
+            (values, codes) = deltapack.unpackDelta(cmd, self.reference)
+            if [i for i in range(4) if codes[i] in (deltapack.DELTA8, deltapack.DELTA16) and not self.referenced[i]]:
+                move = deltapack.absoluteMove(values, pos)
+                if self.crc:
+                    move = crcCommand(move)
+                self.absolute[pos] = move
+
+        else:
+            return
+
+        for i in range(4):
+            if values[i] != None:
+                self.referenced[i] = True
+
+class Preprocessor:
+
+    # Number of lines packed at once by the bulk packer
+    chunkSize = 4096
+
+    # Number of lines packed by a worker process in parallel mode
+    sliceSize = 16 * chunkSize
+
+    # Version of the packed format, part of the cache key. Increment
+    # if the output of the packer changes.
+    packerVersion = 2
+
+    # Parameters of packed G2/G3 arcs (command keys 5 and 6), in the
+    # order they are packed: letter, bit in the parameter mask, struct
+    # format and range of integer parameters.
+    arcParams = (
+        ("F", 1 << 7, "<H", 1, 0xffff),
+        ("X", 1 << 6, "<f", None, None),
+        ("Y", 1 << 5, "<f", None, None),
+        ("Z", 1 << 4, "<f", None, None),
+        ("E", 1 << 3, "<f", None, None),
+        ("I", 1 << 1, "<f", None, None),
+        ("J", 1 << 0, "<f", None, None),
+        )
+
+    # M-codes packed with command key 7
+    packedMCodes = ("M104", "M106", "M107", "M109", "M140")
+
+    # Parameters of packed M-codes, see arcParams
+    mcodeParams = (
+        ("S", 1 << 7, "<H", 0, 0xffff),
+        ("T", 1 << 6, "<B", 0, 0xff),
+        )
+
+    def __init__(self, mode, filename=None, gcode=[], stream=None, lazy=False, bulk=True, cache=None, jobs=1, delta=False, crc=False, passes=()):
+
+        self.initPacker(bulk, delta, crc)
+
+        # G-code passes run before packing, see gcodepass.py
+        self.passes = None
+        if passes:
+            self.passes = gcodepass.Pipeline(passes)
+            self.passStats = self.passes.stats
+
+        # Number of worker processes, the lazy mode packs in
+        # the sending process.
+        self.jobs = 1
+        if not lazy:
+            self.jobs = jobs
+
+        # Cache of preprocessed files, key of this file
+        self.cache = None
+        self.cacheKey = None
+
+        self.mode = mode
+        options = [name for (name, on) in (("delta", delta), ("crc", crc)) if on]
+        if self.passes:
+            options += self.passes.names()
+        self.options = ",".join(options)
+
+        if filename and prepcache.isPrepFile(filename):
+
+            # Written by "pre -o", send as it is
+            prepFile = prepcache.PrepFile(filename)
+
+            if prepFile.mode != mode:
+                raise IOError("%s: preprocessed for %s mode, not for %s mode" % (filename, prepFile.mode, mode))
+
+            log.info("Using preprocessed gcode file: %s, packer version %d, options: '%s'", filename, prepFile.packerVersion, prepFile.options)
+            self.usePrepFile(prepFile)
+            return
+
+        if cache and filename and not gcode:
+
+            key = cache.key(filename, mode, Preprocessor.packerVersion, self.options)
+            cached = cache.get(key)
+
+            if cached:
+                log.info("Using cached preprocessed gcode: %s", cache.path(key))
+                self.usePrepFile(cached)
+                return
+
+            # Write the packed commands to the cache
+            self.cache = cache
+            self.cacheKey = key
+
+        gcode = source = self.readGCode(mode, filename, gcode, stream, not lazy)
+
+        if self.passes:
+            gcode = self.passes.run(source)
+
+        if lazy:
+            # Pack commands on demand while sending
+            self.prep = LazyGCode(self.packLines(gcode))
+        else:
+            # A mapped file is read line by line while packing, as
+            # are the lines of the gcode passes. Other input is read
+            # into a list.
+            if not isinstance(gcode, gcodefile.GCodeFile) and not self.passes:
+                gcode = list(gcode)
+
+            # The gcode lists contain no reference cycles, don't let the
+            # garbage collector scan the millions of new tuples.
+            gc.disable()
+            try:
+                self.prep = self.preprocessGCode(gcode)
+            finally:
+                gc.enable()
+
+            if isinstance(source, gcodefile.GCodeFile):
+                source.close()
 
         # debug
         """
@@ -144,17 +474,141 @@ class Preprocessor:
             f.close()
         """
 
+    # The preprocessed commands as memory-mapped file (see
+    # prepcache.py), None if they are not in a file.
+    def prepFile(self):
+
+        if self.cacheKey and isinstance(self.prep, PackedGCode):
+            cached = self.cache.get(self.cacheKey)
+            if cached:
+                self.usePrepFile(cached)
+
+        if isinstance(self.prep, prepcache.PrepFile):
+            return self.prep
+
+        return None
+
+    # Use the commands and the statistics of the
+    # preprocessed file 'prepFile'.
+    def usePrepFile(self, prepFile):
+
+        self.origbytes = prepFile.origbytes
+        self.packbytes = prepFile.packbytes
+        self.uncompressedCmds.update(prepFile.uncompressedCmds)
+        self.packedCmds.update(prepFile.packedCmds)
+        self.passStats = prepFile.passStats
+        self.prep = prepFile
+
+    def initPacker(self, bulk, delta, crc):
+
+        # Use the bulk packer if numpy is available
+        self.bulk = bulk and bulkpack.available()
+
+        # Delta encoding of moves, see deltapack.py
+        self.delta = delta
+        self.deltaEncoder = deltapack.DeltaEncoder()
+        # Number of input lines read, the delta encoder is reset
+        # at the start of each slice.
+        self.rawPos = 0
+
+        # CRC-16 instead of the XOR checksum, see crcCommand()
+        self.crc = crc
+
+        self.lineNr = 0
+        self.origbytes = 0
+        self.packbytes = 0
+        self.uncompressedCmds = collections.defaultdict(int)
+        # Packed commands: [count, unpacked size, packed size]
+        self.packedCmds = collections.defaultdict(lambda: [0, 0, 0])
+        # Commands and bytes removed by the gcode passes:
+        # [name, commands, bytes]
+        self.passStats = []
+
+    # Count a packed command in the statistics
+    def countPacked(self, cmd, count, origlen, packlen):
+
+        stat = self.packedCmds[cmd]
+        stat[0] += count
+        stat[1] += origlen
+        stat[2] += packlen
+
+    # Returns the (line, response) tuples to preprocess, including
+    # the commands to setup and finish the usb transfer. A file is
+    # memory-mapped (see gcodefile.py) unless 'mapped' is False, the
+    # lazy mode reads it as a stream to keep the memory usage low.
+    def readGCode(self, mode, filename, gcode, stream, mapped=True):
+
+        # Always reset line counter first
+        head = [("M110", "ok")] + list(gcode)
+
+        if not (filename or stream):
+            return head
+
+        # Switch the firmware to the CRC-16 of the packed commands
+        if self.crc:
+            head.append(("M624 S1", "ok"))
+
+        # If in printing mode, then send custom M623 command,
+        # select file for UM2 print
+        if mode == "print":
+            head.append(("M623 usb.g", "ok"))
+
+        # Store or print mode, open the file on the
+        # SD card with the M28 command, then send the
+        # contents of the file given on the commandline.
+        # Close file on SD card with M29 if done.
+        head.append(("M28 usb.g", "ok"))
+        tail = [("M29", Printer.endStoreToken)]
+
+        if filename:
+            log.info("Preprocessing: %s", filename)
+            if mapped:
+                return gcodefile.GCodeFile(filename, head, tail)
+        else:
+            log.info("Preprocessing: %s", stream)
+
+        return itertools.chain(head, self.readStream(filename, stream), tail)
+
+    # Generator, the lines of the file 'filename' or of the
+    # file object 'stream'.
+    def readStream(self, filename, stream):
+
+        if filename:
+            stream = open(filename)
+
+        for line in stream:
+
+            # Strip very long lines like ";CURA_PROFILE_STRING" line at the end of the file:
+            # Marlin: #define MAX_CMD_SIZE 96
+            if len(line) > gcodefile.maxLineLength:
+                continue
+
+            yield (line, None)
+
+        if filename:
+            stream.close()
+
     def printStat(self):
-        print "\n-----------------------------------------------"
-        print "Preprocessor statistics:"
-        print "-----------------------------------------------\n"
-        print "Size of unpacked commands: %d bytes" % self.origbytes
-        print "Size of   packed commands: %d bytes" % self.packbytes
-        print "Compression ratio: %.1f%%" % (self.packbytes*100.0/self.origbytes)
-
-        print "# Uncompressed commands: "
+        log.info("-----------------------------------------------")
+        log.info("Preprocessor statistics:")
+        log.info("-----------------------------------------------")
+        log.info("Size of unpacked commands: %d bytes", self.origbytes)
+        log.info("Size of   packed commands: %d bytes", self.packbytes)
+        log.info("Compression ratio: %.1f%%", self.packbytes*100.0/self.origbytes)
+
+        log.info("# Uncompressed commands: ")
         for cmd in self.uncompressedCmds:
-            print "%-10s: %5d" % (cmd, self.uncompressedCmds[cmd])
+            log.info("%-10s: %5d", cmd, self.uncompressedCmds[cmd])
+
+        log.info("# Packed commands, bytes saved: ")
+        for cmd in sorted(self.packedCmds):
+            (count, origlen, packlen) = self.packedCmds[cmd]
+            log.info("%-10s: %7d, %9d bytes saved (%.1f bytes/command)", cmd, count, origlen - packlen, (origlen - packlen) / float(count))
+
+        if self.passStats:
+            log.info("# G-code passes, removed: ")
+            for (name, commands, nbytes) in self.passStats:
+                log.info("%-10s: %7d commands, %9d bytes", name, commands, nbytes)
 
 
     # Create gcode checksum, this is stolen from
@@ -162,6 +616,26 @@ class Preprocessor:
     def checksum(self, command):
         return reduce(lambda x, y: x ^ y, map(ord, command))
 
+    # Add the line number and the checksum to a packed command, params
+    # are the packed parameters.
+    def packCommand(self, cmdHex, paramFlags, params, lineNr):
+
+        lnHex = struct.pack("<I", lineNr)
+        if lineNr < 0x10000:
+            # pack line number as short
+            paramFlags += 1 << 2
+            lnHex = struct.pack("<H", lineNr)
+
+        packed = struct.pack("<BB", cmdHex, paramFlags) + params
+
+        # add number and checksum
+        packed += lnHex
+
+        chk = self.checksum(packed)
+        packed += struct.pack("<B", chk)
+
+        return packed + "\n"
+
     def packGCode(self, code, lineNr):
 
         # Note: Arduino is little endian
@@ -219,32 +693,20 @@ class Preprocessor:
                 else:
                     assert(0)
 
-            lnHex = struct.pack("<I", lineNr)
-            if lineNr < 0x10000:
-                # pack line number as short
-                paramFlags += 1 << 2
-                lnHex = struct.pack("<H", lineNr)
-
-            packed = struct.pack("<BB", cmdHex, paramFlags)
+            params = ""
 
             if fHex:
-                packed += fHex
+                params += fHex
             if xHex:
-                packed += xHex
+                params += xHex
             if yHex:
-                packed += yHex
+                params += yHex
             if zHex:
-                packed += zHex
+                params += zHex
             if eHex:
-                packed += eHex
+                params += eHex
 
-            # add number and checksum
-            packed += lnHex
-
-            chk = self.checksum(packed)
-            packed += struct.pack("<B", chk)
-
-            return packed + "\n"
+            return self.packCommand(cmdHex, paramFlags, params, lineNr)
 
         if cmd == "G10" or cmd == "G11":
 
@@ -254,30 +716,227 @@ class Preprocessor:
             if cmd == "G11":
                 cmdHex = 4
 
-            lnHex = struct.pack("<I", lineNr)
-            if lineNr < 0x10000:
-                # pack line number as short
-                paramFlags += 1 << 2
-                lnHex = struct.pack("<H", lineNr)
+            return self.packCommand(cmdHex, paramFlags, "", lineNr)
+
+        if cmd == "G2" or cmd == "G3":
+            return self.packArc(splitted, lineNr)
+
+        if cmd in Preprocessor.packedMCodes:
+            return self.packMCode(splitted, lineNr)
+
+    # Pack a G2/G3 arc, arcs the packer can't handle (unknown or
+    # repeated parameters, for example) are sent as plain text.
+    def packArc(self, splitted, lineNr):
+
+        cmdHex = 5
+        if splitted[0] == "G3":
+            cmdHex = 6
+
+        return self.packParams(cmdHex, "", Preprocessor.arcParams, splitted[1:], lineNr)
+
+    # Pack a temperature or fan M-code, the number of the M-code
+    # is packed as first parameter.
+    def packMCode(self, splitted, lineNr):
+
+        mcodeHex = struct.pack("<B", int(splitted[0][1:]))
+
+        return self.packParams(7, mcodeHex, Preprocessor.mcodeParams, splitted[1:], lineNr)
+
+    # Pack the parameters of a command, paramTypes is the table of the
+    # allowed parameters. Returns None if a parameter is unknown, repeated
+    # or out of range, the command is sent as plain text then.
+    def packParams(self, cmdHex, params, paramTypes, splitted, lineNr):
 
-            packed = struct.pack("<BB", cmdHex, paramFlags)
+        values = {}
 
-            # add number and checksum
-            packed += lnHex
+        for param in splitted:
 
-            chk = self.checksum(packed)
-            packed += struct.pack("<B", chk)
+            paramType = param[0]
 
-            return packed + "\n"
+            if paramType in values:
+                return None
+
+            values[paramType] = param[1:]
+
+        paramFlags = 0
+
+        for (paramType, bit, fmt, minValue, maxValue) in paramTypes:
+
+            if paramType not in values:
+                continue
+
+            try:
+                value = float(values.pop(paramType))
+            except ValueError:
+                return None
+
+            if fmt != "<f":
+                # Integer parameter
+                if not value.is_integer() or value < minValue or value > maxValue:
+                    return None
+                value = int(value)
+
+            paramFlags += bit
+            params += struct.pack(fmt, value)
+
+        if values:
+            # Unknown parameter
+            return None
+
+        return self.packCommand(cmdHex, paramFlags, params, lineNr)
 
     def preprocessGCode(self, gcode):
 
-        print "Preprocessing %d gcode lines..." % len(gcode)
+        if isinstance(gcode, (list, gcodefile.GCodeFile)):
+            log.info("Preprocessing %d gcode lines...", len(gcode))
+        else:
+            log.info("Preprocessing gcode lines...")
+
+        prep = PackedGCode(self.packLines(gcode))
+
+        log.info("done...")
+        return prep
+
+    # Generator, pack the (line, response) tuples in gcode and yield
+    # the (command, response) tuples to send.
+    def packLines(self, gcode):
+
+        if self.jobs > 1:
+            packed = self.packParallel(gcode)
+        elif self.bulk:
+            packed = itertools.chain.from_iterable(self.packChunks(gcode))
+        else:
+            packed = self.packSingleLines(gcode)
+
+        if self.cache:
+            packed = self.cacheLines(packed)
+
+        return packed
+
+    # Generator, write the packed (command, response) tuples to the
+    # cache while passing them on. The cache file is only stored if
+    # all commands have been packed.
+    def cacheLines(self, packed):
+
+        writer = self.cache.writer(self.cacheKey, Preprocessor.packerVersion)
+        done = False
+
+        try:
+            for (cmd, response) in packed:
+                writer.add(cmd, response)
+                yield (cmd, response)
+
+            writer.close(self)
+            done = True
+        finally:
+            if not done:
+                writer.abort()
+
+        self.cache.evict()
+
+    # Generator, split the list of lines into slices and pack the
+    # slices in 'jobs' worker processes, yields the (command, response)
+    # tuples in order.
+    def packParallel(self, gcode):
+
+        pool = multiprocessing.Pool(self.jobs)
+
+        try:
+            for (data, lengths, responses, origbytes, packbytes, uncompressedCmds, packedCmds) in pool.imap(packSlice, self.sliceTasks(gcode)):
+
+                self.origbytes += origbytes
+                self.packbytes += packbytes
+                for (cmd, n) in uncompressedCmds.items():
+                    self.uncompressedCmds[cmd] += n
+                for (cmd, stat) in packedCmds.items():
+                    self.countPacked(cmd, *stat)
+
+                pos = 0
+                for (i, length) in enumerate(lengths):
+                    yield (data[pos:pos+length], responses.get(i))
+                    pos += length
+        finally:
+            pool.terminate()
+
+    # Generator, yields the packing tasks for the worker processes: the
+    # slice of lines, the line number of the first command of the
+    # slice and the packer to use.
+    def sliceTasks(self, gcode):
+
+        gcode = iter(gcode)
+
+        while True:
+
+            gslice = list(itertools.islice(gcode, Preprocessor.sliceSize))
+            if not gslice:
+                break
+
+            yield (gslice, self.lineNr, self.bulk, self.delta, self.crc)
+
+            # Line number of the next slice, empty lines are skipped
+            # and M110 resets the line number.
+            lines = [cmd.strip() for (cmd, response) in gslice]
+
+            if "M110" in lines:
+                lines = lines[len(lines) - 1 - lines[::-1].index("M110"):]
+                self.lineNr = 0
+
+            self.lineNr += len(filter(None, lines))
+
+    # Generator, collect chunks of lines and pack them with
+    # the bulk packer, yields lists of (command, response) tuples.
+    def packChunks(self, gcode):
+
+        gcode = iter(gcode)
 
-        prep = []
+        while True:
+
+            chunk = list(itertools.islice(gcode, Preprocessor.chunkSize))
+
+            if not chunk:
+                break
+
+            # Slices are multiples of the chunk size
+            if self.rawPos % Preprocessor.sliceSize == 0:
+                self.deltaEncoder.reset()
+            self.rawPos += len(chunk)
+
+            # skip empty lines
+            chunk = [(cmd.strip(), response) for (cmd, response) in chunk]
+            chunk = [(scmd, response) for (scmd, response) in chunk if scmd]
+
+            if not chunk:
+                continue
+
+            (lines, responses) = zip(*chunk)
+
+            if "M110" in lines:
+                lineNrs = []
+                for scmd in lines:
+                    if scmd == "M110":
+                        self.lineNr = 0
+                    lineNrs.append(self.lineNr)
+                    self.lineNr += 1
+            else:
+                lineNrs = range(self.lineNr, self.lineNr + len(lines))
+                self.lineNr += len(lines)
+
+            packed = bulkpack.packChunk(self, lines, lineNrs, responses)
+
+            if self.crc:
+                packed = [(crcCommand(cmd), response) for (cmd, response) in packed]
+
+            yield packed
+
+    # Generator, pack line by line.
+    def packSingleLines(self, gcode):
 
         for (cmd, response) in gcode:
 
+            if self.rawPos % Preprocessor.sliceSize == 0:
+                self.deltaEncoder.reset()
+            self.rawPos += 1
+
             scmd = cmd.strip()
 
             if not scmd:
@@ -306,11 +965,18 @@ class Preprocessor:
 
             packed = self.packGCode(scmd, self.lineNr)
 
+            if packed and self.delta:
+                packed = self.deltaEncoder.encode(packed, self.lineNr)
+
+            if packed and self.crc:
+                packed = crcCommand(packed)
+
             if packed:
 
                 self.packbytes += len(packed)
+                self.countPacked(scmd.split(None, 1)[0], 1, origlen, len(packed))
 
-                prep.append( ( packed, response ) )
+                yield ( packed, response )
             else:
 
                 self.packbytes += origlen
@@ -326,16 +992,60 @@ class Preprocessor:
                 # print "'%s'" % scmd
                 assert(len(scmd) == origlen) # +1 is for newline
 
-                prep.append( ( scmd, response ) )
+                yield ( scmd, response )
 
             self.lineNr += 1
 
-        print "done..."
-        return prep
+# Packer of the worker processes in parallel mode, packs a slice of
+# the gcode starting with a given line number.
+class SlicePacker(Preprocessor):
+
+    def __init__(self, lineNr, bulk, delta, crc):
+
+        self.initPacker(bulk, delta, crc)
+
+        self.lineNr = lineNr
+        self.jobs = 1
+        self.cache = None
+
+# Pack a slice of gcode in a worker process, returns the packed
+# commands and the statistics. To keep the pickled result small, the
+# commands are returned as one string with the length of each command
+# and a dictionary of the (few) responses.
+def packSlice(task):
+
+    (gslice, lineNr, bulk, delta, crc) = task
+
+    packer = SlicePacker(lineNr, bulk, delta, crc)
+    prep = list(packer.packLines(gslice))
+
+    cmds = [cmd for (cmd, response) in prep]
+    responses = dict([(i, response) for (i, (cmd, response)) in enumerate(prep) if response])
+
+    return ("".join(cmds), array.array("I", map(len, cmds)), responses, packer.origbytes, packer.packbytes, dict(packer.uncompressedCmds), dict(packer.packedCmds))
+
+# Acknowledge of a usb transmission from printer
+ACK = chr(0x6)
 
 def isPackedCommand(cmd):
     return cmd[0] < "\n"
 
+# The packed command 'cmd' with the CRC-16 of the command instead of
+# the XOR checksum and the newline, ascii commands keep their checksum.
+def crcCommand(cmd):
+
+    if not isPackedCommand(cmd):
+        return cmd
+
+    data = cmd[:-2]
+    return data + struct.pack("<H", binascii.crc_hqx(data, 0))
+
+# The ascii command 'text' with the line number 'lineNr' and the checksum
+def asciiCommand(text, lineNr):
+
+    prefix = "N%d %s" % (lineNr, text)
+    return prefix + "*%d\n" % blockstore.checksum(prefix)
+
 
 class SERIALDISCON(SerialException):
     pass
@@ -346,6 +1056,18 @@ class Printer(Serial):
     # Number of rx errors till we assume the
     # line is dead.
     maxRXErrors = 10
+    # Size of the firmware serial receive buffer, see
+    # RX_BUFFER_SIZE in MarlinSerial.h.
+    rxBufferSize = 128
+    # The firmware drains its receive buffer for drainTime seconds
+    # after an error (UsbCommand::reset() in Marlin_main.cpp), the
+    # pause before a resend is errorPauseMargin seconds longer.
+    drainTime = 0.05
+    errorPauseMargin = 0.01
+    # An error less than errorBurst acknowledged commands after the
+    # last one doubles the pause, up to maxErrorPause seconds.
+    errorBurst = 10
+    maxErrorPause = 0.2
 
     def __init__(self):
 
@@ -359,6 +1081,8 @@ class Printer(Serial):
 
         self.gcodeData = []
         self.gcodePos = 0
+        # Position of the first command
+        self.gcodeStart = 0
 
         # Retry counter on rx errors
         self.rxErrors = 0
@@ -372,9 +1096,73 @@ class Printer(Serial):
         self.startTime = None
 
         self.wantReply = None
-        self.wantAck = None
-        # Part of a response read from printer
-        self.recvPart = ""
+
+        # Max. number of commands in flight (not yet acknowledged),
+        # 1 means stop and wait.
+        self.window = 1
+        # Max. number of bytes in flight, must not overflow the
+        # serial receive buffer of the firmware.
+        self.windowBytes = Printer.rxBufferSize - 1
+        # Length of the commands in flight
+        self.inFlight = collections.deque()
+        self.inFlightBytes = 0
+        # Number of bytes sent, including resends
+        self.sentBytes = 0
+
+        # Send the commands to store in blocks of up to this
+        # many bytes, 0 to send them one by one (see blockstore.py).
+        self.blockSize = 0
+
+        # After an error, don't send until this time is reached. If
+        # flushPause is set, the responses received in the meantime
+        # are dropped.
+        self.pauseUntil = 0
+        self.flushPause = False
+        # Pause after the last error and number of commands
+        # acknowledged at that time, see errorPause().
+        self.lastErrorPause = 0
+        self.ackedAtError = 0
+
+        # Read timeout of the serial line, 0 for non-blocking
+        # reads (see printerloop.py).
+        self.readTimeout = 0.05
+
+        # Watcher of the device directory while the line is
+        # disconnected, see reconnect().
+        self.hotplug = None
+        self.devDir = "/dev"
+        # Max. time to wait for the printer to come back, and the
+        # end of this time while disconnected.
+        self.reconnectTimeout = 2.0
+        self.reconnectUntil = 0
+        # Device of the printer that could not be opened yet
+        self.reconnectDev = None
+        # Set if the printer did not come back in time
+        self.detached = False
+        # Set if the transfer was aborted by an error reply of the
+        # printer (cold extrusion, SD card errors...)
+        self.failed = False
+
+        # Checkpoint of the acknowledged position, see checkpoint.py
+        self.checkpoint = None
+
+        # Incomplete response line read from printer
+        self.rxBuffer = ""
+        # Received events, response lines and ACKs
+        self.rxEvents = collections.deque()
+
+        # Per command metrics, exported as json lines to metricsOut
+        # if set, see metrics.py.
+        self.metrics = metrics.CommandMetrics()
+        self.metricsOut = None
+
+        # Log the sent commands and ACKs, checked once per transfer
+        # to keep the send loop free of logging calls.
+        self.debug = log.isEnabledFor(logging.DEBUG)
+
+        # Min. time between two progress lines
+        self.progressInterval = 2
+        self.lastProgress = 0
 
     def initMode(self, mode):
 
@@ -385,42 +1173,109 @@ class Printer(Serial):
     def initSerial(self, device, br=115200):
         self.port = device
         self.baudrate = br
-        self.timeout = 0.05
+        self.timeout = self.readTimeout
         self.writeTimeout = 10
         self.open()
 
         # Store usb information for later re-connection even if device
-        # name has changed:
-        comports = list_ports.comports()
-
-        # ('/dev/ttyACM0', 'ttyACM0', 'USB VID:PID=2341:0042 SNR=75237333536351815111')]
-        for (dev, name, usbid) in comports:
-            if dev == device or name == device:
-                print "Found usbid %s for device %s" % (usbid, dev)
-                self.usbId = usbid
-                break
-        
-    def reconnect(self):
+        # name has changed, e.g. 'USB VID:PID=2341:0042 SNR=75237333536351815111'
+        self.usbId = list_ports.usb_id(device)
+        if self.usbId:
+            log.info("Found usbid %s for device %s", self.usbId, device)
+
+    # The file descriptor to wait for, the device watcher while
+    # disconnected, None if there is none (see printerloop.py).
+    def fileno(self):
+
+        if self.hotplug:
+            return self.hotplug.fileno()
+
+        if not self.isOpen():
+            return None
 
-        # XXX add timeout, or otherwise prevent re-connection to power-cycled printer?!
+        return Serial.fileno(self)
 
-        comports = list_ports.comports()
+    # The serial line is dead, watch for the printer to come back.
+    def disconnected(self):
 
-        # ('/dev/ttyACM0', 'ttyACM0', 'USB VID:PID=2341:0042 SNR=75237333536351815111')]
-        for (dev, name, usbid) in comports:
-            if usbid == self.usbId:
-                print "reconnect(): found device %s, previous device: %s" % (dev, self.port)
-                self.close()
-                self.initSerial(dev, br=self.baudrate)
+        self.close()
+
+        if not self.usbId:
+            self.showError("No usb id of device %s, can't reconnect!" % self.port)
+            self.detach()
+            return
+
+        self.hotplug = hotplug.TtyWatcher(self.devDir)
+        self.reconnectUntil = time.time() + self.reconnectTimeout
+        self.reconnectDev = None
+
+        # The device may still be there (or back already)
+        self.reconnect([("add", list_ports.find_usb_id(self.usbId))])
+
+    # Reattach to the printer if one of the added devices (or the
+    # devices added in the meantime) has our usb id. A device that
+    # can't be opened yet is tried again on each call.
+    def reconnect(self, events=None):
+
+        if events == None:
+            events = self.hotplug.wait(self.readTimeout)
+
+        if self.reconnectDev:
+            events = [("add", self.reconnectDev)] + events
+
+        for (event, dev) in events:
+
+            if event == "remove" and dev == self.reconnectDev:
+                self.reconnectDev = None
+
+            elif event == "add" and dev and list_ports.usb_id(dev) == self.usbId:
+
+                if dev != self.reconnectDev:
+                    log.warning("reconnect(): found device %s, previous device: %s", dev, self.port)
+
+                try:
+                    self.initSerial(dev, br=self.baudrate)
+                except (SerialException, OSError) as ex:
+                    # The device node is there before udev has set
+                    # its permissions, try again.
+                    log.debug("reconnect(): can't open device %s yet: %s", dev, ex)
+                    self.reconnectDev = dev
+                    continue
+
+                self.reconnectDev = None
+                self.hotplug.close()
+                self.hotplug = None
+
+                # Send the commands in flight again, the firmware
+                # reports the commands it already has as line errors.
+                self.gcodePos -= len(self.inFlight)
+                self.inFlight.clear()
+                self.inFlightBytes = 0
+                self.wantReply = None
+                self.rxBuffer = ""
+                self.rxErrors = 0
+                self.metrics.resend()
                 return
 
-        time.sleep(0.1)
+        if time.time() > self.reconnectUntil:
+            self.showError("Printer %s not back within %.1f seconds, not reconnecting to a power-cycled printer!" % (self.port, self.reconnectTimeout))
+            self.hotplug.close()
+            self.hotplug = None
+            self.reconnectDev = None
+            self.detach()
+
+    # Give up the printer
+    def detach(self):
+
+        self.detached = True
+        self.printing = False
+        self.postMonitor = 0
 
     def showMessage(self, s):
-        print s
+        progress.info(s)
 
     def showError(self, s):
-        print "\n%s" %s
+        log.error(s)
 
     # Check a printer response for an error
     def checkError(self, recvLine):
@@ -430,22 +1285,32 @@ class Printer(Serial):
             # Error:checksum mismatch, Last Line: 71388
             lastLine = int(recvLine.split(":")[2])
 
-            print "\nERROR:"
-            print "Reply: ", recvLine,
-            print "Scheduling resend of command:", lastLine+1
+            log.warning("ERROR: reply: %s, scheduling resend of command: %d", recvLine.rstrip(), lastLine+1)
 
             # assert(self.gcodePos == lastLine + 2)
 
-            self.gcodePos = lastLine + 1
+            # Not before the first command, e.g. after an error
+            # of the M110 of a resumed transfer
+            self.gcodePos = max(lastLine + 1, self.gcodeStart)
+
+            # Give firmware time to drain buffers. If more than one
+            # command was sent, drop the error replies to the other
+            # commands of the send window.
+            self.pauseUntil = time.time() + self.errorPause()
+            self.flushPause = self.window > 1
+
+            # Commands in flight are discarded by the firmware
+            self.metrics.resend()
+            self.inFlight.clear()
+            self.inFlightBytes = 0
 
-            # Wait 0.1 sec, give firmware time to drain buffers
-            time.sleep(0.5)
             return True
 
-        for token in ["Error:", "cold extrusion", "SD init fail", "open failed"]:
+        for token in ["Error:", "cold extrusion", "SD init fail", "open failed", 'Unknown command: "M624']:
             if token in recvLine:
 
                 self.printing = False
+                self.failed = True
 
                 s = "ERROR: reply from printer: '%s'" % recvLine
                 self.showError(s)
@@ -460,69 +1325,123 @@ class Printer(Serial):
                 # print "\n\nPrinter reset done, bailing out...\n\n"
                 # assert(0)
 
-    # Read a response from printer, "handle" exceptions
-    def safeReadline(self):
+    # Pause before the resend after an error in seconds: the drain time
+    # of the firmware plus the time the bytes in flight take on the
+    # line. Bursts of errors (e.g. a noisy line) double the pause of
+    # the last error, up to maxErrorPause.
+    def errorPause(self):
 
-        result = ""
+        acked = self.metrics.total.acked
 
-        while True:
-            try:
-                c = self.read()
-                # print "c: ", c
-            except SerialException as ex:
-                print "Readline() Exception raised:", ex
+        # 10 bits per byte on the line
+        pause = Printer.drainTime + Printer.errorPauseMargin + self.inFlightBytes * 10.0 / self.baudrate
 
-                self.rxErrors += 1
+        if acked - self.ackedAtError < Printer.errorBurst:
+            pause = max(pause, 2 * self.lastErrorPause)
 
-                if self.rxErrors >= Printer.maxRXErrors:
-                    print "declare line is dead ..."
-                    raise SERIALDISCON
+        pause = min(pause, Printer.maxErrorPause)
 
-                time.sleep(0.1)
-                break
+        self.lastErrorPause = pause
+        self.ackedAtError = acked
 
-            if not c:
-                break
+        return pause
 
-            # Received something, reset error counter
-            self.rxErrors = 0
+    # Read all available bytes from printer, "handle" exceptions. The
+    # data is split into events: complete response lines and standalone
+    # ACKs (chr(0x6)), an incomplete line is kept until the rest arrives.
+    def receive(self):
 
-            result += c
+        try:
+            # Wait for the first byte (max. timeout), then drain the input
+            data = self.read(max(1, self.inWaiting()))
 
-            if c == "\n":
-                break
+            n = self.inWaiting()
+            if n:
+                data += self.read(n)
 
-            if ord(c) == 0x6:
-                result += "\n"
-                break
+        except SerialException as ex:
+            log.warning("Readline() Exception raised: %s", ex)
+
+            self.rxErrors += 1
+
+            if self.rxErrors >= Printer.maxRXErrors:
+                log.error("declare line is dead ...")
+                raise SERIALDISCON
 
-        return result
+            time.sleep(0.1)
+            return
+
+        if not data:
+            return
+
+        # Received something, reset error counter
+        self.rxErrors = 0
+
+        lines = (self.rxBuffer + data).split("\n")
+        self.rxBuffer = lines.pop()
+
+        for line in lines:
+
+            if ACK in line:
+                # ACKs are sent without newline
+                self.rxEvents.extend(ACK * line.count(ACK))
+                line = line.replace(ACK, "")
+
+                if not line:
+                    continue
+
+            self.rxEvents.append(line + "\n")
+
+        # Don't wait for the end of the line to process the ACKs
+        if ACK in self.rxBuffer:
+            self.rxEvents.extend(ACK * self.rxBuffer.count(ACK))
+            self.rxBuffer = self.rxBuffer.replace(ACK, "")
+
+    # Generator, read from printer and yield the received events.
+    def readEvents(self):
+
+        self.receive()
+
+        while self.rxEvents:
+            yield self.rxEvents.popleft()
+
+    # Read a response from printer, returns the next event or an
+    # empty string if nothing was received.
+    def safeReadline(self):
+
+        if not self.rxEvents:
+            self.receive()
+
+        if self.rxEvents:
+            return self.rxEvents.popleft()
+
+        return ""
 
     # Monitor printer responses for a while (wait waitcount * 0.1 seconds)
     def readMore(self, waitcount=100):
 
-        print "waiting %.2f seconds for more messages..." % (waitcount/20.0)
+        log.info("waiting %.2f seconds for more messages...", waitcount/20.0)
 
         for i in range(waitcount):
 
             try:
                 recvLine = self.safeReadline()        
             except SERIALDISCON:
-                print "Line disconnected in readMore"
+                log.error("Line disconnected in readMore")
                 return
 
             if recvLine:
                 if ord(recvLine[0]) > 20:
-                    print "Reply: ", recvLine,
+                    log.info("Reply: %s", recvLine.rstrip())
                 else:
-                    print "Reply: 0x%s" % recvLine.encode("hex")
+                    log.info("Reply: 0x%s", recvLine.encode("hex"))
 
     # Stop and reset the printer
     # xxx does not work right yet, um2 display still says 'preheating...'
     # yyy is this still the case?
     def reset(self):
 
-        print "\nResetting printer"
+        log.warning("Resetting printer")
 
         # self._send("M29\n") # End sd write, response: "Done saving"
         # self._send("G28\n") # Home all Axis, response: ok
@@ -533,7 +1452,7 @@ class Printer(Serial):
         gcode = ["M29", "G28", "M84", "M104 S0", "M140 S0"]
         prep = Preprocessor("reset", gcode = map(lambda x: (x, None), gcode))
 
-        print "Reset code sequence: ", prep.prep
+        log.info("Reset code sequence: %s", list(prep.prep))
 
         for (cmd, resp) in prep.prep:
             self.send(cmd)
@@ -543,107 +1462,229 @@ class Printer(Serial):
     # needed.
     def send(self, cmd):
 
+        if self.debug:
+            self.logSend(cmd)
+
+        self.write(cmd)
+
+    def logSend(self, cmd):
+
         if isPackedCommand(cmd):
-        
-            print "\nSend: ", cmd.encode("hex")
-            self.write(cmd)
+            log.debug("Send: %s", cmd.encode("hex"))
         else:
+            log.debug("Send: %s", cmd.rstrip())
 
-            print "\nSend: ", cmd,
-            self.write(cmd)
+    # Write the commands 'start' to 'end' - 1 of gcodeData in one go,
+    # 'lines' is the list of these commands.
+    def sendBlock(self, start, end, lines):
+
+        if isinstance(self.gcodeData, PackedGCode):
+            self.write(self.gcodeData.view(start, end))
+        elif len(lines) == 1:
+            self.write(lines[0])
+        else:
+            self.write("".join(lines))
 
 
     # The 'mainloop' process each command in the list 'gcode', check
     # for the required responses and do errorhandling.
-    def sendGcode(self, gcode, wantReply=None):
+    def sendGcode(self, gcode, wantReply=None, start=0):
+
+        self.startGcode(gcode, wantReply, start)
+
+        ev = DummyEvent()
+
+        while self.processCommand(ev):
+            pass
+
+    # Setup sending of the commands in the list 'gcode' from position
+    # 'start' on, the commands are sent by processCommand().
+    def startGcode(self, gcode, wantReply=None, start=0):
 
         self.printing = True
 
         self.startTime = time.time()
 
+        if self.blockSize:
+            gcode = self.frameGcode(gcode)
+
         self.gcodeData = gcode
-        self.gcodePos = 0
+        self.gcodePos = self.gcodeStart = start
+        self.failed = False
 
         self.wantReply = wantReply
-        self.wantAck = False
+        self.inFlight.clear()
+        self.inFlightBytes = 0
+        self.sentBytes = 0
 
-        self.recvPart = None
+        self.rxBuffer = ""
+        self.rxEvents.clear()
 
-        ev = DummyEvent()
+        self.pauseUntil = 0
+        self.flushPause = False
+        self.lastErrorPause = 0
+        self.ackedAtError = 0
 
-        while self.processCommand(ev):
-            pass
+        self.metrics.start()
+
+        self.debug = log.isEnabledFor(logging.DEBUG)
+        self.lastProgress = self.startTime
+
+    # The commands of 'gcode' with the commands to store
+    # framed in blocks, see blockstore.py.
+    def frameGcode(self, gcode):
+
+        frames = blockstore.frameCommands(gcode, self.blockSize)
+
+        if isinstance(gcode, LazyGCode):
+            return LazyGCode(frames)
+
+        return PackedGCode(frames)
+
+    # Returns True if all commands are sent and the post
+    # monitoring time is over.
+    def done(self):
+        return not self.printing and time.time() > self.postMonitor
 
     def processCommand(self, ev):
 
-        if not self.printing and time.time() > self.postMonitor:
+        if self.done():
             return False
 
+        if self.hotplug:
+            # Disconnected, wait for the printer to come back
+            self.reconnect()
+            return not self.done()
+
+        if self.flushPause and time.time() >= self.pauseUntil:
+            # End of the pause after an error, drop the rest
+            # of the dropped responses.
+            self.flushPause = False
+            self.rxBuffer = ""
+
         # if time.time() <  self.postMonitor: 
-            # print "postmon: ", self.wantAck, self.wantReply, self.gcodePos
+            # print "postmon: ", self.inFlight, self.wantReply, self.gcodePos
         
         # if self.printing:
-            # print "print: ", self.wantAck, self.wantReply, self.gcodePos
+            # print "print: ", self.inFlight, self.wantReply, self.gcodePos
+
+        # Fill the send window, stop if a command needs a reply first.
+        # The commands are written in one block.
+        start = self.gcodePos
+        lines = []
+
+        while self.printing and time.time() >= self.pauseUntil and len(self.inFlight) < self.window and not self.wantReply and self.mode != "mon" and self.gcodePos < len(self.gcodeData):
+
+            (line, reply) = self.gcodeData[self.gcodePos]
+
+            if self.inFlight and (self.inFlightBytes + len(line)) > self.windowBytes:
+                # Firmware receive buffer is full
+                break
 
-        if self.printing and not self.wantAck and not self.wantReply and self.mode != "mon" and self.gcodePos < len(self.gcodeData):
             # send a line
-            (line, self.wantReply) = self.gcodeData[self.gcodePos]
-            self.send(line)
+            self.wantReply = reply
+            if self.debug:
+                self.logSend(line)
+            lines.append(line)
             self.gcodePos += 1
             self.lastSend = time.time()
-            self.wantAck = True
+            self.inFlight.append(len(line))
+            self.inFlightBytes += len(line)
+            self.sentBytes += len(line)
+            self.metrics.sent(len(line), isPackedCommand(line), self.lastSend)
 
             # Update gui
-            if (self.gcodePos % 250) == 0:
-                duration = time.time() - self.startTime
-                self.showMessage("Sent %d/%d gcodes, %.1f gcodes/sec" % (self.gcodePos, len(self.gcodeData), self.gcodePos/duration))
+            if self.lastSend - self.lastProgress >= self.progressInterval:
+                self.lastProgress = self.lastSend
+                duration = self.lastSend - self.startTime
+                if isinstance(self.gcodeData, LazyGCode):
+                    # Total number of commands not known yet
+                    self.showMessage("Sent %d gcodes, %.1f gcodes/sec" % (self.gcodePos, self.gcodePos/duration))
+                else:
+                    self.showMessage("Sent %d/%d gcodes, %.1f gcodes/sec" % (self.gcodePos, len(self.gcodeData), self.gcodePos/duration))
 
             # We have sent a command to the printer, request more
             # cpu cycles from wx to process the answer quickly
             ev.RequestMore(True)
 
+        if lines:
+            self.sendBlock(start, self.gcodePos, lines)
+
         try:
-            recvLine = self.safeReadline()        
+            for recvLine in self.readEvents():
+
+                # There was something to read, so request more
+                # cpu cycles from wx
+                ev.RequestMore(True)
+
+                if self.flushPause and time.time() < self.pauseUntil:
+                    # Drop the error replies to the other commands of
+                    # the send window
+                    continue
+
+                self.processResponse(recvLine)
+
         except SERIALDISCON:
             # self.printing = False
             # self.postMonitor = 0
             # self.showError("Line disconnected in processCommand(). Can't do a reset! Check your printer!")
             self.showError("Line disconnected in processCommand(). Trying reconnect!")
-            self.reconnect()
-            return True
+            self.disconnected()
 
-        if not recvLine:
-            return True
+        self.writeMetrics(self.metrics.poll())
+
+        if self.checkpoint:
+            self.saveCheckpoint()
 
-        # There was something to read, so request more
-        # cpu cycles from wx
-        ev.RequestMore(True)
+        return True
 
+    # Save the acknowledged position, at most once per
+    # Checkpoint.interval unless 'force' is set.
+    def saveCheckpoint(self, force=False):
+        self.checkpoint.update(self.gcodePos - len(self.inFlight), force)
 
-        if self.recvPart:
-            recvLine = self.recvPart + recvLine
-            self.recvPart = None
+    # Save the last acknowledged position and close the checkpoint
+    def closeCheckpoint(self):
 
-        if recvLine[-1] != "\n":
-            self.recvPart = recvLine
-            return True
+        if self.checkpoint:
+            self.saveCheckpoint(True)
+            self.checkpoint.close()
+            self.checkpoint = None
+
+    # Export a record of the metrics
+    def writeMetrics(self, record):
+
+        if record and self.metricsOut:
+            metrics.writeRecord(self.metricsOut, record, port=self.port)
+
+    # Print the metrics of the finished transfer and export them
+    def reportMetrics(self):
+
+        self.metrics.printReport()
+        self.writeMetrics(self.metrics.poll(force=True))
+        self.writeMetrics(self.metrics.report())
+
+    # Handle a response line or an ACK from the printer
+    def processResponse(self, recvLine):
 
         if self.mode != "mon" and self.checkError(recvLine):
             # command resend
-            self.wantAck = False
             self.wantReply = None
-            return True
+            return
 
-        if self.wantAck and recvLine[0] == chr(0x6):
-            print "ACK"
-            self.wantAck = False
-            return True
+        if recvLine == ACK:
+            if self.inFlight:
+                if self.debug:
+                    log.debug("ACK")
+                self.inFlightBytes -= self.inFlight.popleft()
+                self.metrics.acked()
+            return
 
         if self.wantReply and recvLine.startswith(self.wantReply):
-            print "Got Required reply: ", recvLine,
+            log.info("Got Required reply: %s", recvLine.rstrip())
             self.wantReply = None
         else:
-            print "Reply: ", recvLine,
+            log.info("Reply: %s", recvLine.rstrip())
 
         # self.endTokens = ['echo:enqueing "M84"']   
 
@@ -651,17 +1692,24 @@ class Printer(Serial):
 
             self.postMonitor = time.time() + 5
 
-            print "\n-----------------------------------------------"
-            print "Store statistics:"
-            print "-----------------------------------------------\n"
+            log.info("-----------------------------------------------")
+            log.info("Store statistics:")
+            log.info("-----------------------------------------------")
             self.storeDuration = time.time() - self.startTime
 
+            if self.checkpoint:
+                # Transfer complete, nothing to resume
+                self.checkpoint.finish()
+                self.checkpoint = None
+
             if self.mode == "store":
                 self.showMessage("Sent %d gcodes in %.1f seconds, %.1f gcodes/sec." % (self.gcodePos, self.storeDuration, self.gcodePos/self.storeDuration))
                 self.printing = False
             else:
                 self.showMessage("Sent %d gcodes in %.1f seconds, %.1f gcodes/sec.\nPlease wait for the print to finish.\n" % (self.gcodePos, self.storeDuration, self.gcodePos/self.storeDuration))
 
+            self.reportMetrics()
+
         else:
 
             for token in self.endTokens:
@@ -669,14 +1717,231 @@ class Printer(Serial):
 
                     self.postMonitor = time.time() + 5
 
-                    print "end-reply received, finished print..."
+                    log.info("end-reply received, finished print...")
                     self.printing = False
 
                     duration = time.time() - self.startTime
 
                     self.showMessage("Print finished. Duration: %.1f seconds, Downloadspeed: %.1f gcodes/sec.\n" % (duration, self.gcodePos/self.storeDuration))
 
-        return True
+
+# The comment lines at the start of the preprocessed file 'prep', the
+# header the UM2 reads (";FLAVOR:UltiGCode", ";TIME:", ";MATERIAL:"...).
+def headerComments(prep):
+
+    comments = []
+
+    for pos in xrange(len(prep)):
+
+        (cmd, response) = prep[pos]
+
+        if response:
+            # Setup of the transfer, M110, M28...
+            continue
+
+        if isPackedCommand(cmd) or not blockstore.asciiText(cmd).startswith(";"):
+            break
+
+        comments.append(blockstore.asciiText(cmd))
+
+    return comments
+
+# The commands to resume the transfer of the preprocessed file 'prep' at
+# position 'position' with the modal state 'state' (see checkpoint.py),
+# None if the file has to be sent from the beginning. The header comments
+# of the file come first, so the UM2 prints an UltiGCode file as
+# UltiGCode: it heats up and primes the nozzle itself (see
+# UltiLCD2_menu_print.cpp) and the E values are volumes.
+def resumeGCode(prep, position, state):
+
+    crc = "crc" in prep.options.split(",")
+
+    head = [("M110", "ok")]
+    if crc:
+        head.append(("M624 S1", "ok"))
+    if prep.mode == "print":
+        head.append(("M623 usb.g", "ok"))
+    head.append(("M28 usb.g", "ok"))
+    head += [(cmd, None) for cmd in headerComments(prep)]
+    head += [(cmd, None) for cmd in state.preamble()]
+
+    if position < len(head):
+        # Nothing of the file stored yet
+        return None
+
+    return ResumedGCode(prep, position, head, state.reference, crc)
+
+# Preprocess a job of the printer farm in a worker process, the
+# result is stored in the cache.
+def prepareJob(task):
+
+    (mode, filename, cacheDir, cacheSize, delta, crc, passes) = task
+
+    Preprocessor(mode, filename, cache=prepcache.PrepCache(cacheDir, cacheSize), delta=delta, crc=crc, passes=passes)
+
+    return filename
+
+# Find the serial devices of all connected printers with
+# the usb id 'vidPid', e.g. "2341:0042".
+def findPrinters(vidPid):
+
+    return [dev for (dev, name, usbid) in list_ports.grep("VID:PID=%s" % vidPid)]
+
+#
+# Print farm: dispatch a queue of gcode files to a set of printers. The
+# jobs are preprocessed ahead of time by a pool of worker processes into
+# the cache, each job is sent to the next idle printer. All printers are
+# driven by one PrinterLoop.
+#
+class Farm:
+
+    def __init__(self, printers, mode, gfiles, cacheDir, cacheSize, jobs=1, delta=False, crc=False, passes=()):
+
+        self.printers = printers
+        self.mode = mode
+        self.cacheDir = cacheDir
+        self.cacheSize = cacheSize
+        self.delta = delta
+        self.crc = crc
+        self.passes = passes
+
+        self.pool = multiprocessing.Pool(jobs)
+
+        # Queue of (filename, preprocessing result) tuples
+        self.queue = collections.deque()
+        for gfile in gfiles:
+            task = (mode, gfile, cacheDir, cacheSize, delta, crc, passes)
+            self.queue.append((gfile, self.pool.apply_async(prepareJob, (task,))))
+
+        # Per printer: current job and list of (filename, commands,
+        # bytes, duration) of the finished jobs.
+        self.current = {}
+        self.finished = dict([(printer, []) for printer in printers])
+
+        # Per printer: list of (filename, reason) of the jobs that
+        # were not finished, aborted by an error or printer lost.
+        self.failed = dict([(printer, []) for printer in printers])
+
+        # List of (filename, reason) of the jobs not started
+        self.notStarted = []
+
+        # Per printer: ACK latencies and resends of all jobs
+        self.latency = dict([(printer, metrics.LatencyHistogram()) for printer in printers])
+        self.resends = dict([(printer, 0) for printer in printers])
+
+    def run(self):
+
+        loop = printerloop.PrinterLoop()
+
+        # Printers waiting for a job, the first job of a printer has
+        # to wait for the printer startup.
+        idle = collections.deque(self.printers)
+        started = set()
+
+        while self.queue or loop.printers:
+
+            while idle and self.queue and self.queue[0][1].ready():
+
+                (gfile, result) = self.queue.popleft()
+
+                try:
+                    # Raises the exception of the worker process, if any
+                    result.get()
+
+                    prep = Preprocessor(self.mode, gfile, cache=prepcache.PrepCache(self.cacheDir, self.cacheSize), delta=self.delta, crc=self.crc, passes=self.passes)
+                except Exception as ex:
+                    # Bad file, go on with the next job
+                    log.error("Preprocessing of job %s failed: %s", gfile, ex)
+                    self.notStarted.append((gfile, "preprocessing failed"))
+                    continue
+
+                printer = idle.popleft()
+                progress.info("Starting job %s on printer %s, %d jobs left.", gfile, printer.port, len(self.queue))
+
+                wantReply = None
+                if printer not in started:
+                    wantReply = "echo:SD card ok"
+                    started.add(printer)
+
+                loop.add(printer, prep.prep, wantReply)
+                self.current[printer] = gfile
+
+            if self.queue and not idle and not loop.printers:
+                log.error("No printers left, %d jobs not started.", len(self.queue))
+                self.notStarted += [(gfile, "no printer left") for (gfile, result) in self.queue]
+                break
+
+            for printer in loop.step():
+
+                duration = time.time() - printer.startTime
+                gfile = self.current.pop(printer)
+
+                if printer.detached:
+                    # Lost, don't give it another job
+                    log.error("Printer %s lost, job %s not finished.", printer.port, gfile)
+                    self.failed[printer].append((gfile, "lost"))
+                    continue
+
+                if printer.failed:
+                    # The printer reported an error (cold extrusion, no
+                    # SD card...) that needs attention, don't give it
+                    # another job.
+                    log.error("Printer %s failed, job %s aborted after %d commands.", printer.port, gfile, printer.gcodePos)
+                    self.failed[printer].append((gfile, "failed"))
+                    continue
+
+                progress.info("Printer %s finished job %s: %d commands, %d bytes in %.1f seconds, %.1f gcodes/sec, %.1f bytes/sec.",
+                    printer.port, gfile, printer.gcodePos, printer.sentBytes, duration, printer.gcodePos/duration, printer.sentBytes/duration)
+
+                self.finished[printer].append((gfile, printer.gcodePos, printer.sentBytes, duration))
+                self.latency[printer].merge(printer.metrics.total.latency)
+                self.resends[printer] += printer.metrics.total.resends
+                idle.append(printer)
+
+        self.pool.close()
+        self.pool.join()
+
+        self.printStat()
+
+    def printStat(self):
+
+        log.info("# Printer farm, completed jobs:")
+        log.info("#")
+        log.info("# %-20s %6s %10s %12s %10s %12s %8s %8s %8s %8s", "Printer", "Jobs", "Commands", "Bytes", "Seconds", "Bytes/sec", "p50 ms", "p95 ms", "p99 ms", "Resends")
+        log.info("#")
+
+        for printer in self.printers:
+
+            jobs = self.finished[printer]
+            commands = sum([job[1] for job in jobs])
+            nbytes = sum([job[2] for job in jobs])
+            duration = sum([job[3] for job in jobs])
+
+            rate = 0
+            if duration:
+                rate = nbytes / duration
+
+            lat = self.latency[printer].summary()
+
+            log.info("# %-20s %6d %10d %12d %10.1f %12.1f %8.2f %8.2f %8.2f %8d",
+                printer.port, len(jobs), commands, nbytes, duration, rate, lat["p50"], lat["p95"], lat["p99"], self.resends[printer])
+
+            for (gfile, n, b, d) in jobs:
+                log.info("#     %s", gfile)
+
+            # Unfinished jobs are errors, reported with -q too
+            for (gfile, reason) in self.failed[printer]:
+                log.warning("#     %s (%s)", gfile, reason)
+
+        if self.notStarted:
+
+            log.warning("#")
+            log.warning("# Jobs not started:")
+            log.warning("#")
+
+            for (gfile, reason) in self.notStarted:
+                log.warning("#     %s (%s)", gfile, reason)
+
 
 # 
 # Main
@@ -684,42 +1949,219 @@ class Printer(Serial):
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser(description='UltiPrint, print on UM2 over USB.')
-    parser.add_argument("-d", dest="device", action="store", type=str, help="Device to use, default: /dev/ttyACM0.", default="/dev/ttyACM0")
-
-    subparsers = parser.add_subparsers(dest="mode", help='Mode: mon(itor)|print|store|reset|pre(process).')
+    parser.add_argument("-d", dest="devices", action="append", type=str, help="Device to use, default: /dev/ttyACM0. Give -d more than once to drive several printers at once (mon, print, store and farm mode), farm mode uses all printers found by usb id by default.", default=None)
+    parser.add_argument("-w", dest="window", action="store", type=int, help="Max. number of commands in flight, default: 1 (wait for the ACK of each command).", default=1)
+    parser.add_argument("-b", dest="blockSize", action="store", type=int, help="Bulk store, send the commands to store in blocks of up to this many bytes (%d-%d), needs firmware support of packed command 9, default: 0 (off)." % (blockstore.minBlockSize, blockstore.maxBlockSize), default=0)
+    parser.add_argument("-R", dest="reconnectTimeout", action="store", type=float, help="Max. seconds to wait for a disconnected printer to come back, a printer that takes longer is not reattached (power-cycled), default: 2.", default=2.0)
+    parser.add_argument("-M", dest="metricsFile", action="store", type=str, help="Write the command metrics (ACK latency, throughput, resends) as json lines to this file, '-' for stdout.", default=None)
+    parser.add_argument("-v", dest="verbose", action="store_true", help="Verbose output, log each command sent and each ACK.")
+    parser.add_argument("-q", dest="quiet", action="store_true", help="Quiet, report progress and errors only.")
+    parser.add_argument("-I", dest="metricsInterval", action="store", type=float, help="Seconds between two metrics records while sending, default: 10.", default=10)
+    parser.add_argument("-K", dest="checkpointFile", action="store", type=str, help="Save the resume position of the print to this checkpoint file (print mode), see the resume mode. Needs the preprocessed commands in a file: a cache directory (-c) or a file written by 'pre -o', not with -l.", default=None)
+    parser.add_argument("-B", dest="checkpointBackoff", action="store", type=int, help="Number of acknowledged commands the printer may not have printed yet (firmware command and planner buffers), the resume position of -K is this many commands before the first command not acknowledged, default: %d." % checkpoint.Checkpoint.backoff, default=checkpoint.Checkpoint.backoff)
+
+    subparsers = parser.add_subparsers(dest="mode", help='Mode: mon(itor)|print|store|resume|reset|pre(process)|farm.')
 
     sp = subparsers.add_parser("mon", help=u"Monitor printer.")
 
+    # Names of the gcode passes
+    def passList(s):
+
+        names = s.split(",")
+        if names == ["all"]:
+            return gcodepass.passNames
+
+        for name in names:
+            if name not in gcodepass.passNames:
+                raise argparse.ArgumentTypeError("unknown gcode pass '%s'" % name)
+
+        return names
+
+    # Packer options
+    def addPackOptions(sp, cacheDir=None):
+        sp.add_argument("-D", dest="delta", action="store_true", help="Delta encode the coordinates of moves, needs firmware support of packed command 8.")
+        sp.add_argument("-r", "--crc", dest="crc", action="store_true", help="Check the packed commands with a CRC-16 instead of the XOR checksum, needs firmware support of M624.")
+        sp.add_argument("-O", dest="passes", action="store", type=passList, help="Comma separated list of gcode passes to run before packing: %s, or all (see gcodepass.py), default: none." % ",".join(gcodepass.passNames), default=[])
+        sp.add_argument("-j", "--jobs", dest="jobs", action="store", type=int, help="Number of worker processes to preprocess in parallel, not used with -l, default: 1.", default=1)
+        sp.add_argument("-c", dest="cacheDir", action="store", type=str, help="Cache preprocessed files in this directory, e.g. ~/.ultiprint/cache.", default=cacheDir)
+        sp.add_argument("-C", dest="cacheSize", action="store", type=int, help="Max. size of the cache directory in MB, default: 1024.", default=1024)
+
+    # Options common to the modes that preprocess a gcode file
+    def addPrepOptions(sp):
+        sp.add_argument("gfile", help="Input GCode file.")
+        sp.add_argument("-l", dest="lazy", action="store_true", help="Preprocess lazily while sending, keeps memory usage low for big files.")
+        addPackOptions(sp)
+
+    # Cache of preprocessed files or None
+    def prepCache(args):
+        if args.cacheDir:
+            return prepcache.PrepCache(args.cacheDir, args.cacheSize * 1024 * 1024)
+        return None
+
     sp = subparsers.add_parser("print", help=u"Print file.")
-    sp.add_argument("gfile", help="Input GCode file.")
+    addPrepOptions(sp)
 
     sp = subparsers.add_parser("store", help=u"Store file as USB.G on sd-card.")
-    sp.add_argument("gfile", help="Input GCode file.")
+    addPrepOptions(sp)
+
+    sp = subparsers.add_parser("resume", help=u"Resume an interrupted print from the checkpoint file written with -K.")
+    sp.add_argument("checkpoint", help="Checkpoint file.")
 
     sp = subparsers.add_parser("reset", help=u"Try to stop/reset printer.")
 
-    sp = subparsers.add_parser("pre", help=u"Preprocess gcode, for debugging purpose.")
-    sp.add_argument("gfile", help="Input GCode file.")
+    sp = subparsers.add_parser("pre", help=u"Preprocess gcode, print the statistics and optionally write the packed commands to a file.")
+    addPrepOptions(sp)
+    sp.add_argument("-k", "--check", dest="check", action="store_true", help="Check that the result is identical to serial preprocessing.")
+    sp.add_argument("-o", dest="output", action="store", type=str, help="Write the packed commands to this file, it can be given to the print or store mode instead of a gcode file.", default=None)
+    sp.add_argument("-m", dest="prepMode", choices=["store", "print"], help="Preprocess for this mode, default: store.", default="store")
+
+    sp = subparsers.add_parser("farm", help=u"Send a queue of gcode files to all connected printers, each file to the next idle printer.")
+    sp.add_argument("gfiles", nargs="+", help="Input GCode files.")
+    sp.add_argument("-m", dest="jobMode", choices=["store", "print"], help="Store or print the files, default: store.", default="store")
+    sp.add_argument("-u", dest="vidPid", action="store", type=str, help="USB VID:PID of the printers if no -d is given, default: 2341:0042 (UM2).", default="2341:0042")
+    addPackOptions(sp, "~/.ultiprint/cache")
 
     args = parser.parse_args()
     # print "args: ", args
 
+    setupLogging(args.verbose, args.quiet)
+
+    if args.blockSize and not (blockstore.minBlockSize <= args.blockSize <= blockstore.maxBlockSize):
+        parser.error("block size must be in the range %d-%d" % (blockstore.minBlockSize, blockstore.maxBlockSize))
+
     if args.mode == 'pre':
+
+        if args.check and args.lazy:
+            parser.error("-k can not be used with -l")
+
         #
         # Preprocess only
         #
-        prep = Preprocessor(args.mode, args.gfile)
+        prep = Preprocessor(args.prepMode, args.gfile, lazy=args.lazy, cache=prepCache(args), jobs=args.jobs, delta=args.delta, crc=args.crc, passes=args.passes)
+
+        if args.output:
+            # Before drain(), the lazy mode keeps only the last commands
+            prepcache.writePrepFile(args.output, prep, Preprocessor.packerVersion)
+            log.info("Packed commands written to: %s", args.output)
+
+        if isinstance(prep.prep, LazyGCode):
+            prep.prep.drain()
         prep.printStat();
+
+        if args.check:
+            log.info("Checking against serial preprocessing...")
+            serial = Preprocessor(args.prepMode, args.gfile, delta=args.delta, crc=args.crc, passes=args.passes)
+
+            if len(prep.prep) != len(serial.prep) or \
+                (prep.origbytes, prep.packbytes, dict(prep.uncompressedCmds), dict(prep.packedCmds)) != \
+                (serial.origbytes, serial.packbytes, dict(serial.uncompressedCmds), dict(serial.packedCmds)):
+                log.error("Check failed: different number of commands or statistics.")
+                sys.exit(1)
+
+            for pos in xrange(len(serial.prep)):
+                if prep.prep[pos] != serial.prep[pos]:
+                    log.error("Check failed: command %d differs: %s, %s", pos, repr(prep.prep[pos]), repr(serial.prep[pos]))
+                    sys.exit(1)
+
+            log.info("Check ok, %d commands identical.", len(serial.prep))
+
         sys.exit(0)
 
-    printer = Printer()
-    printer.initMode(args.mode)
-    printer.initSerial(args.device)
+    printerMode = args.mode
+
+    if args.mode == "farm":
+
+        if not args.cacheDir:
+            parser.error("farm mode needs a cache directory (-c)")
+
+        devices = args.devices or findPrinters(args.vidPid)
+
+        if not devices:
+            log.error("No printers with usb id %s found.", args.vidPid)
+            sys.exit(1)
+
+        progress.info("Printer farm: %d printers, %d jobs.", len(devices), len(args.gfiles))
+        printerMode = args.jobMode
+    else:
+        devices = args.devices or ["/dev/ttyACM0"]
+
+    if len(devices) > 1 and args.mode == "reset":
+        parser.error("reset mode supports only one device")
+
+    if args.checkpointFile and args.mode == "store":
+        parser.error("-K: a store can't be resumed, the firmware truncates usb.g")
+
+    if args.mode == "resume" or (args.checkpointFile and args.mode == "print"):
+
+        if len(devices) > 1:
+            parser.error("checkpoints support only one device")
+
+        # The framed blocks have other positions than the commands
+        if args.blockSize:
+            parser.error("checkpoints can not be used with -b")
+
+    if args.checkpointFile and args.mode == "print":
+
+        if args.lazy or not (args.cacheDir or prepcache.isPrepFile(args.gfile)):
+            parser.error("-K needs a cache directory (-c) or a preprocessed file and can not be used with -l")
+
+    if args.mode == "resume":
+
+        saved = checkpoint.load(args.checkpoint)
+        if not saved:
+            parser.error("%s: no valid checkpoint" % args.checkpoint)
+
+        (seq, position, lineNr, offset, jobHash, prepPath, state) = saved
+
+        resumePrep = prepcache.PrepFile(prepPath)
+
+        if checkpoint.jobHash(resumePrep) != jobHash:
+            parser.error("%s: preprocessed file has changed since the checkpoint" % prepPath)
+
+        if position > len(resumePrep) or resumePrep.offsets[position] - prepcache.header.size != offset:
+            parser.error("%s: checkpoint doesn't match the preprocessed file" % args.checkpoint)
+
+        if resumePrep.mode != "print":
+            parser.error("%s: a store can't be resumed, the firmware truncates usb.g, store the file again" % prepPath)
+
+        resumeGcode = resumeGCode(resumePrep, position, state)
+
+        # An UltiGCode file has no temperatures, the printer heats up
+        # itself. Don't print other files with a cold nozzle.
+        if resumeGcode and not state.hotend and ";FLAVOR:UltiGCode" not in headerComments(resumePrep):
+            parser.error("%s: can't resume, no hotend temperature known (no M104/M109 and not UltiGCode)" % prepPath)
+
+        # The resumed commands are numbered by their position, see
+        # ResumedGCode
+        if position < len(resumePrep) and blockstore.lineNumber(resumePrep[position][0]) != position:
+            parser.error("%s: can't resume, the line numbers are reset (M110) in the file" % prepPath)
+
+        printerMode = resumePrep.mode
+
+    metricsOut = None
+    if args.metricsFile == "-":
+        metricsOut = sys.stdout
+    elif args.metricsFile:
+        metricsOut = open(args.metricsFile, "a")
+
+    printers = []
+
+    for device in devices:
+
+        printer = Printer()
+        printer.initMode(printerMode)
+        printer.window = args.window
+        printer.blockSize = args.blockSize
+        printer.reconnectTimeout = args.reconnectTimeout
+        printer.metrics.interval = args.metricsInterval
+        printer.metricsOut = metricsOut
+        printer.initSerial(device)
 
-    # Read left over garbage
-    recvLine = printer.safeReadline()        
-    print "Initial read: "
-    print recvLine.encode("hex"), "\n"
+        # Read left over garbage
+        recvLine = printer.safeReadline()        
+        log.debug("Initial read: %s", recvLine.encode("hex"))
+
+        printers.append(printer)
 
     if args.mode == "reset":
         #
@@ -729,18 +2171,90 @@ if __name__ == "__main__":
         printer.readMore(50)
         sys.exit(0)
 
-    if args.mode == "mon":
+    if args.mode == "farm":
         #
-        # Monitor printer output
+        # Dispatch the job queue to the printers
         #
-        printer.sendGcode([], "echo:SD card ok")
+        Farm(printers, printerMode, args.gfiles, args.cacheDir, args.cacheSize * 1024 * 1024, jobs=args.jobs, delta=args.delta, crc=args.crc, passes=args.passes).run()
         sys.exit(0)
 
+    if len(printers) == 1:
+
+        if args.mode == "mon":
+            #
+            # Monitor printer output
+            #
+            printer.sendGcode([], "echo:SD card ok")
+            sys.exit(0)
+
+        if args.mode == "resume":
+            #
+            # Send the rest of the file from the checkpoint on
+            #
+            gcode = resumeGcode
+
+            if gcode:
+                log.info("Resuming %s at command %d (line %d acknowledged)", prepPath, position, lineNr)
+                printer.checkpoint = checkpoint.Checkpoint(args.checkpoint, resumePrep, position, state, seq, args.checkpointBackoff)
+                start = gcode.start
+            else:
+                log.info("Nothing stored yet, sending %s from the beginning", prepPath)
+                gcode = resumePrep
+                printer.checkpoint = checkpoint.Checkpoint(args.checkpoint, resumePrep, backoff=args.checkpointBackoff)
+                start = 0
+
+            try:
+                printer.sendGcode(gcode, "echo:SD card ok", start)
+            finally:
+                printer.closeCheckpoint()
+
+            sys.exit(0)
+
+        prep = Preprocessor(args.mode, args.gfile, lazy=args.lazy, cache=prepCache(args), jobs=args.jobs, delta=args.delta, crc=args.crc, passes=args.passes)
+
+        if args.checkpointFile:
+
+            prepFile = prep.prepFile()
+            if not prepFile:
+                log.error("No preprocessed file to checkpoint, the cache file is gone.")
+                sys.exit(1)
+
+            printer.checkpoint = checkpoint.Checkpoint(args.checkpointFile, prepFile, backoff=args.checkpointBackoff)
+
+        try:
+            printer.sendGcode(prep.prep, "echo:SD card ok")
+        finally:
+            printer.closeCheckpoint()
+
+    else:
+
+        #
+        # Drive all printers from one event loop
+        #
+        loop = printerloop.PrinterLoop()
+
+        if args.mode == "mon":
+
+            for printer in printers:
+                loop.add(printer, [], "echo:SD card ok")
+
+            loop.run()
+            sys.exit(0)
+
+        prep = Preprocessor(args.mode, args.gfile, lazy=args.lazy, cache=prepCache(args), jobs=args.jobs, delta=args.delta, crc=args.crc, passes=args.passes)
+
+        for printer in printers:
+
+            gcode = prep.prep
 
-    prep = Preprocessor(args.mode, args.gfile)
+            if isinstance(gcode, LazyGCode) and printer is not printers[0]:
+                # The lazy preprocessor keeps only a window of the
+                # commands, each printer needs its own one.
+                gcode = Preprocessor(args.mode, args.gfile, lazy=True, delta=args.delta, crc=args.crc, passes=args.passes).prep
 
-    printer.sendGcode(prep.prep, "echo:SD card ok")
+            loop.add(printer, gcode, "echo:SD card ok")
 
+        loop.run()
 
     prep.printStat();
 